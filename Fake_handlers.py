@@ -1,14 +1,360 @@
-class Fake_GPIO:
-    def __init__(self):
-        self.IN = 1
-        self.OUT = 0
-        self.PUD_UP = 1
-        self.PUD_DOWN = 1
-    def setup(self, *args,**kwargs):
+import os
+import threading
+import queue
+import heapq
+import time
+import traceback
+import weakref
+
+
+def bounce_burst(t, level, bounces = 4, spacing = 0.0005):
+    '''make a list of (time, level) pairs that chatter between levels before settling on level at t.
+    mimics the contact bounce / beam flicker we see on the rig'''
+    other = 0 if level else 1
+    burst = []
+    for i in range(bounces):
+        burst += [(t + 2*i*spacing, level), (t + (2*i+1)*spacing, other)]
+    burst += [(t + 2*bounces*spacing, level)]
+    return burst
+
+class Simulated_GPIO:
+    '''stand-in for RPi.GPIO that plays back scripted edge timelines per pin.
+
+    pin levels follow the scripted edges, and edge callbacks are run one at a time from a single
+    dispatch thread, the same way RPi.GPIO runs them. like the kernel, edges that arrive on a pin while its
+    last event is still waiting to be handled are coalesced, and bouncetime is measured from the last callback.'''
+
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, verbose = False):
+        self.mode = None
+        self.verbose = verbose
+        self.levels = {}
+        self.directions = {}
+        self.detections = {}
+        self.edge_log = []
+        self.stats = {'edges':0, 'detected':0, 'callbacks':0, 'coalesced':0, 'bounced':0, 'undetected':0}
+
+        self._lock = threading.RLock()
+        self._pending = set()
+        self._dispatching = False
+        self._dispatch_queue = queue.Queue()
+        self._dispatch_thread = None
+
+        self._timeline = []
+        self._timeline_counter = 0
+        self._timeline_changed = threading.Condition(self._lock)
+        self._player_thread = None
+        self._playing = False
+        if hasattr(os, 'register_at_fork'):
+            after_fork = weakref.WeakMethod(self._after_fork)
+            os.register_at_fork(after_in_child = lambda: after_fork() and after_fork()())
+
+    def _after_fork(self):
+        '''threads don't survive a fork (box_sharding's workers), so the child gets fresh locks and queue and
+        starts its own dispatcher and player when it next needs them'''
+        self._lock = threading.RLock()
+        self._pending = set()
+        self._dispatching = False
+        self._dispatch_queue = queue.Queue()
+        self._dispatch_thread = None
+        self._timeline_changed = threading.Condition(self._lock)
+        self._player_thread = None
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def getmode(self):
+        return self.mode
+
+    def setwarnings(self, flag):
         pass
-    
+
+    def setup(self, pin, direction, pull_up_down = None, initial = None):
+        pull_up_down = self.PUD_OFF if pull_up_down is None else pull_up_down
+        with self._lock:
+            self.directions[pin] = direction
+            if pin in self.levels:
+                #keep the level a script has already put on this pin
+                return
+            if direction == self.OUT:
+                self.levels[pin] = self.LOW if initial is None else initial
+            else:
+                self.levels[pin] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+
     def input(self, pin):
-        return 3
+        if pin not in self.directions:
+            raise RuntimeError('You must setup() the GPIO channel first')
+        return self.levels[pin]
+
+    def output(self, pin, value):
+        if self.directions.get(pin) != self.OUT:
+            raise RuntimeError('The GPIO channel has not been set up as an OUTPUT')
+        self.set_level(pin, value)
+
+    def add_event_detect(self, pin, edge, callback = None, bouncetime = None):
+        if pin not in self.directions:
+            raise RuntimeError('You must setup() the GPIO channel first')
+        if edge not in (self.RISING, self.FALLING, self.BOTH):
+            raise ValueError('The edge must be set to RISING, FALLING or BOTH')
+        with self._lock:
+            if pin in self.detections:
+                raise RuntimeError('Conflicting edge detection already enabled for this GPIO channel')
+            self.detections[pin] = {'edge':edge,
+                                    'bouncetime':bouncetime,
+                                    'callbacks':[callback] if callback else [],
+                                    'last_call':0,
+                                    'detected':False}
+        self._start_dispatcher()
+
+    def add_event_callback(self, pin, callback):
+        with self._lock:
+            if pin not in self.detections:
+                raise RuntimeError('Add event detection using add_event_detect first before adding a callback')
+            self.detections[pin]['callbacks'].append(callback)
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self.detections.pop(pin, None)
+            self._pending.discard(pin)
+
+    def event_detected(self, pin):
+        with self._lock:
+            detection = self.detections.get(pin)
+            if detection is None or not detection['detected']:
+                return False
+            detection['detected'] = False
+            return True
+
+    def cleanup(self, pin = None):
+        with self._lock:
+            pins = list(self.directions) if pin is None else ([pin] if isinstance(pin, int) else list(pin))
+            for p in pins:
+                self.detections.pop(p, None)
+                self.directions.pop(p, None)
+                self.levels.pop(p, None)
+                self._pending.discard(p)
+            if pin is None:
+                self._timeline = []
+                self._playing = False
+                self._timeline_changed.notify_all()
+
+    def set_level(self, pin, level):
+        '''drive a pin to level right now. fires edge detection the same way a scripted edge does'''
+        level = 1 if level else 0
+        with self._lock:
+            previous = self.levels.get(pin)
+            self.levels[pin] = level
+            if previous is None or previous == level:
+                return
+            now = time.perf_counter_ns()
+            self.stats['edges'] += 1
+            self.edge_log.append((now, pin, level))
+            detection = self.detections.get(pin)
+            if detection is None:
+                self.stats['undetected'] += 1
+                return
+            if not self._edge_matches(detection['edge'], level):
+                return
+            self.stats['detected'] += 1
+            detection['detected'] = True
+            if pin in self._pending:
+                self.stats['coalesced'] += 1
+                return
+            self._pending.add(pin)
+        self._dispatch_queue.put(pin)
+
+    def script_edges(self, pin, timeline, start = None):
+        '''schedule a list of (seconds, level) pairs on a pin. seconds are relative to start,
+        which is a time.perf_counter() value and defaults to now.'''
+        start = time.perf_counter() if start is None else start
+        with self._lock:
+            for t, level in timeline:
+                self._timeline_counter += 1
+                heapq.heappush(self._timeline, (start + t, self._timeline_counter, pin, level))
+            self._timeline_changed.notify_all()
+        self._start_player()
+
+    def pending_edges(self):
+        with self._lock:
+            return len(self._timeline)
+
+    def wait_for_timeline(self, timeout = None):
+        '''block until every scripted edge has been applied. returns False on timeout'''
+        end = None if timeout is None else time.perf_counter() + timeout
+        while self.pending_edges():
+            if end is not None and time.perf_counter() > end:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def wait_for_callbacks(self, timeout = None):
+        '''block until the dispatch thread has handled every detected edge. returns False on timeout'''
+        end = None if timeout is None else time.perf_counter() + timeout
+        while not self.idle():
+            if end is not None and time.perf_counter() > end:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def idle(self):
+        '''no detected edge is waiting for, or still inside, its callbacks'''
+        with self._lock:
+            return not self._pending and not self._dispatching and self._dispatch_queue.empty()
+
+    def _edge_matches(self, edge, level):
+        if edge == self.BOTH:
+            return True
+        return (edge == self.RISING) == (level == self.HIGH)
+
+    def _start_dispatcher(self):
+        with self._lock:
+            if self._dispatch_thread is None or not self._dispatch_thread.is_alive():
+                self._dispatch_thread = threading.Thread(target = self._dispatch, daemon = True, name = 'simulated_gpio_dispatch')
+                self._dispatch_thread.start()
+
+    def _dispatch(self):
+        while True:
+            pin = self._dispatch_queue.get()
+            with self._lock:
+                self._pending.discard(pin)
+                detection = self.detections.get(pin)
+                if detection is None:
+                    continue
+                now = time.perf_counter_ns()
+                bouncetime = detection['bouncetime']
+                if bouncetime and detection['last_call'] and now - detection['last_call'] <= bouncetime * 1_000_000:
+                    self.stats['bounced'] += 1
+                    continue
+                detection['last_call'] = now
+                callbacks = list(detection['callbacks'])
+                self._dispatching = True
+            for callback in callbacks:
+                self.stats['callbacks'] += 1
+                try:
+                    callback(pin)
+                except Exception:
+                    traceback.print_exc()
+            with self._lock:
+                self._dispatching = False
+
+    def _start_player(self):
+        with self._lock:
+            self._playing = True
+            if self._player_thread is None or not self._player_thread.is_alive():
+                self._player_thread = threading.Thread(target = self._play, daemon = True, name = 'simulated_gpio_player')
+                self._player_thread.start()
+
+    def _play(self):
+        '''apply scripted edges at their deadlines. sleeps coarsely, then spins for the last millisecond'''
+        while True:
+            with self._lock:
+                while not self._timeline and self._playing:
+                    self._timeline_changed.wait()
+                if not self._playing:
+                    return
+                deadline, _, pin, level = self._timeline[0]
+                remaining = deadline - time.perf_counter()
+                if remaining > 0.002:
+                    self._timeline_changed.wait(remaining - 0.001)
+                    continue
+            while time.perf_counter() < deadline:
+                pass
+            with self._lock:
+                if self._timeline and self._timeline[0][0] == deadline:
+                    heapq.heappop(self._timeline)
+                else:
+                    continue
+            self.set_level(pin, level)
+
+#kept so older scripts that ask for the fake still get a working GPIO
+Fake_GPIO = Simulated_GPIO
+
+class Fake_I2C_Device:
+    '''stands in for the adafruit_bus_device I2CDevice on a PCA9685 and counts bus transactions.
+    writes land in registers with auto-increment, like the chip'''
+    def __init__(self, registers):
+        self.registers = registers
+        self.transactions = 0
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+    def write(self, buf):
+        self.transactions += 1
+        self.bytes_written += len(buf)
+        self.registers[buf[0]:buf[0] + len(buf) - 1] = buf[1:]
+
+    def reset_counts(self):
+        self.transactions = 0
+        self.bytes_written = 0
+
+
+class Fake_PWM_Channel:
+    '''duty_cycle goes through the fake bus as one 4 register write, the way adafruit_pca9685 PWMChannel does it'''
+    def __init__(self, pca, index):
+        self._pca = pca
+        self.index = index
+
+    @property
+    def duty_cycle(self):
+        on_l, on_h, off_l, off_h = self._pca.registers[0x06 + 4*self.index:0x06 + 4*self.index + 4]
+        if on_h & 0x10:
+            return 0xFFFF
+        if off_h & 0x10:
+            return 0
+        return ((off_h << 8) | off_l) << 4
+
+    @duty_cycle.setter
+    def duty_cycle(self, value):
+        if value == 0xFFFF:
+            on, off = 0x1000, 0
+        elif value < 0x0010:
+            on, off = 0, 0x1000
+        else:
+            on, off = 0, value >> 4
+        with self._pca.i2c_device as i2c:
+            i2c.write(bytes([0x06 + 4*self.index, on & 0xFF, on >> 8, off & 0xFF, off >> 8]))
+
+class Fake_PCA9685:
+    def __init__(self, channels = 16):
+        self.registers = bytearray(256)
+        self.i2c_device = Fake_I2C_Device(self.registers)
+        self.channels = [Fake_PWM_Channel(self, i) for i in range(channels)]
+        self.frequency = 1526
+        #auto-increment on, as adafruit_pca9685 leaves it after setting the frequency
+        self.registers[0x00] = 0x20
+
+    @property
+    def mode1_reg(self):
+        return self.registers[0x00]
+
+    @mode1_reg.setter
+    def mode1_reg(self, value):
+        with self.i2c_device as i2c:
+            i2c.write(bytes([0x00, value]))
+
+class Fake_ServoKit:
+    def __init__(self, channels = 16):
+        '''stands in for adafruit_servokit.ServoKit so LEDs can be built off the pi'''
+        self._pca = Fake_PCA9685(channels)
 
 class Fake_pigpio:
     def pi():
@@ -24,7 +370,6 @@ class Fake_pigpio_funcs:
 class Fake_timestamp_writer:
     def write_timestamp(*args, **kwargs):
         print(f'Fake_timestamp_writer received {args}\n{kwargs}')
-    
+
     def shut_down():
         pass
-    
\ No newline at end of file
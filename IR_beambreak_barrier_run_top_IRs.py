@@ -1,18 +1,17 @@
 import argparse
 import os
-from box import Box
+from session_orchestrator import run_session, resume_session
 parser = argparse.ArgumentParser(description='input io info')
 parser.add_argument('--yaml_in', '-i',type = str, 
                     help = 'where is the csv experiments file?',
                     action = 'store')
-from recording_classes import TimestampManager, default_generate_output_fname
+parser.add_argument('--resume', type = str, default = None,
+                    help = 'journal (journal_*.jsonl in the save path) of a crashed session to carry on. no yaml needed')
 from components import Four_Beambreak_LED_Button_Combo, IR_beambreak, Button, LED
+from event_loop_runtime import Async_Four_Beambreak_LED_Button_Combo
 import yaml
-import datetime
 import pdb
-import time
-from components import GPIO
-import csv
+from state_machine import FOUR_BEAM_SPEC
 args = parser.parse_args()
 
 def make_beambreak_pair(yaml_file, box_id, timestamp_writer):
@@ -39,7 +38,9 @@ def make_beambreak_pair(yaml_file, box_id, timestamp_writer):
         
     
     
-    return Four_Beambreak_LED_Button_Combo(
+    #software: runtime: asyncio runs the box on the event loop instead of the thread pool
+    combo_class = Async_Four_Beambreak_LED_Button_Combo if yaml_file['software'].get('runtime') == 'asyncio' else Four_Beambreak_LED_Button_Combo
+    return combo_class(
                                           beambreak_1 = ir_1, 
                                           beambreak_2 = ir_2,
                                           beambreak_3 = ir_3, 
@@ -56,6 +57,10 @@ def make_beambreak_pair(yaml_file, box_id, timestamp_writer):
     
     
 
+if args.resume:
+    resume_session(args.resume, make_beambreak_pair, spec = FOUR_BEAM_SPEC)
+    exit()
+
 if args.yaml_in:
     yaml_file = args.yaml_in
 if not os.path.isfile(yaml_file):
@@ -65,69 +70,4 @@ if not os.path.isfile(yaml_file):
 with open(yaml_file, 'r') as f:
     config_dict = yaml.safe_load(f)
 
-#save the config file, timestamped just in case
-date = datetime.datetime.now()
-fpath = config_dict['software']['save_path']
-config_filename = default_generate_output_fname('config', date)
-
-with open(os.path.join(fpath,config_filename)+'.yaml', 'w') as outfile:
-    yaml.dump(config_dict, outfile)
-    
-
-#start making boxes
-boxes = []
-
-for box_ID in config_dict['hardware'].keys():
-    box = Box(box_ID)
-    filename = default_generate_output_fname(config_dict['animals'][box_ID]['focal'], date)+'.csv'
-    writer = TimestampManager(fpath, filename)
-    beambreak_pair = make_beambreak_pair(config_dict, box_ID, writer)
-    box.add_component(beambreak_pair, 'ir_pair')
-    box.ir_pair.entry_state(reward_time = config_dict['software']['reward_period'])
-    boxes += [box]
-
-i = 0  
-while any([not b.ir_pair.started for b in boxes]):
-    i+=1
-    if i%15 == 0:
-        print(f'waiting to start: {[b.name  for b in boxes if not b.ir_pair.started]}')
-    time.sleep(0.1)
-print('done waiting to start')
-cycle = time.time()
-while any([cycle - b.ir_pair.start_time < config_dict['software']['total_time'] for b in boxes]) or any([not b.ir_pair.exit for b in boxes]):
-    [b.ir_pair.exit_state() for b in boxes if cycle - b.ir_pair.start_time > config_dict['software']['total_time'] if not b.ir_pair.state == 'reward' if not b.ir_pair.state == 'exit']
-    time.sleep(0.250)
-    cycle = time.time()
-    
-GPIO.cleanup()
-
-
-header = ['box', 'animal', 'IR_1_traversals','IR_1_notes', 'IR_2_traversals','IR_2_notes', 'novel_ID']
-
-
-summary_file = default_generate_output_fname('summary',date) + '.csv'
-summary_fpath = os.path.join(fpath, summary_file)
-with open(summary_fpath, 'w') as f:
-    writer = csv.writer(f)
-    writer.writerow(header)
-
-for box in boxes:
-    ir = box.ir_pair
-    data=[box.name, 
-            config_dict['animals'][box.name]['focal'], 
-            ir.traversal_counts[1], 
-            ir.notes_1,
-            ir.traversal_counts[2],
-            ir.notes_2,
-            config_dict['animals'][box.name]['novel']]
-    
-    with open(summary_fpath, 'a') as f:
-        writer = csv.writer(f)
-        writer.writerow(data)
-
-
-
-
-
-    
-    
\ No newline at end of file
+run_session(config_dict, make_beambreak_pair, spec = FOUR_BEAM_SPEC)
@@ -0,0 +1,168 @@
+'''per session metrics from beambreak timestamp csvs (and binary event logs), for whole results directories.
+
+files are read in chunks with fixed dtypes, and ID, beam, event and notes are categoricals, so a chunk is a few
+arrays of small integer codes. each chunk is reduced with numpy/pandas to partial sums per (box, beam, event kind),
+and those are folded into the running totals, so memory is bounded by the chunk size however long a session is.
+a directory is streamed one file at a time and only the per beam metrics are kept.
+
+one row per box and beam:
+    traversal beams   traversals, traversal latency (from the last reset, s) mean/std/min/max,
+                      reward periods completed and canceled, cancel rate, cancel latency (from the traversal)
+    top beams         breaks, total time broken, mean/max break duration
+plus session_s, the last event's elapsed_time for the box.
+
+    python beambreak_analysis.py results/Kelly --out kelly_metrics.csv
+'''
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['ID', 'beam', 'elapsed_time', 'event', 'latency', 'notes']
+DTYPES = {'ID':'category', 'beam':'category', 'elapsed_time':'float64', 'event':'category', 'latency':'float64',
+          'notes':'category'}
+KEYS = ['ID', 'beam', 'notes']
+CHUNKSIZE = 200_000
+
+OTHER, TRAVERSAL, CANCELED, REWARD_END, TOP_DURATION = range(5)
+KIND_OF_EVENT = {'reward_canceled':CANCELED, 'reward_period_end':REWARD_END, 'beam_break_duration':TOP_DURATION}
+
+
+def event_kinds(events):
+    '''kind of every row, looked up from the (few) event categories rather than row by row'''
+    categories = events.cat.categories
+    lookup = np.array([KIND_OF_EVENT.get(name, TRAVERSAL if name.endswith(' traversal') else OTHER) for name in categories]
+                      + [OTHER], dtype = np.int8)
+    #missing events have code -1, which lands on the trailing OTHER
+    return lookup[events.cat.codes.to_numpy()]
+
+def is_event_file(path):
+    if path.endswith('.bbev'):
+        return True
+    if not path.endswith('.csv'):
+        return False
+    with open(path) as f:
+        header = f.readline().strip().split(',')
+    return all(column in header for column in COLUMNS)
+
+def read_chunks(path, chunksize = CHUNKSIZE):
+    '''the COLUMNS of an event file as dataframes of at most chunksize rows'''
+    if path.endswith('.bbev'):
+        from binary_event_log import Binary_Event_Log
+        log = Binary_Event_Log(path)
+        for start in range(0, len(log), chunksize):
+            yield log.to_dataframe(start, start + chunksize)[COLUMNS]
+        return
+    yield from pd.read_csv(path, usecols = COLUMNS, dtype = DTYPES, chunksize = chunksize)
+
+def partial_sums(chunk):
+    '''latency sums per (ID, beam, notes, kind) for the rows that count toward a metric'''
+    kinds = event_kinds(chunk['event'])
+    keep = kinds != OTHER
+    latency = chunk['latency'].to_numpy()[keep]
+    frame = pd.DataFrame({key:chunk[key].to_numpy()[keep].astype(str) for key in KEYS})
+    frame['kind'] = kinds[keep]
+    frame['latency'] = latency
+    frame['latency_sq'] = latency*latency
+    grouped = frame.groupby(KEYS + ['kind'], sort = False)
+    sums = grouped['latency'].agg(['size', 'count', 'sum', 'min', 'max'])
+    sums['sum_sq'] = grouped['latency_sq'].sum()
+    return sums
+
+def combine(totals, sums):
+    if totals is None:
+        return sums
+    both = pd.concat([totals, sums]).groupby(level = [0, 1, 2, 3], sort = False)
+    return both.agg({'size':'sum', 'count':'sum', 'sum':'sum', 'min':'min', 'max':'max', 'sum_sq':'sum'})
+
+def session_sums(path, chunksize = CHUNKSIZE):
+    '''running totals over a whole file, and each box's last elapsed_time'''
+    totals = None
+    session_s = pd.Series(dtype = 'float64')
+    for chunk in read_chunks(path, chunksize):
+        totals = combine(totals, partial_sums(chunk))
+        last = chunk.groupby('ID', observed = True)['elapsed_time'].max()
+        last.index = last.index.astype(str)
+        session_s = pd.concat([session_s, last]).groupby(level = 0).max()
+    return totals, session_s
+
+def latency_columns(sums, prefix):
+    n = sums['count']
+    variance = (sums['sum_sq'] - sums['sum']**2/n)/(n - 1)
+    return pd.DataFrame({f'{prefix}_mean':sums['sum']/n,
+                         f'{prefix}_std':np.sqrt(variance.clip(lower = 0)).where(n > 1),
+                         f'{prefix}_min':sums['min'],
+                         f'{prefix}_max':sums['max']})
+
+def session_metrics(path, chunksize = CHUNKSIZE):
+    '''one row per box and beam of the file at path, see the module docstring'''
+    totals, session_s = session_sums(path, chunksize)
+    if totals is None or totals.empty:
+        return pd.DataFrame()
+    kinds = totals.index.get_level_values('kind')
+    by_kind = {kind:totals[kinds == kind].droplevel('kind') for kind in (TRAVERSAL, CANCELED, REWARD_END, TOP_DURATION)}
+
+    traversal = by_kind[TRAVERSAL]
+    sides = pd.DataFrame({'traversals':traversal['size']}, index = traversal.index)
+    sides = sides.join(latency_columns(traversal, 'traversal_latency'))
+    sides['rewards_completed'] = by_kind[REWARD_END]['size'].reindex(sides.index, fill_value = 0)
+    sides['rewards_canceled'] = by_kind[CANCELED]['size'].reindex(sides.index, fill_value = 0)
+    sides['cancel_rate'] = sides['rewards_canceled']/sides['traversals']
+    sides = sides.join(latency_columns(by_kind[CANCELED], 'cancel_latency')[['cancel_latency_mean', 'cancel_latency_max']])
+    sides.insert(0, 'kind', 'traversal')
+
+    top = by_kind[TOP_DURATION]
+    tops = pd.DataFrame({'kind':'top', 'breaks':top['size'], 'time_broken_s':top['sum']}, index = top.index)
+    tops = tops.join(latency_columns(top, 'break_duration')[['break_duration_mean', 'break_duration_max']])
+
+    metrics = pd.concat([sides, tops]).reset_index().sort_values(['ID', 'kind', 'beam'], ignore_index = True)
+    for column in ('traversals', 'rewards_completed', 'rewards_canceled', 'breaks'):
+        metrics[column] = metrics[column].astype('Int64')
+    metrics['session_s'] = metrics['ID'].map(session_s)
+    metrics.insert(0, 'file', os.path.basename(path))
+    return metrics
+
+def event_files(root):
+    '''every event csv / binary log under root, in a stable order. summaries and configs are skipped'''
+    if os.path.isfile(root):
+        yield root
+        return
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        for fname in sorted(files):
+            path = os.path.join(directory, fname)
+            if is_event_file(path):
+                yield path
+
+def iter_metrics(root, chunksize = CHUNKSIZE):
+    '''(path, metrics) for every session under root, one file in memory at a time'''
+    for path in event_files(root):
+        yield path, session_metrics(path, chunksize)
+
+def directory_metrics(root, chunksize = CHUNKSIZE):
+    frames = [metrics for _, metrics in iter_metrics(root, chunksize) if not metrics.empty]
+    return pd.concat(frames, ignore_index = True) if frames else pd.DataFrame()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'per box and beam metrics for beambreak sessions')
+    parser.add_argument('paths', type = str, nargs = '+', help = 'event csvs, .bbev logs or directories of them')
+    parser.add_argument('--out', type = str, default = None, help = 'write every metric row to this csv')
+    parser.add_argument('--chunksize', type = int, default = CHUNKSIZE)
+    args = parser.parse_args()
+    frames = []
+    for root in args.paths:
+        for path, metrics in iter_metrics(root, args.chunksize):
+            print(f'{path}: {len(metrics)} rows')
+            frames += [metrics]
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        print('no beambreak events found')
+    else:
+        metrics = pd.concat(frames, ignore_index = True)
+        sides = metrics[metrics['kind'] == 'traversal']
+        print(sides.groupby('notes')[['traversals', 'rewards_canceled']].sum().assign(
+            cancel_rate = lambda totals: totals['rewards_canceled']/totals['traversals']).to_string())
+        if args.out:
+            metrics.to_csv(args.out, index = False)
+            print(f'wrote {args.out}')
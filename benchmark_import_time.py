@@ -0,0 +1,55 @@
+'''import time guard for components (and anything else listed).
+
+imports each module in a fresh interpreter a few times and fails (exit code 1) if the median import takes longer
+than the budget, or if importing opened a hardware backend or started a thread. run it after touching imports:
+
+    python benchmark_import_time.py --budget_ms 150
+    python benchmark_import_time.py --modules components wheel --runs 10
+'''
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+parser = argparse.ArgumentParser(description = 'import time regression guard')
+parser.add_argument('--modules', nargs = '+', default = ['components'])
+parser.add_argument('--runs', type = int, default = 5)
+parser.add_argument('--budget_ms', type = float, default = 150)
+
+CHILD = '''
+import json, sys, threading, time
+start = time.perf_counter()
+module = __import__(sys.argv[1])
+elapsed = time.perf_counter() - start
+import hardware_backends
+print(json.dumps({'import_ms':elapsed*1000,
+                  'threads':threading.active_count(),
+                  'gpio_open':hardware_backends.GPIO.is_open(),
+                  'servo_open':hardware_backends.SERVO_KIT.is_open()}))
+'''
+
+def measure(module):
+    result = subprocess.run([sys.executable, '-c', CHILD, module], capture_output = True, text = True)
+    if result.returncode != 0:
+        raise Exception(f'importing {module} failed:\n{result.stderr}')
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    failed = False
+    print(f"{'module':<16}{'median ms':>10}{'max ms':>9}{'threads':>9}  hardware opened")
+    for module in args.modules:
+        runs = [measure(module) for _ in range(args.runs)]
+        times = [r['import_ms'] for r in runs]
+        opened = [kind for kind in ('gpio', 'servo') if any(r[f'{kind}_open'] for r in runs)]
+        threads = max(r['threads'] for r in runs)
+        median = statistics.median(times)
+        print(f"{module:<16}{median:>10.1f}{max(times):>9.1f}{threads:>9}  {', '.join(opened) if opened else 'no'}")
+        if median > args.budget_ms:
+            print(f'  {module} import is over the {args.budget_ms} ms budget')
+            failed = True
+        if opened or threads > 1:
+            print(f'  importing {module} should not open hardware or start threads')
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,275 @@
+'''edge-to-disk latency benchmark for the beambreak state machines.
+
+drives Two_Beambreak_LED_Button_Combo / Four_Beambreak_LED_Button_Combo boxes with scripted edges on the
+simulated GPIO and reports, per box count:
+    edge -> TimestampManager.write_timestamp latency for traversal events
+    write_timestamp -> line landing in the csv latency for every event
+    events per second, dropped traversal edges and lines that never reached the file
+
+every (combo, box count) pair runs in its own interpreter so leftover threads from one run can't skew the next.
+
+    python benchmark_latency.py --boxes 1 4 16 64 --combo two four --duration 15
+    python benchmark_latency.py --runtime asyncio
+    python benchmark_latency.py --runtime table
+'''
+import argparse
+import contextlib
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+parser = argparse.ArgumentParser(description = 'edge-to-disk latency benchmark for the beambreak state machines')
+parser.add_argument('--boxes', type = int, nargs = '+', default = [1, 4, 16, 64])
+parser.add_argument('--combo', type = str, nargs = '+', default = ['two', 'four'], choices = ['two', 'four'])
+parser.add_argument('--duration', type = float, default = 15, help = 'seconds of scripted behavior per run')
+parser.add_argument('--reward_time', type = float, default = 0.5)
+parser.add_argument('--out_dir', type = str, default = None, help = 'where to put the csvs. defaults to a temp dir')
+parser.add_argument('--seed', type = int, default = 0)
+parser.add_argument('--runtime', type = str, default = 'threads', choices = ['threads', 'asyncio', 'table'],
+                    help = 'run the combos on the thread pool or on the event loop runtime, or run state_machine boxes')
+parser.add_argument('--single', action = 'store_true', help = argparse.SUPPRESS)
+parser.add_argument('--result_file', type = str, default = None, help = argparse.SUPPRESS)
+
+PIN_BLOCK = 8
+HOLD = 0.15
+BUTTON_HOLD = 0.1
+CYCLE_GAP = 0.5
+
+def box_pins(box_number):
+    base = 100 + box_number*PIN_BLOCK
+    return {'ir_1':base, 'ir_2':base+1, 'ir_3':base+2, 'ir_4':base+3, 'button':base+4}
+
+def summarize(values_ns):
+    '''percentiles of a list of nanosecond latencies, in ms'''
+    if not values_ns:
+        return {'n':0, 'p50':None, 'p90':None, 'p99':None, 'max':None}
+    values = sorted(v/1e6 for v in values_ns)
+    if len(values) > 1:
+        cuts = statistics.quantiles(values, n = 100, method = 'inclusive')
+        p50, p90, p99 = cuts[49], cuts[89], cuts[98]
+    else:
+        p50 = p90 = p99 = values[0]
+    return {'n':len(values), 'p50':p50, 'p90':p90, 'p99':p99, 'max':values[-1]}
+
+class File_Tailer:
+    '''polls csv files and timestamps each line as it lands on disk'''
+    def __init__(self, paths, interval = 0.001):
+        self.paths = paths
+        self.interval = interval
+        self.landed = {p:[] for p in paths}
+        self.running = True
+        self.thread = threading.Thread(target = self.run, daemon = True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.poll(time.perf_counter_ns())
+
+    def run(self):
+        while self.running:
+            self.poll(time.perf_counter_ns())
+            time.sleep(self.interval)
+
+    def poll(self, now):
+        for path, handle in self.handles.items():
+            chunk = handle.read()
+            if chunk:
+                self.landed[path] += [now]*chunk.count('\n')
+
+    def open(self):
+        self.handles = {p:open(p, 'r') for p in self.paths}
+        for p, handle in self.handles.items():
+            #skip the header
+            handle.readline()
+
+def run_single(combo_type, n_boxes, duration, reward_time, out_dir, seed, runtime = 'threads'):
+    import components
+    from components import IR_beambreak, Button, LED, Two_Beambreak_LED_Button_Combo, Four_Beambreak_LED_Button_Combo
+    if runtime == 'asyncio':
+        from event_loop_runtime import Async_Two_Beambreak_LED_Button_Combo as Two_Beambreak_LED_Button_Combo
+        from event_loop_runtime import Async_Four_Beambreak_LED_Button_Combo as Four_Beambreak_LED_Button_Combo
+    from recording_classes import TimestampManager
+    from box_executor import EXECUTORS
+    from state_machine import State_Machine_Box, Compiled_State_Machine, DEFAULT_SPEC
+    machine = Compiled_State_Machine(DEFAULT_SPEC)
+
+    class Instrumented_TimestampManager(TimestampManager):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.calls = []
+
+        def write_timestamp(self, line, *args, **kwargs):
+            self.calls.append((time.perf_counter_ns(), line))
+            return super().write_timestamp(line, *args, **kwargs)
+
+    GPIO = components.GPIO
+    if not GPIO.is_open():
+        GPIO.use('simulated')
+        components.SERVO_KIT.use('simulated')
+    if not hasattr(GPIO, 'script_edges'):
+        raise Exception(f'benchmark needs the simulated GPIO backend, but {GPIO.backend_name()} is open')
+
+    rng = random.Random(seed)
+    boxes = []
+    for b in range(n_boxes):
+        pins = box_pins(b)
+        writer = Instrumented_TimestampManager(out_dir, f'{combo_type}_{n_boxes}_box_{b}.csv')
+        led = LED(b % 16)
+        button = Button(pins['button'])
+        ir_1 = IR_beambreak(pins['ir_1'])
+        ir_2 = IR_beambreak(pins['ir_2'])
+        if runtime == 'table':
+            top_beams = []
+            if combo_type == 'four':
+                top_beams = [IR_beambreak(pins['ir_3'], timestamp_writer = writer, notes = 'novel_top'),
+                             IR_beambreak(pins['ir_4'], timestamp_writer = writer, notes = 'partner_top')]
+            combo = State_Machine_Box(machine, [ir_1, ir_2], led, button, f'box_{b}', top_beams = top_beams,
+                                      notes = ['novel', 'partner'], timestamp_writer = writer)
+        elif combo_type == 'two':
+            combo = Two_Beambreak_LED_Button_Combo(ir_1, ir_2, led, button, f'box_{b}',
+                                                   notes_1 = 'novel', notes_2 = 'partner', timestamp_writer = writer)
+        else:
+            ir_3 = IR_beambreak(pins['ir_3'], timestamp_writer = writer, notes = 'novel_top')
+            ir_4 = IR_beambreak(pins['ir_4'], timestamp_writer = writer, notes = 'partner_top')
+            combo = Four_Beambreak_LED_Button_Combo(ir_1, ir_2, ir_3, ir_4, led, button, f'box_{b}',
+                                                    notes_1 = 'novel', notes_2 = 'partner', timestamp_writer = writer)
+        boxes += [(combo, writer, pins)]
+
+    for combo, _, _ in boxes:
+        combo.entry_state(reward_time = reward_time)
+    while any(combo.state != 'entry' for combo, _, _ in boxes):
+        time.sleep(0.01)
+
+    tailer = File_Tailer([writer.fp for _, writer, _ in boxes])
+    tailer.open()
+    tailer.start()
+
+    cycle_length = reward_time + CYCLE_GAP + HOLD
+    n_cycles = max(1, int((duration - 0.7)//cycle_length))
+    start = time.perf_counter()
+    for combo, writer, pins in boxes:
+        offset = rng.uniform(0, 0.2)
+        GPIO.script_edges(pins['button'], [(offset + 0.2, 0), (offset + 0.2 + BUTTON_HOLD, 1)], start = start)
+        for c in range(n_cycles):
+            t = offset + 0.7 + c*cycle_length
+            beam = 'ir_1' if c % 2 == 0 else 'ir_2'
+            GPIO.script_edges(pins[beam], [(t, 0), (t + HOLD, 1)], start = start)
+            if combo_type == 'four':
+                top = 'ir_3' if c % 2 == 0 else 'ir_4'
+                GPIO.script_edges(pins[top], [(t + 0.2, 0), (t + 0.3, 1)], start = start)
+            press = t + reward_time + 0.2
+            GPIO.script_edges(pins['button'], [(press, 0), (press + BUTTON_HOLD, 1)], start = start)
+
+    GPIO.wait_for_timeline()
+    GPIO.wait_for_callbacks(timeout = 5)
+    time.sleep(reward_time + 0.5)
+    session_time = time.perf_counter() - start
+    tailer.stop()
+
+    for combo, _, _ in boxes:
+        combo.LED.set_off()
+
+    edge_ns = {}
+    for t_ns, pin, level in GPIO.edge_log:
+        if level == 0:
+            edge_ns.setdefault(pin, []).append(t_ns)
+
+    edge_to_write = []
+    write_to_disk = []
+    scripted_traversals = 0
+    detected_traversals = 0
+    written = 0
+    landed = 0
+    for combo, writer, pins in boxes:
+        used = set()
+        traversal_edges = {1:edge_ns.get(pins['ir_1'], []), 2:edge_ns.get(pins['ir_2'], [])}
+        scripted_traversals += n_cycles
+        for call_ns, line in writer.calls:
+            if not str(line[3]).endswith('traversal'):
+                continue
+            detected_traversals += 1
+            candidates = [t for t in traversal_edges[line[1]] if t <= call_ns and (line[1], t) not in used]
+            if candidates:
+                used.add((line[1], candidates[-1]))
+                edge_to_write += [call_ns - candidates[-1]]
+        landed_ns = tailer.landed[writer.fp]
+        written += len(writer.calls)
+        landed += len(landed_ns)
+        write_to_disk += [land - call for (call, _), land in zip(writer.calls, landed_ns)]
+
+    return {'combo':combo_type,
+            'runtime':runtime,
+            'boxes':n_boxes,
+            'session_s':session_time,
+            'events_per_s':landed/session_time,
+            'edge_to_write_ms':summarize(edge_to_write),
+            'write_to_disk_ms':summarize(write_to_disk),
+            'scripted_traversals':scripted_traversals,
+            'dropped_edges':max(0, scripted_traversals - detected_traversals),
+            'lines_written':written,
+            'lines_lost':written - landed,
+            'gpio_stats':dict(GPIO.stats),
+            'edge_dispatch':dict(components.EDGE_DISPATCHER.stats),
+            'executor':EXECUTORS.metrics()}
+
+def format_ms(value):
+    return '-' if value is None else f'{value:.2f}'
+
+def print_report(results):
+    header = f"{'combo':<6}{'boxes':>6}{'ev/s':>9}{'edge>write p50/p99/max ms':>30}{'write>disk p50/p99/max ms':>30}{'dropped':>9}{'lost':>6}{'coalesced':>11}{'bounced':>9}"
+    print(header)
+    print('-'*len(header))
+    for r in results:
+        ew = r['edge_to_write_ms']
+        wd = r['write_to_disk_ms']
+        ew_string = f"{format_ms(ew['p50'])}/{format_ms(ew['p99'])}/{format_ms(ew['max'])}"
+        wd_string = f"{format_ms(wd['p50'])}/{format_ms(wd['p99'])}/{format_ms(wd['max'])}"
+        print(f"{r['combo']:<6}{r['boxes']:>6}{r['events_per_s']:>9.1f}{ew_string:>30}{wd_string:>30}"
+              f"{r['dropped_edges']:>9}{r['lines_lost']:>6}{r['gpio_stats']['coalesced']:>11}{r['gpio_stats']['bounced']:>9}")
+    if any(lane['wait_ms']['count'] for r in results for lane in r.get('executor', [])):
+        print('\nexecutor lanes (threads runtime), worst per run')
+        for r in results:
+            run_lanes = [lane for lane in r.get('executor', []) if lane['wait_ms']['count']]
+            if run_lanes:
+                print(f"{r['combo']:<6}{r['boxes']:>6}  lanes {len(run_lanes)}, max queue depth {max(l['max_queue_depth'] for l in run_lanes)}, "
+                      f"max wait {max(l['wait_ms']['max'] for l in run_lanes):.1f} ms, starved {sum(l['starved'] for l in run_lanes)}, "
+                      f"refused {sum(l['rejected'] for l in run_lanes)}")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.single:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = run_single(args.combo[0], args.boxes[0], args.duration, args.reward_time, args.out_dir, args.seed, args.runtime)
+        with open(args.result_file, 'w') as f:
+            json.dump(result, f)
+        #state machine threads (LED flashes, reward timers) are not joinable, so don't wait on them
+        os._exit(0)
+
+    out_dir = args.out_dir if args.out_dir else tempfile.mkdtemp(prefix = 'beambreak_bench_')
+    results = []
+    for combo_type in args.combo:
+        for n_boxes in args.boxes:
+            run_dir = os.path.join(out_dir, f'{combo_type}_{n_boxes}')
+            os.makedirs(run_dir, exist_ok = True)
+            result_file = os.path.join(run_dir, 'result.json')
+            print(f'running {combo_type} beambreak combo with {n_boxes} boxes on {args.runtime}')
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--single',
+                            '--combo', combo_type, '--boxes', str(n_boxes),
+                            '--duration', str(args.duration), '--reward_time', str(args.reward_time),
+                            '--out_dir', run_dir, '--seed', str(args.seed), '--result_file', result_file,
+                            '--runtime', args.runtime],
+                           check = True)
+            with open(result_file) as f:
+                results += [json.load(f)]
+    print()
+    print_report(results)
+    print(f'\ncsvs and raw results in {out_dir}')
@@ -0,0 +1,76 @@
+'''I2C bus load of flashing LEDs: the old thread-per-flash loop writing channel.duty_cycle vs the LED scheduler.
+
+both drive a Fake_PCA9685, which counts bus transactions and bytes.
+
+    python benchmark_led_bus.py --leds 16 --duration 10
+'''
+import argparse
+import threading
+import time
+from Fake_handlers import Fake_PCA9685
+from led_scheduler import LED_Scheduler
+
+parser = argparse.ArgumentParser(description = 'LED I2C bus load benchmark')
+parser.add_argument('--leds', type = int, default = 16)
+parser.add_argument('--duration', type = float, default = 10)
+parser.add_argument('--frequencies', type = float, nargs = '+', default = [0.2, 0.5],
+                    help = 'flash periods in seconds, handed out to the LEDs in turn (exit state is 0.2, reward 0.5)')
+parser.add_argument('--tick', type = float, default = 0.02)
+
+def legacy_flash(channel, frequency, interrupt_func):
+    '''what LED.flash used to do on its own pool thread'''
+    half_freq = frequency/2
+    while not interrupt_func():
+        channel.duty_cycle = 65535
+        start = time.time()
+        while (time.time() - start) < half_freq:
+            if interrupt_func():
+                break
+            else:
+                time.sleep(0.1)
+        channel.duty_cycle = 0
+        start = time.time()
+        if not interrupt_func():
+            while (time.time() - start) < half_freq:
+                if interrupt_func():
+                    break
+                else:
+                    time.sleep(0.1)
+    channel.duty_cycle = 0
+
+def run_legacy(args):
+    pca = Fake_PCA9685()
+    stop = threading.Event()
+    threads = [threading.Thread(target = legacy_flash, args = (pca.channels[i], args.frequencies[i % len(args.frequencies)], stop.is_set))
+               for i in range(args.leds)]
+    before = time.process_time()
+    [t.start() for t in threads]
+    time.sleep(args.duration)
+    stop.set()
+    [t.join() for t in threads]
+    return pca.i2c_device, time.process_time() - before, len(threads)
+
+def run_scheduler(args):
+    pca = Fake_PCA9685()
+    scheduler = LED_Scheduler(pca, tick = args.tick)
+    stop = threading.Event()
+    before = time.process_time()
+    for i in range(args.leds):
+        scheduler.flash(i, args.frequencies[i % len(args.frequencies)], stop.is_set)
+    time.sleep(args.duration)
+    stop.set()
+    time.sleep(args.tick*3)
+    scheduler.scheduler.shut_down()
+    return pca.i2c_device, time.process_time() - before, 1
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(f'{args.leds} LEDs flashing for {args.duration} s, periods {args.frequencies}')
+    print(f"{'driver':<18}{'threads':>8}{'transactions':>14}{'per s':>9}{'bytes':>9}{'cpu s':>8}")
+    results = []
+    for name, run in [('thread per flash', run_legacy), ('LED_Scheduler', run_scheduler)]:
+        bus, cpu, threads = run(args)
+        results += [bus.transactions]
+        print(f'{name:<18}{threads:>8}{bus.transactions:>14}{bus.transactions/args.duration:>9.1f}{bus.bytes_written:>9}{cpu:>8.3f}')
+    if results[1]:
+        print(f'bus transactions reduced {results[0]/results[1]:.1f}x')
@@ -0,0 +1,164 @@
+'''throughput of a session as its boxes are spread over more worker processes (software: processes, see
+box_sharding), on the simulated GPIO.
+
+every box is a Two_Beambreak_LED_Button_Combo driven by scripted edges: a start press, a traversal and a
+button press every cycle, then exit presses after total_time. processes 1 is today's single process session
+(run_session), 2 and up go through the shared-memory rings and the aggregator. reported per run:
+    events per second that reached the csvs
+    dispatch delay (edge -> write_timestamp, from the csvs' dispatch_delay_ms) of traversal events. this is
+    where boxes wait on each other for the GIL
+    traversal edges that never made it into a csv
+    cpu seconds of the parent (the writer/aggregator when sharded) and of the workers
+
+each run is its own interpreter. on a pi use --processes 1 2 4, one worker per core.
+
+    python benchmark_sharding.py --boxes 16 64 --processes 1 2 4 --duration 20
+'''
+import argparse
+import csv
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description = 'session throughput across worker processes')
+parser.add_argument('--boxes', type = int, nargs = '+', default = [16, 64])
+parser.add_argument('--processes', type = int, nargs = '+', default = [1, 2, 4])
+parser.add_argument('--duration', type = float, default = 15, help = 'total_time of the session in seconds')
+parser.add_argument('--reward_time', type = float, default = 0.2)
+parser.add_argument('--out_dir', type = str, default = None)
+parser.add_argument('--seed', type = int, default = 0)
+parser.add_argument('--single', action = 'store_true', help = argparse.SUPPRESS)
+parser.add_argument('--result_file', type = str, default = None, help = argparse.SUPPRESS)
+
+PIN_BLOCK = 8
+HOLD = 0.1
+BUTTON_HOLD = 0.1
+GAP = 0.1
+LEAD = 2.0
+
+def box_pins(box_number):
+    base = 100 + box_number*PIN_BLOCK
+    return {'ir_1':base, 'ir_2':base+1, 'button':base+2, 'led':box_number % 16}
+
+def cycle_length(reward_time):
+    return HOLD + reward_time + 0.2 + BUTTON_HOLD + GAP
+
+def n_cycles(duration, reward_time):
+    return max(1, int((duration - 1)//cycle_length(reward_time)))
+
+def percentiles(values):
+    if not values:
+        return {'p50':None, 'p99':None, 'max':None}
+    values = sorted(values)
+    if len(values) > 1:
+        cuts = statistics.quantiles(values, n = 100, method = 'inclusive')
+        return {'p50':cuts[49], 'p99':cuts[98], 'max':values[-1]}
+    return {'p50':values[0], 'p99':values[0], 'max':values[0]}
+
+def make_scripted_box(config_dict, box_ID, timestamp_writer):
+    '''make_box for run_session that also scripts the box's behavior on the simulated GPIO'''
+    from components import GPIO, Two_Beambreak_LED_Button_Combo, IR_beambreak, Button, LED
+    software = config_dict['software']
+    hardware = config_dict['hardware'][box_ID]
+    rng = random.Random(f"{software['seed']} {box_ID}")
+    start = software['script_start'] + rng.uniform(0, 0.2)
+    reward_time = software['reward_period']
+    GPIO.script_edges(hardware['button'], [(0, 0), (BUTTON_HOLD, 1)], start = start)
+    for c in range(n_cycles(software['total_time'], reward_time)):
+        t = 0.5 + c*cycle_length(reward_time)
+        GPIO.script_edges(hardware['ir_1' if c % 2 == 0 else 'ir_2'], [(t, 0), (t + HOLD, 1)], start = start)
+        press = t + HOLD + reward_time + 0.2
+        GPIO.script_edges(hardware['button'], [(press, 0), (press + BUTTON_HOLD, 1)], start = start)
+    #exit presses. a box that was mid reward at total_time needs one to leave it first
+    for k in range(4):
+        press = software['total_time'] + 0.6*(k + 1)
+        GPIO.script_edges(hardware['button'], [(press, 0), (press + BUTTON_HOLD, 1)], start = start)
+    return Two_Beambreak_LED_Button_Combo(IR_beambreak(hardware['ir_1']), IR_beambreak(hardware['ir_2']), LED(hardware['led']),
+                                          Button(hardware['button']), box_ID, notes_1 = 'novel', notes_2 = 'partner',
+                                          timestamp_writer = timestamp_writer)
+
+def run_single(n_boxes, n_processes, duration, reward_time, out_dir, seed):
+    from session_orchestrator import run_session
+    config_dict = {'hardware':{f'box_{b}':box_pins(b) for b in range(n_boxes)},
+                   'animals':{f'box_{b}':{'focal':f'animal_{b}', 'novel':f'novel_{b}'} for b in range(n_boxes)},
+                   'software':{'reward_period':reward_time, 'total_time':duration, 'save_path':out_dir,
+                               'processes':n_processes, 'seed':seed, 'script_start':time.perf_counter() + LEAD}}
+    start = time.perf_counter()
+    run_session(config_dict, make_scripted_box)
+    session_time = time.perf_counter() - start
+    parent = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    lines = 0
+    traversals = 0
+    delays = []
+    for fname in os.listdir(out_dir):
+        if not fname.startswith('animal_'):
+            continue
+        with open(os.path.join(out_dir, fname)) as f:
+            for row in csv.DictReader(f):
+                lines += 1
+                if row['event'].endswith('traversal'):
+                    traversals += 1
+                    delays += [float(row['dispatch_delay_ms'])]
+    scripted = n_boxes*n_cycles(duration, reward_time)
+    return {'boxes':n_boxes,
+            'processes':n_processes,
+            'session_s':session_time,
+            'events_per_s':lines/session_time,
+            'dispatch_delay_ms':percentiles(delays),
+            'scripted_traversals':scripted,
+            'dropped':max(0, scripted - traversals),
+            'parent_cpu_s':parent.ru_utime + parent.ru_stime,
+            'worker_cpu_s':children.ru_utime + children.ru_stime}
+
+def format_ms(value):
+    return '-' if value is None else f'{value:.2f}'
+
+def print_report(results):
+    print(f"{'boxes':>5}{'procs':>6}{'ev/s':>9}{'dispatch p50/p99/max ms':>26}{'dropped':>9}{'parent cpu s':>14}{'worker cpu s':>14}")
+    print('-'*83)
+    for r in results:
+        delay = r['dispatch_delay_ms']
+        delay_string = f"{format_ms(delay['p50'])}/{format_ms(delay['p99'])}/{format_ms(delay['max'])}"
+        print(f"{r['boxes']:>5}{r['processes']:>6}{r['events_per_s']:>9.1f}{delay_string:>26}{r['dropped']:>9}"
+              f"{r['parent_cpu_s']:>14.2f}{r['worker_cpu_s']:>14.2f}")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.single:
+        with open(os.devnull, 'w') as devnull:
+            stdout = os.dup(1)
+            os.dup2(devnull.fileno(), 1)
+            result = run_single(args.boxes[0], args.processes[0], args.duration, args.reward_time, args.out_dir, args.seed)
+            os.dup2(stdout, 1)
+        with open(args.result_file, 'w') as f:
+            json.dump(result, f)
+        os._exit(0)
+
+    print(f'{os.cpu_count()} cpus')
+    out_dir = args.out_dir if args.out_dir else tempfile.mkdtemp(prefix = 'beambreak_sharding_')
+    environment = dict(os.environ, BEAMBREAK_BACKEND = 'simulated', BEAMBREAK_SERVO_BACKEND = 'simulated')
+    results = []
+    for n_boxes in args.boxes:
+        for n_processes in args.processes:
+            run_dir = os.path.join(out_dir, f'{n_boxes}_boxes_{n_processes}_processes')
+            os.makedirs(run_dir, exist_ok = True)
+            result_file = os.path.join(run_dir, 'result.json')
+            print(f'running {n_boxes} boxes on {n_processes} processes')
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--single', '--boxes', str(n_boxes),
+                            '--processes', str(n_processes), '--duration', str(args.duration),
+                            '--reward_time', str(args.reward_time), '--out_dir', run_dir, '--seed', str(args.seed),
+                            '--result_file', result_file],
+                           check = True, env = environment)
+            with open(result_file) as f:
+                results += [json.load(f)]
+    print()
+    print_report(results)
+    print(f'\ncsvs and raw results in {out_dir}')
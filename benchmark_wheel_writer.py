@@ -0,0 +1,83 @@
+'''compare the wheel recorder's old open/write/close per row with Buffered_Row_Writer.
+
+writes a session's worth of rows (45 min at 10 Hz by default) as fast as possible and reports cpu time, write and
+open syscalls and bytes the kernel sent to the device, read from /proc/self/io (linux only).
+
+    python benchmark_wheel_writer.py --rows 27000 --animals 4
+'''
+import argparse
+import csv
+import os
+import tempfile
+import time
+from recording_classes import Buffered_Row_Writer
+
+parser = argparse.ArgumentParser(description = 'wheel recorder row writer benchmark')
+parser.add_argument('--rows', type = int, default = 45*60*10, help = 'rows to write, default is 45 min at 10 Hz')
+parser.add_argument('--animals', type = int, default = 4)
+parser.add_argument('--flush_interval', type = float, default = 5)
+parser.add_argument('--flush_rows', type = int, default = 100)
+parser.add_argument('--fsync', action = 'store_true', help = 'fsync on every buffered flush')
+
+def legacy_write_row(filepath, row):
+    '''what wheel_recorder.write_row used to do for every row'''
+    with open(filepath, 'a+') as f:
+        writer = csv.writer(f)
+        writer.writerow(row)
+
+def read_proc_io():
+    try:
+        with open('/proc/self/io') as f:
+            return {key:int(value) for key, value in (line.split(': ') for line in f)}
+    except OSError:
+        return None
+
+def make_rows(n_rows, n_animals):
+    return [[round(i*0.1, 4)] + [i*3 + a for a in range(n_animals)] for i in range(n_rows)]
+
+def measure(name, write_all):
+    before_io = read_proc_io()
+    before_cpu = time.process_time()
+    before_wall = time.perf_counter()
+    opens = write_all()
+    result = {'name':name,
+              'cpu_s':time.process_time() - before_cpu,
+              'wall_s':time.perf_counter() - before_wall,
+              'opens':opens}
+    after_io = read_proc_io()
+    if before_io and after_io:
+        result['write_syscalls'] = after_io['syscw'] - before_io['syscw']
+        result['device_bytes'] = after_io['write_bytes'] - before_io['write_bytes']
+    return result
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    out_dir = tempfile.mkdtemp(prefix = 'wheel_writer_bench_')
+    rows = make_rows(args.rows, args.animals)
+
+    legacy_path = os.path.join(out_dir, 'legacy.csv')
+    def write_legacy():
+        for row in rows:
+            legacy_write_row(legacy_path, row)
+        return len(rows)
+
+    buffered_path = os.path.join(out_dir, 'buffered.csv')
+    def write_buffered():
+        writer = Buffered_Row_Writer(buffered_path, flush_interval = args.flush_interval,
+                                     flush_rows = args.flush_rows, fsync = args.fsync)
+        for row in rows:
+            writer.writerow(row)
+        writer.close()
+        return 1
+
+    results = [measure('open/close per row', write_legacy), measure('Buffered_Row_Writer', write_buffered)]
+
+    with open(legacy_path) as legacy, open(buffered_path) as buffered:
+        identical = legacy.read() == buffered.read()
+
+    print(f'{args.rows} rows x {args.animals} animals, files in {out_dir}')
+    print(f"{'writer':<22}{'cpu s':>9}{'wall s':>9}{'opens':>8}{'write syscalls':>16}{'device bytes':>14}")
+    for r in results:
+        print(f"{r['name']:<22}{r['cpu_s']:>9.3f}{r['wall_s']:>9.3f}{r['opens']:>8}"
+              f"{r.get('write_syscalls', 'n/a'):>16}{r.get('device_bytes', 'n/a'):>14}")
+    print(f'files identical: {identical}')
@@ -0,0 +1,218 @@
+'''compact fixed-width binary event log, written by TimestampManager(log_format = 'binary').
+
+a log is two files:
+    <name>.bbev          16 byte header, then one 40 byte record per event
+    <name>.bbev.strings  json sidecar: csv header + the table every string field (box, beam, event, notes) indexes into
+
+records are plain little-endian structs, so the pi only pays for a struct.pack per event. timestamp_ns is the
+session CLOCK time of the event's GPIO edge, and the sidecar keeps the clock's wall anchor so wall time can be rebuilt.
+the reader memory-maps the file and hands out columns as numpy views without copying, and can convert back to
+today's csv or to parquet.
+
+    python binary_event_log.py session.bbev --csv session.csv --parquet session.parquet
+'''
+import argparse
+import json
+import math
+import os
+import struct
+import threading
+#numpy is only needed to read logs, so it's imported then rather than on every pi that writes them
+np = None
+
+def load_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise Exception('reading binary event logs needs numpy')
+        np = numpy
+    return np
+
+MAGIC = b'BBEVLOG\x00'
+VERSION = 2
+#version 1 had the same layout with dispatch_delay_ns unused
+READABLE_VERSIONS = (1, 2)
+HEADER = struct.Struct('<8sHHI')
+RECORD = struct.Struct('<HHHHiIqdd')
+RECORD_FIELDS = ['box', 'beam', 'event', 'notes', 'count', 'dispatch_delay_ns', 'timestamp_ns', 'elapsed_time', 'latency']
+STRING_FIELDS = ('box', 'beam', 'event', 'notes')
+CSV_HEADER = ['ID', 'beam', 'elapsed_time', 'event', 'count', 'latency', 'notes']
+CLOCK_COLUMNS = ['edge_ns', 'wall_time', 'dispatch_delay_ms']
+EMPTY_COUNT = -1
+MAX_DELAY_NS = 0xFFFFFFFF
+
+def record_dtype():
+    return np.dtype({'names':RECORD_FIELDS,
+                     'formats':['<u2', '<u2', '<u2', '<u2', '<i4', '<u4', '<i8', '<f8', '<f8'],
+                     'itemsize':RECORD.size})
+
+def strings_path(path):
+    return path + '.strings'
+
+
+class String_Table:
+    '''maps strings to the small integer ids stored in records. new strings are rare (box names, event names,
+    notes), and each one rewrites the sidecar atomically before any record that uses it can be written'''
+    def __init__(self, path, header = None, clock = None):
+        self.path = strings_path(path)
+        self.header = header if header else CSV_HEADER
+        self.clock = clock
+        self.strings = ['']
+        self.ids = {'':0}
+        self._lock = threading.Lock()
+
+    def id_for(self, value):
+        string = str(value)
+        string_id = self.ids.get(string)
+        if string_id is not None:
+            return string_id
+        with self._lock:
+            if string not in self.ids:
+                if len(self.strings) > 0xFFFF:
+                    raise Exception(f'binary event log string table is full, could not add {string}')
+                self.ids[string] = len(self.strings)
+                self.strings.append(string)
+                self.save()
+            return self.ids[string]
+
+    def load(self):
+        '''carry on with the strings already in the sidecar, eg when appending to an existing log'''
+        with open(self.path) as f:
+            sidecar = json.load(f)
+        self.header = sidecar['header']
+        self.strings = sidecar['strings']
+        self.ids = {string:string_id for string_id, string in enumerate(self.strings)}
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            sidecar = {'version':VERSION, 'header':self.header, 'strings':self.strings}
+            if self.clock is not None:
+                sidecar['clock'] = {'wall_anchor':self.clock.wall_anchor, 'mono_anchor_ns':self.clock.mono_anchor_ns}
+            json.dump(sidecar, f)
+        os.replace(tmp, self.path)
+
+
+class Binary_Event_Encoder:
+    '''turns the (ID, beam, elapsed_time, event, count, latency, notes) tuples the combos write into records'''
+    def __init__(self, path, header = None, clock = None):
+        self.table = String_Table(path, header, clock)
+
+    def file_header(self):
+        return HEADER.pack(MAGIC, VERSION, RECORD.size, 0)
+
+    def encode(self, line, timestamp_ns, dispatch_delay_ns = 0):
+        ID, beam, elapsed_time, event, count, latency, notes = line
+        table = self.table
+        return RECORD.pack(table.id_for(ID), table.id_for(beam), table.id_for(event), table.id_for(notes),
+                           EMPTY_COUNT if count == '' else int(count), min(dispatch_delay_ns, MAX_DELAY_NS), timestamp_ns,
+                           float(elapsed_time), math.nan if latency == '' else float(latency))
+
+
+class Binary_Event_Log:
+    '''memory-mapped reader. log['elapsed_time'] etc. are views into the file, not copies'''
+    def __init__(self, path):
+        load_numpy()
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, record_size, _ = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise Exception(f'{path} is not a binary event log')
+        if version not in READABLE_VERSIONS or record_size != RECORD.size:
+            raise Exception(f'{path} is version {version} with {record_size} byte records, this reader handles versions {READABLE_VERSIONS}')
+        with open(strings_path(path)) as f:
+            sidecar = json.load(f)
+        self.header = sidecar['header']
+        self.clock = sidecar.get('clock')
+        self.strings = np.array(sidecar['strings'], dtype = object)
+
+        #a crash can leave a partial record at the end; ignore it
+        n_records = (os.path.getsize(path) - HEADER.size)//RECORD.size
+        if n_records:
+            self.records = np.memmap(path, dtype = record_dtype(), mode = 'r', offset = HEADER.size, shape = (n_records,))
+        else:
+            self.records = np.zeros(0, dtype = record_dtype())
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, field):
+        return self.records[field]
+
+    @property
+    def columns(self):
+        return {field:self.records[field] for field in RECORD_FIELDS}
+
+    def wall_time(self):
+        '''wall clock seconds of each event, from the session clock anchor'''
+        if self.clock is None:
+            raise Exception(f'{self.path} was written without a clock anchor')
+        return self.clock['wall_anchor'] + (self.records['timestamp_ns'] - self.clock['mono_anchor_ns'])/1e9
+
+    def decoded(self, field):
+        '''string field as an object array of strings (this one is a copy)'''
+        return self.strings[self.records[field]]
+
+    def csv_rows(self):
+        '''rows laid out and formatted exactly as TimestampManager writes its csv'''
+        box, beam, event, notes = (self.decoded(field) for field in STRING_FIELDS)
+        counts = self.records['count'].tolist()
+        elapsed = self.records['elapsed_time'].tolist()
+        latency = self.records['latency'].tolist()
+        with_clocks = self.header[len(CSV_HEADER):] == CLOCK_COLUMNS
+        if with_clocks:
+            timestamps = self.records['timestamp_ns'].tolist()
+            delays = self.records['dispatch_delay_ns'].tolist()
+            wall_anchor, mono_anchor_ns = self.clock['wall_anchor'], self.clock['mono_anchor_ns']
+        for i in range(len(self.records)):
+            row = [box[i], beam[i], str(elapsed[i]), event[i],
+                   '' if counts[i] == EMPTY_COUNT else str(counts[i]),
+                   '' if math.isnan(latency[i]) else str(latency[i]),
+                   notes[i]]
+            if with_clocks:
+                #same arithmetic as TimestampManager, so the strings match
+                row += [str(timestamps[i]), str(wall_anchor + (timestamps[i] - mono_anchor_ns)/1e9), str(delays[i]/1e6)]
+            yield row
+
+    def to_csv(self, out_path, delimeter = ','):
+        with open(out_path, 'w') as f:
+            f.write(delimeter.join(self.header)+'\n')
+            for row in self.csv_rows():
+                f.write(delimeter.join(row)+'\n')
+
+    def to_dataframe(self, start = None, stop = None):
+        '''records[start:stop] as a dataframe, string fields as categoricals'''
+        import pandas as pd
+        records = self.records[start:stop]
+        decoded = {field:self.strings[records[field]] for field in STRING_FIELDS}
+        df = pd.DataFrame({'ID':pd.Categorical(decoded['box']),
+                           'beam':pd.Categorical(decoded['beam']),
+                           'elapsed_time':np.asarray(records['elapsed_time']),
+                           'event':pd.Categorical(decoded['event']),
+                           'count':pd.array(np.where(records['count'] == EMPTY_COUNT, 0, records['count']), dtype = 'Int32'),
+                           'latency':np.asarray(records['latency']),
+                           'notes':pd.Categorical(decoded['notes']),
+                           'timestamp_ns':np.asarray(records['timestamp_ns']),
+                           'dispatch_delay_ns':np.asarray(records['dispatch_delay_ns'])})
+        df.loc[np.asarray(records['count'] == EMPTY_COUNT), 'count'] = pd.NA
+        return df
+
+    def to_parquet(self, out_path):
+        '''needs pandas plus pyarrow (or fastparquet)'''
+        self.to_dataframe().to_parquet(out_path, index = False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'convert a binary event log')
+    parser.add_argument('log', type = str)
+    parser.add_argument('--csv', type = str, default = None)
+    parser.add_argument('--parquet', type = str, default = None)
+    args = parser.parse_args()
+    log = Binary_Event_Log(args.log)
+    print(f'{args.log}: {len(log)} events')
+    if args.csv:
+        log.to_csv(args.csv)
+    if args.parquet:
+        log.to_parquet(args.parquet)
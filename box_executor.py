@@ -0,0 +1,186 @@
+'''per-box executor lanes for thread_it.
+
+every box gets its own small pool of worker threads and a bounded queue, so a box that floods or blocks its lane
+only delays itself. a full lane refuses new work straight away (the future holds a Lane_Full exception) rather
+than queueing without limit. each lane keeps queue depth, wait time (queued -> started) and run time, and prints
+a warning when work waited longer than starvation_ms. EXECUTORS.report() gives a table to size lanes with, and the
+same timings go to instrumentation's histograms while the session runs.
+
+workers should stay at 2 or more: beam_broken_state holds a worker for the whole reward period while
+reward_cancel_state needs one to end it.
+'''
+import queue
+import threading
+import time
+import traceback
+from running_stats import Running_Stats
+from instrumentation import METRICS, DEPTH_BOUNDS
+
+
+class Lane_Full(Exception):
+    pass
+
+
+class Executor_Lane:
+
+    def __init__(self, name, workers = 3, max_queue = 16, starvation_ms = 100, warning_interval = 5):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.starvation_ms = starvation_ms
+        self.warning_interval = warning_interval
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._idle = 0
+        self._last_warning = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.starved = 0
+        self.max_queue_depth = 0
+        self.wait_ms = Running_Stats()
+        self.run_ms = Running_Stats()
+        self.depth_histogram = METRICS.histogram('beambreak_executor_queue_depth', DEPTH_BOUNDS, lane = name)
+        self.wait_histogram = METRICS.histogram('beambreak_executor_wait_seconds', lane = name)
+        self.run_histogram = METRICS.histogram('beambreak_executor_run_seconds', lane = name)
+        METRICS.add_gauge('beambreak_executor_queued', self.queue_depth, lane = name)
+
+    def submit(self, func, *args, **kwargs):
+        from concurrent.futures import Future
+        future = Future()
+        try:
+            self._queue.put_nowait((func, args, kwargs, future, time.perf_counter_ns()))
+        except queue.Full:
+            self.rejected += 1
+            print(f'executor lane {self.name} is full ({self.max_queue} queued), refusing {getattr(func, "__name__", func)}')
+            future.set_exception(Lane_Full(f'executor lane {self.name} is full'))
+            return future
+        with self._lock:
+            self.submitted += 1
+            depth = self._queue.qsize()
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+            self.depth_histogram.add(depth)
+            if self._idle == 0 and len(self._threads) < self.workers:
+                thread = threading.Thread(target = self._work, daemon = True, name = f'{self.name}_{len(self._threads)}')
+                self._threads.append(thread)
+                thread.start()
+        return future
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+            item = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+            if item is None:
+                return
+            func, args, kwargs, future, queued_ns = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            start_ns = time.perf_counter_ns()
+            wait_ms = (start_ns - queued_ns)/1e6
+            self.wait_ms.add(wait_ms)
+            self.wait_histogram.add(wait_ms/1e3)
+            if wait_ms > self.starvation_ms:
+                self._starving(func, wait_ms)
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                self.failed += 1
+                traceback.print_exc()
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            run_ns = time.perf_counter_ns() - start_ns
+            self.run_ms.add(run_ns/1e6)
+            self.run_histogram.add(run_ns/1e9)
+            self.completed += 1
+
+    def _starving(self, func, wait_ms):
+        self.starved += 1
+        now = time.perf_counter()
+        if now - self._last_warning > self.warning_interval:
+            self._last_warning = now
+            print(f'executor lane {self.name}: {getattr(func, "__name__", func)} waited {wait_ms:.0f} ms to start '
+                  f'({self._queue.qsize()} queued, {len(self._threads)}/{self.workers} workers). {self.starved} starved so far')
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def metrics(self):
+        return {'lane':self.name,
+                'workers':len(self._threads),
+                'busy':len(self._threads) - self._idle,
+                'queue_depth':self._queue.qsize(),
+                'max_queue_depth':self.max_queue_depth,
+                'submitted':self.submitted,
+                'completed':self.completed,
+                'failed':self.failed,
+                'rejected':self.rejected,
+                'starved':self.starved,
+                'wait_ms':self.wait_ms.summary(),
+                'run_ms':self.run_ms.summary()}
+
+    def shut_down(self, wait = False):
+        '''workers finish what is queued, then exit'''
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class Executor_Registry:
+    '''makes a lane per name on first use. configure() changes the settings of lanes made after it'''
+
+    def __init__(self, **lane_settings):
+        self.lane_settings = lane_settings
+        self.lanes = {}
+        self._lock = threading.Lock()
+
+    def configure(self, **lane_settings):
+        self.lane_settings.update(lane_settings)
+
+    def lane(self, name):
+        lane = self.lanes.get(name)
+        if lane is None:
+            with self._lock:
+                lane = self.lanes.get(name)
+                if lane is None:
+                    lane = self.lanes[name] = Executor_Lane(name, **self.lane_settings)
+        return lane
+
+    def lane_for(self, obj):
+        '''the lane for obj's box (obj.ID), cached on obj. objects without an ID yet share one lane'''
+        lane = obj.__dict__.get('executor_lane')
+        if lane is not None:
+            return lane
+        box_ID = getattr(obj, 'ID', None)
+        if box_ID is None:
+            return self.lane('shared')
+        lane = obj.executor_lane = self.lane(f'box {box_ID}')
+        return lane
+
+    def metrics(self):
+        return [lane.metrics() for lane in list(self.lanes.values())]
+
+    def report(self):
+        lines = [f"{'lane':<16}{'workers':>8}{'queued':>7}{'max q':>6}{'done':>7}{'failed':>7}{'refused':>8}{'starved':>8}"
+                 f"{'wait mean/max ms':>18}{'run mean/max ms':>18}"]
+        for m in self.metrics():
+            wait, run = m['wait_ms'], m['run_ms']
+            wait_string = f"{wait['mean']:.1f}/{wait['max']:.1f}" if wait['count'] else '-'
+            run_string = f"{run['mean']:.1f}/{run['max']:.1f}" if run['count'] else '-'
+            lines += [f"{str(m['lane']):<16}{m['workers']:>8}{m['queue_depth']:>7}{m['max_queue_depth']:>6}{m['completed']:>7}"
+                      f"{m['failed']:>7}{m['rejected']:>8}{m['starved']:>8}{wait_string:>18}{run_string:>18}"]
+        return '\n'.join(lines)
+
+    def shut_down(self, wait = False):
+        for lane in list(self.lanes.values()):
+            lane.shut_down(wait)
+
+
+EXECUTORS = Executor_Registry()
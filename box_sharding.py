@@ -0,0 +1,470 @@
+'''runs groups of boxes in worker processes, one per cpu core, so their state logic and formatting don't all
+share one GIL. turned on with software: processes: n in the run yaml.
+
+each worker runs its boxes exactly as run_session would, but its timestamp writers publish fixed-size records
+into a shared-memory ring (one ring per worker, so each has a single producer and needs no cross-process lock
+on the write path). the parent process is the single writer: it drains every ring, rebuilds each line and
+writes it through an ordinary TimestampManager, so the per-animal files (csv or binary) and the summary are
+the same as a single process session's.
+
+records are SLOT bytes. strings (box names, beams, events, notes, file paths) are sent once per worker as
+STRING records ahead of the first event that uses them, and events carry their ids.
+
+on the pi, each worker opens the GPIO pins of its own boxes. the LED HAT is shared, every worker writes its own
+boxes' channels.
+'''
+import atexit
+import math
+import os
+import struct
+import threading
+import time
+import traceback
+from session_clock import CLOCK
+from running_stats import Running_Stats
+
+SLOT = 48
+EVENT = 1
+STRING = 2
+OPEN = 3
+CLOSE = 4
+DONE = 5
+STATE_CHANGE = 1
+EMPTY_COUNT = -1
+MAX_DELAY_NS = 0xFFFFFFFF
+#kind, flags, file, box, beam, event, notes, count, dispatch delay, edge ns, elapsed, latency
+EVENT_RECORD = struct.Struct('<BBHHHHHiIqdd')
+#kind, more chunks follow, id, chunk length, then the chunk
+STRING_RECORD = struct.Struct('<BBHH')
+STRING_CHUNK = SLOT - STRING_RECORD.size
+#kind, binary, file, path string, header string
+FILE_RECORD = struct.Struct('<BBHHH')
+KIND = struct.Struct('<B')
+INDEX = struct.Struct('<Q')
+HEADER_SEPARATOR = '\x1f'
+#write index and read index on their own cache lines
+WRITE_AT = 0
+READ_AT = 64
+DATA_AT = 128
+
+
+class Shared_Event_Ring:
+    '''single producer, single consumer ring of SLOT byte records in shared memory. made in the parent before the
+    workers fork, so both ends inherit it. the indexes are only read and written under a lock, which is also the
+    memory barrier that makes a record visible before the index that publishes it'''
+
+    def __init__(self, context, doorbell, slots = 8192):
+        from multiprocessing import shared_memory
+        self.slots = slots
+        self.memory = shared_memory.SharedMemory(create = True, size = DATA_AT + slots*SLOT)
+        self.buffer = self.memory.buf
+        INDEX.pack_into(self.buffer, WRITE_AT, 0)
+        INDEX.pack_into(self.buffer, READ_AT, 0)
+        self.doorbell = doorbell
+        self._lock = context.Lock()
+        #each end keeps its own index, the other end's is read from shared memory
+        self._write = 0
+        self._read = 0
+        self._read_seen = 0
+        self.full_waits = 0
+        self.unlinked = False
+
+    def publish(self, record):
+        '''producer side. waits (rather than dropping) if the consumer is a whole ring behind'''
+        while self._write - self._read_seen >= self.slots:
+            with self._lock:
+                self._read_seen = INDEX.unpack_from(self.buffer, READ_AT)[0]
+            if self._write - self._read_seen >= self.slots:
+                self.full_waits += 1
+                time.sleep(0.0005)
+        start = DATA_AT + (self._write % self.slots)*SLOT
+        self.buffer[start:start + len(record)] = record
+        self._write += 1
+        with self._lock:
+            INDEX.pack_into(self.buffer, WRITE_AT, self._write)
+        self.doorbell.set()
+
+    def drain(self, max_records = 1024):
+        '''consumer side. copies of up to max_records records, oldest first'''
+        with self._lock:
+            write = INDEX.unpack_from(self.buffer, WRITE_AT)[0]
+        n = min(write - self._read, max_records)
+        records = []
+        for i in range(self._read, self._read + n):
+            start = DATA_AT + (i % self.slots)*SLOT
+            records.append(bytes(self.buffer[start:start + SLOT]))
+        if n:
+            self._read += n
+            with self._lock:
+                INDEX.pack_into(self.buffer, READ_AT, self._read)
+        return records
+
+    def depth(self):
+        with self._lock:
+            return INDEX.unpack_from(self.buffer, WRITE_AT)[0] - INDEX.unpack_from(self.buffer, READ_AT)[0]
+
+    def unlink(self):
+        '''take the segment out of /dev/shm. mappings stay valid until they are closed'''
+        if not self.unlinked:
+            self.unlinked = True
+            self.memory.unlink()
+
+    def close(self, unlink = False):
+        self.buffer = None
+        self.memory.close()
+        if unlink:
+            self.unlink()
+
+
+class Ring_Publisher:
+    '''the worker end: one per worker process, shared by every Ring_TimestampManager in it'''
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.ids = {'':0}
+        self.n_files = 0
+        self._lock = threading.Lock()
+
+    def string_id(self, value):
+        '''call with the lock held. new strings go out ahead of the record that uses them'''
+        string = str(value)
+        string_id = self.ids.get(string)
+        if string_id is not None:
+            return string_id
+        if len(self.ids) > 0xFFFF:
+            raise Exception(f'shard string table is full, could not add {string}')
+        string_id = self.ids[string] = len(self.ids)
+        data = string.encode()
+        chunks = [data[i:i + STRING_CHUNK] for i in range(0, len(data), STRING_CHUNK)] or [b'']
+        for i, chunk in enumerate(chunks):
+            self.ring.publish(STRING_RECORD.pack(STRING, i < len(chunks) - 1, string_id, len(chunk)) + chunk)
+        return string_id
+
+    def open_file(self, fp, header, log_format):
+        with self._lock:
+            file_id = self.n_files
+            self.n_files += 1
+            self.ring.publish(FILE_RECORD.pack(OPEN, log_format == 'binary', file_id, self.string_id(fp),
+                                               self.string_id(HEADER_SEPARATOR.join(str(bit) for bit in header))))
+        return file_id
+
+    def close_file(self, file_id):
+        with self._lock:
+            self.ring.publish(FILE_RECORD.pack(CLOSE, 0, file_id, 0, 0))
+
+    def event(self, file_id, line, edge_ns, dispatch_delay_ns, state_change):
+        ID, beam, elapsed_time, event, count, latency, notes = line
+        with self._lock:
+            record = EVENT_RECORD.pack(EVENT, STATE_CHANGE if state_change else 0, file_id, self.string_id(ID),
+                                       self.string_id(beam), self.string_id(event), self.string_id(notes),
+                                       EMPTY_COUNT if count == '' else int(count), min(dispatch_delay_ns, MAX_DELAY_NS),
+                                       edge_ns, float(elapsed_time), math.nan if latency == '' else float(latency))
+            self.ring.publish(record)
+
+    def done(self):
+        with self._lock:
+            self.ring.publish(KIND.pack(DONE))
+
+
+class Ring_TimestampManager:
+    '''stands in for TimestampManager inside a worker. same calls, but lines go to the parent through the ring'''
+
+    def __init__(self, publisher, path, fname, log_format = 'csv'):
+        self.publisher = publisher
+        self.fp = os.path.join(path, fname)
+        self.log_format = log_format
+        self.file_id = None
+
+    def create_file(self, header):
+        self.file_id = self.publisher.open_file(self.fp, header, self.log_format)
+
+    def shut_down(self):
+        '''the parent flushes and closes the file once it gets here. doesn't wait for that'''
+        self.publisher.close_file(self.file_id)
+
+    def write_timestamp(self, line, state_change = False, edge_ns = None):
+        now = CLOCK.now_ns()
+        if edge_ns is None:
+            edge_ns = now
+        self.publisher.event(self.file_id, line, edge_ns, max(0, now - edge_ns), state_change)
+
+
+class Ring_Reader:
+    '''the parent's view of one worker: its strings and files so far'''
+    def __init__(self, ring):
+        self.ring = ring
+        self.strings = ['']
+        self.partial = b''
+        self.files = {}
+        self.done = False
+
+
+class Event_Aggregator:
+    '''the parent end: one thread that drains every ring and writes through TimestampManagers on a shared writer.
+    every TimestampManager it opens is passed to each of attach (eg Live_Summary.attach), to listen to its lines'''
+
+    def __init__(self, rings, doorbell, writer, poll_interval = 0.05, attach = ()):
+        self.readers = [Ring_Reader(ring) for ring in rings]
+        self.doorbell = doorbell
+        self.writer = writer
+        self.attach = list(attach)
+        self.poll_interval = poll_interval
+        self.thread = None
+        self._stopping = False
+        self.events = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.edge_to_aggregate_ms = Running_Stats()
+
+    def start(self):
+        self.thread = threading.Thread(target = self._run, daemon = True, name = 'event_aggregator')
+        self.thread.start()
+
+    def stop(self):
+        '''drain whatever is left and stop, whether or not every worker sent DONE'''
+        self._stopping = True
+        self.doorbell.set()
+        self.thread.join()
+
+    def wait(self, timeout = None):
+        '''until every worker has sent DONE and it has all been written'''
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def _run(self):
+        while True:
+            self.doorbell.wait(self.poll_interval)
+            self.doorbell.clear()
+            drained = self.drain()
+            if not drained and (self._stopping or all(reader.done for reader in self.readers)):
+                return
+
+    def drain(self):
+        drained = 0
+        for reader in self.readers:
+            records = reader.ring.drain()
+            if not records:
+                continue
+            self.batches += 1
+            self.max_depth = max(self.max_depth, len(records))
+            drained += len(records)
+            for record in records:
+                try:
+                    self.handle(reader, record)
+                except Exception:
+                    traceback.print_exc()
+        return drained
+
+    def handle(self, reader, record):
+        from recording_classes import TimestampManager
+        kind = record[0]
+        if kind == EVENT:
+            (_, flags, file_id, box, beam, event, notes, count, delay_ns, edge_ns,
+             elapsed_time, latency) = EVENT_RECORD.unpack(record[:EVENT_RECORD.size])
+            strings = reader.strings
+            line = (strings[box], strings[beam], elapsed_time, strings[event], '' if count == EMPTY_COUNT else count,
+                    '' if math.isnan(latency) else latency, strings[notes])
+            reader.files[file_id].write_record(line, edge_ns, delay_ns, state_change = bool(flags & STATE_CHANGE))
+            self.events += 1
+            self.edge_to_aggregate_ms.add((CLOCK.now_ns() - edge_ns)/1e6)
+        elif kind == STRING:
+            _, more, _, length = STRING_RECORD.unpack(record[:STRING_RECORD.size])
+            reader.partial += record[STRING_RECORD.size:STRING_RECORD.size + length]
+            if not more:
+                reader.strings.append(reader.partial.decode())
+                reader.partial = b''
+        elif kind == OPEN:
+            _, binary, file_id, path, header = FILE_RECORD.unpack(record[:FILE_RECORD.size])
+            fp = reader.strings[path]
+            manager = TimestampManager(os.path.dirname(fp), os.path.basename(fp), writer = self.writer,
+                                       log_format = 'binary' if binary else 'csv')
+            manager.create_file(reader.strings[header].split(HEADER_SEPARATOR))
+            for attach in self.attach:
+                attach(manager)
+            reader.files[file_id] = manager
+        elif kind == CLOSE:
+            _, _, file_id, _, _ = FILE_RECORD.unpack(record[:FILE_RECORD.size])
+            reader.files[file_id].shut_down()
+        elif kind == DONE:
+            reader.done = True
+
+    def report(self):
+        delay = self.edge_to_aggregate_ms
+        return (f'aggregator: {self.events} events from {len(self.readers)} workers in {self.batches} batches, '
+                f'largest batch {self.max_depth}, edge -> aggregated mean {delay.mean:.1f} ms max {delay.max:.1f} ms, '
+                f'producer waits on a full ring: {[reader.ring.full_waits for reader in self.readers]}')
+
+
+class Box_Result:
+    '''what the parent gets back of a box that ran in a worker, enough for the summary'''
+    def __init__(self, traversal_counts, notes):
+        self.traversal_counts = traversal_counts
+        for k, note in notes.items():
+            setattr(self, f'notes_{k}', note)
+
+
+def shard_boxes(box_IDs, n_shards):
+    '''consecutive, even-as-possible groups'''
+    box_IDs = list(box_IDs)
+    size, extra = divmod(len(box_IDs), n_shards)
+    shards = []
+    start = 0
+    for k in range(n_shards):
+        end = start + size + (k < extra)
+        shards += [box_IDs[start:end]]
+        start = end
+    return shards
+
+def worker_cores():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return [None]
+
+def run_shard(index, config_dict, box_IDs, make_box, spec, ring, core, results, date):
+    '''worker process: run box_IDs like run_session, publishing every line to ring'''
+    from session_orchestrator import Session_Orchestrator, configure_runtime, compile_machine, make_boxes, log_filename, start_metrics
+    from components import GPIO
+    from box_executor import EXECUTORS
+    from instrumentation import METRICS
+    try:
+        if core is not None:
+            os.sched_setaffinity(0, {core})
+        software = config_dict['software']
+        configure_runtime(software)
+        #the confirm, edge and lane histograms are in this process, so each worker keeps its own stats file
+        metrics = start_metrics(config_dict, date, name = f'metrics_shard_{index}', serve = False)
+        publisher = Ring_Publisher(ring)
+        log_format = software.get('log_format', 'csv')
+        boxes = make_boxes(config_dict, box_IDs, make_box, compile_machine(software, spec),
+                           lambda box_ID: Ring_TimestampManager(publisher, software['save_path'],
+                                                                log_filename(config_dict, box_ID, date), log_format))
+        orchestrator = Session_Orchestrator([box.ir_pair for box in boxes], software['total_time'])
+        for box in boxes:
+            box.ir_pair.entry_state(reward_time = software['reward_period'])
+        orchestrator.run()
+        GPIO.cleanup()
+        publisher.done()
+        if metrics:
+            metrics.stop()
+        summary = {}
+        for box in boxes:
+            ir = box.ir_pair
+            summary[box.name] = (dict(ir.traversal_counts), {k:getattr(ir, f'notes_{k}', '') for k in ir.traversal_counts})
+        report = f'worker {index} (core {core})\n{EXECUTORS.report()}' + (f'\n{METRICS.report()}' if metrics else '')
+        results.put((index, summary, report))
+    except BaseException:
+        traceback.print_exc()
+        results.put((index, None, f'worker {index} failed'))
+
+def stop_workers(workers, timeout = 5):
+    '''terminate the workers that are still running, then join them all'''
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+    for worker in workers:
+        worker.join(timeout)
+
+def run_sharded_session(config_dict, make_box, spec = None):
+    '''run_session with the boxes split across software: processes worker processes'''
+    import datetime
+    import multiprocessing
+    import queue
+    from box import Box
+    from recording_classes import Timestamp_Writer_Thread, Flush_Policy
+    from session_orchestrator import save_config, start_live_summary, start_journal, start_metrics
+    from instrumentation import METRICS
+    software = config_dict['software']
+    box_IDs = list(config_dict['hardware'].keys())
+    n_shards = max(1, min(software['processes'], len(box_IDs)))
+    #fork, so workers inherit the rings, the run script's make_box and the clock anchor
+    context = multiprocessing.get_context('fork')
+    date = datetime.datetime.now()
+    save_config(config_dict, date)
+
+    #event times are monotonic from here on, pinned to wall time once. workers inherit the anchor
+    CLOCK.anchor()
+
+    doorbell = context.Event()
+    rings = [Shared_Event_Ring(context, doorbell, slots = software.get('ring_slots', 8192)) for _ in range(n_shards)]
+    results = context.Queue()
+    cores = worker_cores()
+    workers = []
+    #a caller that gives up on the session (an exception, or exiting while it runs) stops the workers, rather than
+    #leaving multiprocessing's exit waiting on them, and takes the rings out of /dev/shm
+    def abandon():
+        stop_workers(workers)
+        for ring in rings:
+            ring.unlink()
+    atexit.register(abandon)
+    try:
+        for k, shard in enumerate(shard_boxes(box_IDs, n_shards)):
+            worker = context.Process(target = run_shard, name = f'shard_{k}',
+                                     args = (k, config_dict, shard, make_box, spec, rings[k], cores[k % len(cores)],
+                                             results, date))
+            worker.start()
+            workers += [worker]
+            print(f'boxes {shard} on worker {k} (pid {worker.pid})')
+
+        #one writer thread keeps every box's file open. tune with software: flush_policy: {every_n, every_ms, on_state_change, fsync}
+        shared_writer = Timestamp_Writer_Thread(flush_policy = Flush_Policy(**software.get('flush_policy', {})))
+        #this process has the writer and transition histograms, the workers the rest (metrics_shard_k files)
+        metrics = start_metrics(config_dict, date, shared_writer)
+        if metrics:
+            for k, ring in enumerate(rings):
+                METRICS.add_gauge('beambreak_ring_depth', ring.depth, shard = k)
+        session_summary = start_live_summary(config_dict, date)
+        #the journal has every line, but no box checkpoints as the boxes are in the workers
+        journal = start_journal(config_dict, date)
+        aggregator = Event_Aggregator(rings, doorbell, shared_writer,
+                                      attach = [session_summary.attach] + ([journal.attach] if journal else []))
+        aggregator.start()
+
+        summaries = {}
+        reports = []
+        while len(reports) < n_shards:
+            try:
+                index, summary, report = results.get(timeout = 1)
+            except queue.Empty:
+                if any(not worker.is_alive() and worker.exitcode for worker in workers):
+                    print('a worker process died, stopping the session')
+                    #whatever the others already published is still drained and written below
+                    stop_workers(workers)
+                    break
+                continue
+            reports += [report]
+            if summary is not None:
+                summaries.update(summary)
+        for worker in workers:
+            worker.join()
+    except BaseException:
+        abandon()
+        raise
+    finally:
+        atexit.unregister(abandon)
+    aggregator.stop()
+    shared_writer.shut_down()
+    if metrics:
+        metrics.stop()
+    for ring in rings:
+        ring.close(unlink = True)
+    for report in reports:
+        print(report)
+    print(aggregator.report())
+    if metrics:
+        print(METRICS.report())
+    if journal:
+        journal.close()
+        print(journal.report())
+
+    boxes = []
+    for box_ID in box_IDs:
+        if box_ID not in summaries:
+            print(f'no results from {box_ID}, left out of the summary')
+            continue
+        box = Box(box_ID)
+        box.add_component(Box_Result(*summaries[box_ID]), 'ir_pair')
+        boxes += [box]
+    session_summary.add_boxes(boxes)
+    session_summary.stop()
+    return boxes
@@ -1,42 +1,39 @@
 import time
 import sys
-from concurrent.futures import ThreadPoolExecutor
-try:
-    import RPi.GPIO as GPIO
-    GPIO.setmode(GPIO.BCM)
-except:
-    print('RPi.GPIO not found')
-    from .Fake_handlers import Fake_GPIO, Fake_timestamp_writer
-    GPIO = Fake_GPIO()
-try: 
-    from adafruit_servokit import ServoKit
-    SERVO_KIT = ServoKit(channels=16)
-except Exception as e:
-    print(e)
-    print('servokit not found')
-    SERVO_KIT = None
+import threading
+#hardware is opened on first use. pick the backend with BEAMBREAK_BACKEND or GPIO.use(...), see hardware_backends
+from hardware_backends import GPIO, SERVO_KIT
     
 import queue
-import inspect
 from functools import partial
 import functools as functools
+import traceback
+from timer_scheduler import Timer_Scheduler
+from session_clock import CLOCK
+from led_scheduler import LED_Scheduler
+from box_executor import EXECUTORS
+from edge_dispatcher import Edge_Dispatcher
+from instrumentation import METRICS
 
-thread_executor = ThreadPoolExecutor(max_workers = 20)
+_led_scheduler = None
+_lazy_lock = threading.Lock()
+
+def get_led_scheduler():
+    '''the scheduler every LED on the HAT is driven from, made (and the HAT opened) the first time an LED needs it'''
+    global _led_scheduler
+    with _lazy_lock:
+        if _led_scheduler is None:
+            _led_scheduler = LED_Scheduler(SERVO_KIT._pca)
+        return _led_scheduler
 
 def thread_it(func):
-        '''simple decorator to pass function to our thread distributor via a queue. 
-        these 4 lines took about 4 hours of googling and trial and error.
+        '''simple decorator to pass function to its box's executor lane (see box_executor).
+        the arguments go through untouched, nothing is bound or inspected per call.
         the returned 'future' object has some useful features, such as its own task-done monitor. '''
         
+        @functools.wraps(func)
         def pass_to_thread(self, *args, **kwargs):
-            bound_args = inspect.signature(func).bind(self, *args, **kwargs)
-            bound_args.apply_defaults()
-            bound_args_dict = bound_args.arguments
-
-            new_kwargs = {k:v for k, v in bound_args_dict.items() if k not in ('self')}
-            #print(f'submitting {func}')
-            future = thread_executor.submit(func, self, **new_kwargs)
-            return future
+            return EXECUTORS.lane_for(self).submit(func, self, *args, **kwargs)
         return pass_to_thread
 
 def confirm_state_before_callback_execution(self_obj, callback_func, state_func, failure_func = None):
@@ -74,6 +71,100 @@ def confirm_state_before_callback_execution(self_obj, callback_func, state_func,
                 failure_func()
             else:
                 pass
+
+def callback_name(func):
+    return func.func.__name__ if isinstance(func, functools.partial) else getattr(func, '__name__', repr(func))
+
+class Confirmation_Engine:
+    '''timer driven version of confirm_state_before_callback_execution.
+
+    same rules: state_func must hold for cycles_required checks cycle_interval apart, otherwise it is sampled
+    failure_cycles times and the callback still runs if the success rate reaches success_rate_limit, else failure_func runs.
+    the re-checks are scheduled on a timer instead of slept through in the GPIO callback thread, so a noisy beam
+    no longer holds up callbacks on every other pin. any setting can be overridden per pin with configure'''
+
+    default_settings = {'cycles_required':2,
+                        'cycle_interval':0.015,
+                        'failure_cycles':20,
+                        'failure_interval':0,
+                        'success_rate_limit':0.9}
+
+    def __init__(self, scheduler = None, **settings):
+        self.scheduler = scheduler if scheduler else Timer_Scheduler(name = 'confirmation_engine')
+        self.defaults = dict(self.default_settings)
+        self.set_defaults(**settings)
+        self.pin_settings = {}
+
+    def _check_settings(self, settings):
+        unknown = set(settings) - set(self.default_settings)
+        if unknown:
+            raise Exception(f'unknown confirmation settings {unknown}. expected some of {list(self.default_settings)}')
+
+    def set_defaults(self, **settings):
+        self._check_settings(settings)
+        self.defaults.update(settings)
+
+    def configure(self, pin, **settings):
+        '''override the confirmation settings for one pin'''
+        self._check_settings(settings)
+        self.pin_settings.setdefault(pin, {}).update(settings)
+
+    def settings_for(self, pin):
+        settings = dict(self.defaults)
+        settings.update(self.pin_settings.get(pin, {}))
+        return settings
+
+    def confirm(self, pin, callback_func, state_func, failure_func = None):
+        '''start confirming. can be handed straight to GPIO.add_event_detect through a partial, as pin arrives as the channel'''
+        settings = self.settings_for(pin)
+        self._confirm_cycle(0, settings, callback_func, state_func, failure_func, (pin, CLOCK.now_ns()))
+
+    def _confirm_cycle(self, cycle, settings, callback_func, state_func, failure_func, timing):
+        if not state_func():
+            print(f'\ncallback func {callback_name(callback_func)} triggered, but could not confirm signal --> polling for {settings["failure_cycles"]} expecting {settings["success_rate_limit"]} match')
+            self._failure_sample(0, 0, settings, callback_func, state_func, failure_func, timing)
+        elif cycle + 1 >= settings['cycles_required']:
+            self._decided(timing, 'confirmed')
+            self._run(callback_func)
+        else:
+            self.scheduler.call_later(settings['cycle_interval'], self._confirm_cycle, cycle + 1, settings, callback_func, state_func, failure_func, timing)
+
+    def _failure_sample(self, taken, successes, settings, callback_func, state_func, failure_func, timing):
+        failure_cycles = settings['failure_cycles']
+        if settings['failure_interval']:
+            successes += bool(state_func())
+            taken += 1
+            if taken < failure_cycles:
+                self.scheduler.call_later(settings['failure_interval'], self._failure_sample, taken, successes, settings, callback_func, state_func, failure_func, timing)
+                return
+        else:
+            #a burst of reads is cheap, it was the sleeping that blocked
+            successes = sum(bool(state_func()) for _ in range(failure_cycles))
+        measured_rate = successes/failure_cycles
+        print(f'failure of conformation state success rate = {measured_rate}\n')
+        if measured_rate >= settings['success_rate_limit']:
+            self._decided(timing, 'sampled')
+            self._run(callback_func)
+        else:
+            self._decided(timing, 'failed')
+            if not failure_func is None:
+                print(f'utilizing failure function {callback_name(failure_func)}')
+                self._run(failure_func)
+
+    def _decided(self, timing, outcome):
+        pin, started_ns = timing
+        METRICS.pin_histogram('beambreak_confirm_seconds', pin, outcome = outcome).add((CLOCK.now_ns() - started_ns)/1e9)
+
+    def _run(self, func):
+        try:
+            func()
+        except Exception:
+            traceback.print_exc()
+
+CONFIRMATION_ENGINE = Confirmation_Engine()
+
+#every beam and button pin keeps BOTH edge detection for the whole session; state changes only reroute it
+EDGE_DISPATCHER = Edge_Dispatcher(GPIO)
             
 
 
@@ -95,11 +186,14 @@ class FakeTimestampManager:
     def write_timestamp(self, *args, **kwargs):
         print(f'writing a timestamp {args} {kwargs}')
         pass
+
+    def shut_down(self):
+        pass
     
 class IR_beambreak:
     
     def __init__(self, pin_number, pullup_pulldown = 'pullup', 
-                 timestamp_writer = None, ID = None, notes = None):
+                 timestamp_writer = None, ID = None, notes = None, confirmation_engine = None, edge_dispatcher = None):
         ''''''
         self.pin_number = pin_number
         self.pu_pd = pullup_pulldown    
@@ -109,13 +203,17 @@ class IR_beambreak:
         self.blocked_value = 0
         self.ID = ID
         self.name = notes
-        self.start_time = 0
+        self.start_ns = 0
+        self.last_edge_ns = None
         self.beam_break_count = 0
         self.timestamp_writer = FakeTimestampManager() if not timestamp_writer else timestamp_writer
         self.notes = notes if notes else ''
+        self.confirmation_engine = confirmation_engine if confirmation_engine else CONFIRMATION_ENGINE
+        self.edge_dispatcher = edge_dispatcher if edge_dispatcher else EDGE_DISPATCHER
+        self._wrappers = {'rising':{}, 'falling':{}}
 
-    def begin(self, start_time):
-        self.start_time = start_time
+    def begin(self, start_ns):
+        self.start_ns = start_ns
         self.testing = True
     
     def stop_testing(self):
@@ -123,14 +221,28 @@ class IR_beambreak:
         
     def set_callback(self, func, edge = 'falling', failure_func = None):
         self.clear_callback()
+        #callers that reuse the same func (the state machine engine) reuse the same wrapper too
+        cache = self._wrappers.get(edge) if failure_func is None else None
+        wrapper = cache.get(func) if cache is not None else None
         if edge == 'rising':
-            wrapper = partial(confirm_state_before_callback_execution,  callback_func = func, state_func = self.is_unblocked, failure_func = failure_func)
-            GPIO.add_event_detect(self.pin, GPIO.RISING, callback = wrapper, bouncetime = 100)
+            if wrapper is None:
+                wrapper = partial(self.edge_detected,  callback_func = func, state_func = self.is_unblocked, failure_func = failure_func)
+            self.edge_dispatcher.route(self.pin, GPIO.RISING, wrapper, bouncetime = 100)
         elif edge == 'falling':
-            wrapper = partial(confirm_state_before_callback_execution,  callback_func = func, state_func = self.is_blocked, failure_func = failure_func)
-            GPIO.add_event_detect(self.pin, GPIO.FALLING, callback = wrapper, bouncetime = 100)
+            if wrapper is None:
+                wrapper = partial(self.edge_detected,  callback_func = func, state_func = self.is_blocked, failure_func = failure_func)
+            self.edge_dispatcher.route(self.pin, GPIO.FALLING, wrapper, bouncetime = 100)
         else:
             raise Exception(f'edge must be "falling" or "rising" but was {edge}')
+        if cache is not None and len(cache) < 8:
+            cache[func] = wrapper
+
+    def edge_detected(self, channel, callback_func, state_func, failure_func = None):
+        '''GPIO callback. timestamps the edge before anything else, then hands it to confirmation'''
+        #the dispatcher has the edge's own time (the sample's, on the sampled backend)
+        edge_ns = self.edge_dispatcher.edge_ns(channel)
+        self.last_edge_ns = edge_ns if edge_ns is not None else CLOCK.now_ns()
+        self.confirmation_engine.confirm(channel, callback_func, state_func, failure_func)
     
     def is_blocked(self):
         return GPIO.input(self.pin) == self.blocked_value
@@ -148,9 +260,9 @@ class IR_beambreak:
             if self.is_blocked():
                 #print('\n\nentering record durations in a blocked state\n\n')
                 #directly check state with confirm_state func. go to begin_duration with current time. return to this func if state is not confirmed
-                confirm_state_before_callback_execution(self_obj = self, callback_func=partial(self.begin_duration), 
-                                                        state_func = self.is_blocked, 
-                                                        failure_func = self.record_durations)
+                self.confirmation_engine.confirm(self.pin, callback_func=partial(self.begin_duration, CLOCK.now_ns()), 
+                                                 state_func = self.is_blocked, 
+                                                 failure_func = self.record_durations)
             else:
                 #if not blocked, set callback as usual 
                 #print(f'setting callback for begin_duration as usual on {self.pin}')
@@ -160,52 +272,54 @@ class IR_beambreak:
         else:
             self.clear_callback()
     
-    def begin_duration(self, incoming_time = None):
-        '''this function can take an incoming time for recovery if a rising edge cannot be confirmed before
-        moving to "submit_duration" '''
+    def begin_duration(self, incoming_ns = None):
+        '''this function can take an incoming time (CLOCK ns) for recovery if a rising edge cannot be confirmed before
+        moving to "submit_duration". otherwise the break starts at the falling edge that triggered it'''
         #for 2 beambreak behavior rig ['ID', 'beam', 'elapsed_time', 'event','count', 'latency','notes']
         self.clear_callback()
         
-        if incoming_time is None:
-            incoming_time = time.time()
+        if incoming_ns is None:
+            incoming_ns = self.last_edge_ns if self.last_edge_ns is not None else CLOCK.now_ns()
         
         #can enter in an unblocked state
         if self.is_unblocked():
             #print('\n\nentering begin_duration in an unblocked state\n\n')
             #directly check state with confirm_state func. go to begin_duration with current time. return to this func if state is not confirmed
-            partial_in_case_of_callback_failure = partial(self.begin_duration, incoming_time)
-            confirm_state_before_callback_execution(self_obj = self, callback_func=partial(self.submit_duration, incoming_time), 
-                                                    state_func = self.is_unblocked, 
-                                                    failure_func = partial_in_case_of_callback_failure)
+            partial_in_case_of_callback_failure = partial(self.begin_duration, incoming_ns)
+            self.confirmation_engine.confirm(self.pin, callback_func=partial(self.submit_duration, incoming_ns, CLOCK.now_ns()), 
+                                             state_func = self.is_unblocked, 
+                                             failure_func = partial_in_case_of_callback_failure)
         else:
             print(f'begin duration on ir pin{self.pin}')
-            self.timestamp_writer.write_timestamp((self.ID, self.name, incoming_time - self.start_time, 
+            self.timestamp_writer.write_timestamp((self.ID, self.name, (incoming_ns - self.start_ns)/1e9, 
                                                 'beam_break_initiation', self.beam_break_count, 
-                                                '', self.notes))
+                                                '', self.notes), edge_ns = incoming_ns)
 
             #set the callback with rising edge detection. if it fails, return to the start of begin_duration and check beam there
-            partial_in_case_of_callback_failure = partial(self.set_callback, partial(self.submit_duration, incoming_time), edge = 'rising', 
-                                            failure_func = partial(self.begin_duration, incoming_time))
-            self.set_callback(func=partial(self.submit_duration, incoming_time), edge = 'rising', 
+            partial_in_case_of_callback_failure = partial(self.set_callback, partial(self.submit_duration, incoming_ns), edge = 'rising', 
+                                            failure_func = partial(self.begin_duration, incoming_ns))
+            self.set_callback(func=partial(self.submit_duration, incoming_ns), edge = 'rising', 
                                             failure_func = partial_in_case_of_callback_failure)
             
     
-    def submit_duration(self, incoming_time):
+    def submit_duration(self, incoming_ns, end_ns = None):
+        '''the break ends at the rising edge that triggered this, unless an end time is passed in'''
         self.clear_callback()
         #can enter in an unblocked state if state func was not confirmed by wrapper of set_callback
-        now = time.time()
-        duration = now - incoming_time
+        if end_ns is None:
+            end_ns = self.last_edge_ns
+        duration = (end_ns - incoming_ns)/1e9
         self.beam_break_count+=1
         print(f'submit duration {duration} count {self.beam_break_count} on ir pin{self.pin} / {self.notes}\n')
         #for 2 beambreak behavior rig ['ID', 'beam', 'elapsed_time', 'event','count', 'latency','notes']
-        self.timestamp_writer.write_timestamp((self.ID, self.name, now - self.start_time, 
+        self.timestamp_writer.write_timestamp((self.ID, self.name, (end_ns - self.start_ns)/1e9, 
                                                'beam_break_duration', self.beam_break_count, 
-                                               duration, self.notes))
+                                               duration, self.notes), edge_ns = end_ns)
         
         self.record_durations()
         
     def clear_callback(self):
-        GPIO.remove_event_detect(self.pin)
+        self.edge_dispatcher.mask(self.pin)
     
     @thread_it
     def test_IR_with_LED(self, LED):        
@@ -226,10 +340,14 @@ class IR_beambreak:
                     
 class Button:
     
-    def __init__(self, pin_number, pullup_pulldown = 'pullup'):
+    def __init__(self, pin_number, pullup_pulldown = 'pullup', confirmation_engine = None, edge_dispatcher = None):
         ''''''
         self.pin = pin_number
         self.pu_pd = pullup_pulldown 
+        self.confirmation_engine = confirmation_engine if confirmation_engine else CONFIRMATION_ENGINE
+        self.edge_dispatcher = edge_dispatcher if edge_dispatcher else EDGE_DISPATCHER
+        self._wrappers = {'rising':{}, 'falling':{}}
+        self.last_edge_ns = None
         GPIO.setup(self.pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
         if pullup_pulldown == 'pullup':
             GPIO.setup(self.pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
@@ -244,18 +362,96 @@ class Button:
     
     def set_callback(self, func, bouncetime = 100):
         print(f'setting callback on {self.pin}')
-        wrapper = partial(confirm_state_before_callback_execution, callback_func = func, state_func = self.is_pressed)
-        GPIO.add_event_detect(self.pin, GPIO.FALLING, callback = wrapper, bouncetime = bouncetime)
+        wrapper = self._wrappers['falling'].get(func)
+        if wrapper is None:
+            wrapper = partial(self.edge_detected, callback_func = func, state_func = self.is_pressed)
+            if len(self._wrappers['falling']) < 8:
+                self._wrappers['falling'][func] = wrapper
+        self.edge_dispatcher.route(self.pin, GPIO.FALLING, wrapper, bouncetime = bouncetime)
+
+    def edge_detected(self, channel, callback_func, state_func, failure_func = None):
+        '''GPIO callback. timestamps the press before anything else, then hands it to confirmation'''
+        edge_ns = self.edge_dispatcher.edge_ns(channel)
+        self.last_edge_ns = edge_ns if edge_ns is not None else CLOCK.now_ns()
+        self.confirmation_engine.confirm(channel, callback_func, state_func, failure_func)
 
     def clear_callback(self):
-        GPIO.remove_event_detect(self.pin)
+        self.edge_dispatcher.mask(self.pin)
+
+class Session_Flags:
+    '''started, exit and state as properties, so a session can wait on its boxes instead of polling them.
+    started and exit are threading.Events underneath (wait_started/wait_exit). listeners added with
+    add_session_listener are called as listener(combo, name, value) on every change, from the thread that made it'''
 
-class Two_Beambreak_LED_Button_Combo:
+    #set by resume(). the start press then counts as this far into the session
+    resume_offset_ns = 0
+
+    def resume(self, elapsed, traversal_counts):
+        '''carry on a session that was interrupted elapsed seconds in (see session_journal). the box still waits for
+        its start press, then its elapsed times and counts continue from where they stopped'''
+        self.resume_offset_ns = int(elapsed*1e9)
+        for k, count in traversal_counts.items():
+            self.traversal_counts[int(k)] = count
+
+    def _session_events(self):
+        events = self.__dict__.get('_events')
+        if events is None:
+            events = self.__dict__.setdefault('_events', {'started':threading.Event(), 'exit':threading.Event()})
+        return events
+
+    def _set_flag(self, name, value):
+        event = self._session_events()[name]
+        if value:
+            event.set()
+        else:
+            event.clear()
+        self._notify(name, bool(value))
+
+    def _notify(self, name, value):
+        for listener in self.__dict__.get('_session_listeners', ()):
+            listener(self, name, value)
+
+    def add_session_listener(self, listener):
+        self.__dict__.setdefault('_session_listeners', []).append(listener)
+
+    @property
+    def started(self):
+        return self._session_events()['started'].is_set()
+
+    @started.setter
+    def started(self, value):
+        self._set_flag('started', value)
+
+    @property
+    def exit(self):
+        return self._session_events()['exit'].is_set()
+
+    @exit.setter
+    def exit(self, value):
+        self._set_flag('exit', value)
+
+    @property
+    def state(self):
+        return self.__dict__.get('_state')
+
+    @state.setter
+    def state(self, value):
+        self.__dict__['_state'] = value
+        self._notify('state', value)
+
+    def wait_started(self, timeout = None):
+        return self._session_events()['started'].wait(timeout)
+
+    def wait_exit(self, timeout = None):
+        return self._session_events()['exit'].wait(timeout)
+
+class Two_Beambreak_LED_Button_Combo(Session_Flags):
     def __init__(self, beambreak_1, beambreak_2, led, button, box_ID, notes_1 = None, notes_2 = None, timestamp_writer = None, screen_writer = None):
         self.ID = box_ID
         self.traversal_counts = {1:0, 2:0}
         self.beambreak_1 = beambreak_1
         self.beambreak_2 = beambreak_2
+        self.traversal_beams = {1:self.beambreak_1, 2:self.beambreak_2}
         self.LED = led
         self.button = button
         self.timestamp_writer = FakeTimestampManager() if not timestamp_writer else timestamp_writer
@@ -306,20 +502,31 @@ class Two_Beambreak_LED_Button_Combo:
         if self.beambreak_1.is_blocked() or self.beambreak_2.is_blocked():
             print('waiting for beambreaks to be unblocked')
             while self.beambreak_1.is_blocked() or self.beambreak_2.is_blocked():
-                time.sleep(0.5)
+                CLOCK.sleep(0.5)
         
         self.state = 'entry'
         self.reward_time = reward_time
         self.LED.set_on()
-        self.latency_from = time.time()
+        self.latency_from_ns = CLOCK.now_ns()
         self.button.set_callback(self.begin)
     
     def check_state(self, state_query):
         return self.state == state_query
+
+    def edge_time(self, component):
+        '''CLOCK ns at which the edge that triggered this state reached the GPIO callback, or now if there wasn't one'''
+        return component.last_edge_ns if component.last_edge_ns is not None else CLOCK.now_ns()
+
+    def elapsed(self, t_ns):
+        return (t_ns - self.start_ns)/1e9
+
+    def latency(self, t_ns):
+        return (t_ns - self.latency_from_ns)/1e9
     
     def begin(self, channel = None):
         self.button.clear_callback()
-        self.start_time = time.time()
+        self.start_ns = self.edge_time(self.button) - self.resume_offset_ns
+        self.start_time = CLOCK.to_wall(self.start_ns)
         self.started = True
         self.ready_state(channel)
     
@@ -327,7 +534,8 @@ class Two_Beambreak_LED_Button_Combo:
     def reward_cancel_state(self, beam_ID, notes):
         print('reward canceled state')
         self.state = 'reward_canceled'
-        self.timestamp_writer.write_timestamp((self.ID, beam_ID, time.time() - self.start_time, 'reward_canceled', '', time.time()-self.latency_from, notes))
+        t_ns = self.edge_time(self.button)
+        self.timestamp_writer.write_timestamp((self.ID, beam_ID, self.elapsed(t_ns), 'reward_canceled', '', self.latency(t_ns), notes), state_change = True, edge_ns = t_ns)
         self.beambreak_1.clear_callback()
         self.beambreak_2.clear_callback()
         self.button.clear_callback()
@@ -341,8 +549,9 @@ class Two_Beambreak_LED_Button_Combo:
         print('ready state')
         self.state = 'ready'
         #self.write_to_screen(f'traversal_counts for {self.ID}: {self.traversal_counts}')
-        self.timestamp_writer.write_timestamp((self.ID, '', time.time() - self.start_time, 'reset', '', time.time()-self.latency_from, ''))
-        self.latency_from = time.time()
+        t_ns = self.edge_time(self.button)
+        self.timestamp_writer.write_timestamp((self.ID, '', self.elapsed(t_ns), 'reset', '', self.latency(t_ns), ''), state_change = True, edge_ns = t_ns)
+        self.latency_from_ns = t_ns
         
         self.beambreak_1.set_callback(func=partial(self.beam_broken_state, 1, self.notes_1))
         self.beambreak_2.set_callback(func=partial(self.beam_broken_state, 2, self.notes_2))
@@ -357,28 +566,33 @@ class Two_Beambreak_LED_Button_Combo:
         self.traversal_counts[beam_ID] += 1
         print(f'\n\ntraversal_count +=1 for {beam_ID}\n{self.ID} {1} {self.notes_1}: {self.traversal_counts[1]} | {self.ID} {2} {self.notes_2}: {self.traversal_counts[2]}\n\n')
         'box_ID, beam_ID, time (since start), event, latency, notes'
-        self.timestamp_writer.write_timestamp((self.ID, beam_ID, time.time() - self.start_time , f'{beam_ID} traversal',self.traversal_counts[beam_ID], time.time()-self.latency_from, notes))
+        t_ns = self.edge_time(self.traversal_beams[beam_ID])
+        self.timestamp_writer.write_timestamp((self.ID, beam_ID, self.elapsed(t_ns), f'{beam_ID} traversal',self.traversal_counts[beam_ID], self.latency(t_ns), notes), state_change = True, edge_ns = t_ns)
         self.button.set_callback(func=partial(self.reward_cancel_state, beam_ID, notes))
-        start = time.time()
         self.state = 'reward'
-        self.latency_from = time.time()
-        while time.time() - start < self.reward_time and self.state == 'reward':
-            time.sleep(0.1)
+        self.latency_from_ns = t_ns
+        #the reward period runs from the beam break itself
+        end_ns = t_ns + int(self.reward_time*1e9)
+        while CLOCK.now_ns() < end_ns and self.state == 'reward':
+            CLOCK.sleep(0.1)
         if self.state == 'reward':
             print(f'{self.ID} reward period over')
             self.LED.flash(frequency = 0.5, interrupt_func = self.LED.interrupt_LED)
             self.button.clear_callback()
             self.button.set_callback(self.ready_state)
-            self.timestamp_writer.write_timestamp((self.ID, beam_ID, time.time() - self.start_time, 'reward_period_end','', '', notes))
-            self.latency_from = time.time()
+            self.timestamp_writer.write_timestamp((self.ID, beam_ID, self.elapsed(end_ns), 'reward_period_end','', '', notes), state_change = True, edge_ns = end_ns)
+            self.latency_from_ns = end_ns
         
     def write_to_screen(self, message):
         print(f'\n{self.ID}: {message}\n')
         
 class LED:
-    def __init__(self, HAT_pin):
-        ''''''
+    def __init__(self, HAT_pin, led_scheduler = None):
+        '''writes go through the LED scheduler, which owns every HAT channel and batches their I2C writes'''
+        self.HAT_pin = HAT_pin
         self.channel = SERVO_KIT._pca.channels[HAT_pin]
+        self.led_scheduler = led_scheduler if led_scheduler else get_led_scheduler()
+        self.flash_handle = None
         self.output_on = self.set_active_HAT
         self.output_off = self.set_inactive_HAT
         self.type = 'HAT'
@@ -389,7 +603,7 @@ class LED:
         
     def set_active_HAT(self, percent = 100):
         self.active = True
-        self.channel.duty_cycle = self.hat_PWM_hex_from_percent(percent)
+        self.led_scheduler.set(self.HAT_pin, self.hat_PWM_hex_from_percent(percent))
         
     def hat_PWM_hex_from_percent(self, percent = 100, int_bit = 16, max_value = None):
         vals = {16:65535, 12: 4095, 8: 255}
@@ -405,13 +619,13 @@ class LED:
         
     def set_inactive_HAT(self):
         self.active = False
-        self.channel.duty_cycle = 0
+        self.led_scheduler.set(self.HAT_pin, 0)
     
     def flash_on(self, percent = 100):
-        self.channel.duty_cycle = self.hat_PWM_hex_from_percent(percent)
+        self.led_scheduler.set(self.HAT_pin, self.hat_PWM_hex_from_percent(percent))
         
     def flash_off(self):
-        self.channel.duty_cycle = 0
+        self.led_scheduler.set(self.HAT_pin, 0)
     
     def is_active(self):
         return self.active
@@ -421,36 +635,18 @@ class LED:
         
         return not self.active
     
-    @thread_it
     def flash(self, frequency, interrupt_func, percent = 100, ):
         '''given a frequency in seconds, flash on for 1/2, off for 1/2 of that 
-        frequency until interrupt_func returns True'''
+        frequency until interrupt_func returns True. runs on the LED scheduler's timer, not a thread of its own'''
         
-        
-        half_freq = frequency/2
         self.active = True
-        while not interrupt_func():
-            self.flash_on(percent = percent)
-            start = time.time()
-            while (time.time() - start) < half_freq:
-                if interrupt_func():
-                    break
-                else:
-                    time.sleep(0.1)
-            
-            self.flash_off()
-            start = time.time()
-            if not interrupt_func():
-                while (time.time() - start) < half_freq:
-                    if interrupt_func():
-                        break
-                    else:
-                        time.sleep(0.1)
-        
-        self.set_off()
+        self.flash_handle = self.led_scheduler.flash(self.HAT_pin, frequency, interrupt_func,
+                                                     duty_cycle = self.hat_PWM_hex_from_percent(percent),
+                                                     on_done = self.set_off)
+        return self.flash_handle
             
             
-class Four_Beambreak_LED_Button_Combo:
+class Four_Beambreak_LED_Button_Combo(Session_Flags):
     def __init__(self, beambreak_1, beambreak_2, beambreak_3, beambreak_4, led, button, box_ID, notes_1 = None, notes_2 = None, notes_3 = None, notes_4 = None, timestamp_writer = None, screen_writer = None):
         self.ID = box_ID
         self.traversal_counts = {1:0, 2:0}
@@ -458,6 +654,7 @@ class Four_Beambreak_LED_Button_Combo:
         #these are traversal beambreaks
         self.beambreak_1 = beambreak_1
         self.beambreak_2 = beambreak_2
+        self.traversal_beams = {1:self.beambreak_1, 2:self.beambreak_2}
         
         #these are top-of-wall beambreaks
         self.beambreak_3 = beambreak_3
@@ -517,23 +714,34 @@ class Four_Beambreak_LED_Button_Combo:
                 print('waiting for beambreaks to be unblocked')
                 while any([b.is_blocked() for b in self.all_breaks]):
                     print([f'{b.is_blocked()}:{b.ID}\{b.pin}' for b in self.all_breaks])
-                    time.sleep(0.5)
+                    CLOCK.sleep(0.5)
         
         self.state = 'entry'
         self.reward_time = reward_time
         self.LED.set_on()
-        self.latency_from = time.time()
+        self.latency_from_ns = CLOCK.now_ns()
         self.button.set_callback(self.begin)
     
     def check_state(self, state_query):
         return self.state == state_query
+
+    def edge_time(self, component):
+        '''CLOCK ns at which the edge that triggered this state reached the GPIO callback, or now if there wasn't one'''
+        return component.last_edge_ns if component.last_edge_ns is not None else CLOCK.now_ns()
+
+    def elapsed(self, t_ns):
+        return (t_ns - self.start_ns)/1e9
+
+    def latency(self, t_ns):
+        return (t_ns - self.latency_from_ns)/1e9
     
     def begin(self, channel = None):
         self.button.clear_callback()
-        self.start_time = time.time()
+        self.start_ns = self.edge_time(self.button) - self.resume_offset_ns
+        self.start_time = CLOCK.to_wall(self.start_ns)
         self.started = True
-        self.beambreak_3.begin(self.start_time)
-        self.beambreak_4.begin(self.start_time)
+        self.beambreak_3.begin(self.start_ns)
+        self.beambreak_4.begin(self.start_ns)
         
         self.ready_state(channel)
     
@@ -543,7 +751,8 @@ class Four_Beambreak_LED_Button_Combo:
         self.beambreak_2.clear_callback()
         print('reward canceled state')
         self.state = 'reward_canceled'
-        self.timestamp_writer.write_timestamp((self.ID, beam_ID, time.time() - self.start_time, 'reward_canceled', '', time.time()-self.latency_from, notes))
+        t_ns = self.edge_time(self.button)
+        self.timestamp_writer.write_timestamp((self.ID, beam_ID, self.elapsed(t_ns), 'reward_canceled', '', self.latency(t_ns), notes), state_change = True, edge_ns = t_ns)
         self.button.clear_callback()
         self.ready_state()
 
@@ -557,8 +766,9 @@ class Four_Beambreak_LED_Button_Combo:
         print('ready state')
         self.state = 'ready'
         #self.write_to_screen(f'traversal_counts for {self.ID}: {self.traversal_counts}')
-        self.timestamp_writer.write_timestamp((self.ID, '', time.time() - self.start_time, 'reset', '', time.time()-self.latency_from, ''))
-        self.latency_from = time.time()
+        t_ns = self.edge_time(self.button)
+        self.timestamp_writer.write_timestamp((self.ID, '', self.elapsed(t_ns), 'reset', '', self.latency(t_ns), ''), state_change = True, edge_ns = t_ns)
+        self.latency_from_ns = t_ns
         
         self.beambreak_1.set_callback(func=partial(self.beam_broken_state, 1, self.notes_1))
         self.beambreak_2.set_callback(func=partial(self.beam_broken_state, 2, self.notes_2))
@@ -573,13 +783,15 @@ class Four_Beambreak_LED_Button_Combo:
         self.traversal_counts[beam_ID] += 1
         print(f'\n\ntraversal_count +=1 for {beam_ID}\n{self.ID} {1} {self.notes_1}: {self.traversal_counts[1]} | {self.ID} {2} {self.notes_2}: {self.traversal_counts[2]}\n\n')
         'box_ID, beam_ID, time (since start), event, latency, notes'
-        self.timestamp_writer.write_timestamp((self.ID, beam_ID, time.time() - self.start_time , f'{beam_ID} traversal',self.traversal_counts[beam_ID], time.time()-self.latency_from, notes))
+        t_ns = self.edge_time(self.traversal_beams[beam_ID])
+        self.timestamp_writer.write_timestamp((self.ID, beam_ID, self.elapsed(t_ns), f'{beam_ID} traversal',self.traversal_counts[beam_ID], self.latency(t_ns), notes), state_change = True, edge_ns = t_ns)
         self.button.set_callback(func=partial(self.reward_cancel_state, beam_ID, notes))
-        start = time.time()
         self.state = 'reward'
-        self.latency_from = time.time()
-        while time.time() - start < self.reward_time and self.state == 'reward':
-            time.sleep(0.1)
+        self.latency_from_ns = t_ns
+        #the reward period runs from the beam break itself
+        end_ns = t_ns + int(self.reward_time*1e9)
+        while CLOCK.now_ns() < end_ns and self.state == 'reward':
+            CLOCK.sleep(0.1)
         if self.state == 'reward':
             print(f'{self.ID} reward period over')
             self.beambreak_3.clear_callback()
@@ -588,8 +800,8 @@ class Four_Beambreak_LED_Button_Combo:
             self.LED.flash(frequency = 0.5, interrupt_func = self.LED.interrupt_LED)
             self.button.clear_callback()
             self.button.set_callback(self.ready_state)
-            self.timestamp_writer.write_timestamp((self.ID, beam_ID, time.time() - self.start_time, 'reward_period_end','', '', notes))
-            self.latency_from = time.time()
+            self.timestamp_writer.write_timestamp((self.ID, beam_ID, self.elapsed(end_ns), 'reward_period_end','', '', notes), state_change = True, edge_ns = end_ns)
+            self.latency_from_ns = end_ns
         
     def write_to_screen(self, message):
         print(f'\n{self.ID}: {message}\n')
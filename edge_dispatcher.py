@@ -0,0 +1,118 @@
+'''persistent edge detection.
+
+the combos change what a pin's edges mean on every state change. instead of GPIO.remove_event_detect +
+add_event_detect each time (which tears down and rebuilds the kernel's edge polling, and misses edges in between),
+each pin is registered once for BOTH edges and every edge goes through a software dispatch table.
+route() points a pin at the current state's handler, mask() drops its edges until the next route().
+
+the edge direction is read back from the pin level when the edge arrives, and bouncetime is applied in software
+from the time the route last delivered an edge, the same as RPi.GPIO's per registration bouncetime.
+
+edge_ns(pin) is the time of the edge being delivered: the backend's own time for it where it has one (the sampled
+backend's edge_time_ns, which can be dispatch_interval older than the callback), otherwise when it arrived here.
+'''
+import threading
+from session_clock import CLOCK
+from instrumentation import METRICS
+
+
+class Edge_Route:
+    '''one per registered pin, updated in place on every route/mask so rerouting allocates nothing.
+    generation changes every time, so an edge that raced a reroute is dropped rather than delivered to the old handler'''
+    def __init__(self):
+        self.active = False
+        self.level = None
+        self.callback = None
+        self.bounce_ns = 0
+        self.last_ns = None
+        self.edge_ns = None
+        self.generation = 0
+        self.callback_histogram = None
+
+
+class Edge_Dispatcher:
+
+    def __init__(self, gpio):
+        self.gpio = gpio
+        self.routes = {}
+        self.stats = {'dispatched':0, 'masked':0, 'wrong_direction':0, 'bounced':0}
+        self._edge_time = None
+        self._lock = threading.Lock()
+
+    @property
+    def registered(self):
+        return set(self.routes)
+
+    def register(self, pin):
+        '''start BOTH edge detection on pin, once'''
+        route = self.routes.get(pin)
+        if route is not None:
+            return route
+        with self._lock:
+            if pin not in self.routes:
+                self._edge_time = getattr(self.gpio, 'edge_time_ns', None)
+                self.gpio.add_event_detect(pin, self.gpio.BOTH, callback = self._on_edge)
+                route = Edge_Route()
+                route.callback_histogram = METRICS.pin_histogram('beambreak_edge_callback_seconds', pin)
+                self.routes[pin] = route
+            return self.routes[pin]
+
+    def route(self, pin, edge, callback, bouncetime = None):
+        '''callback(pin) on the next edges of direction edge (GPIO.RISING or GPIO.FALLING, or GPIO.BOTH) on pin,
+        like GPIO.add_event_detect but without touching detection'''
+        route = self.register(pin)
+        route.active = False
+        route.generation += 1
+        route.level = 1 if edge == self.gpio.RISING else 0 if edge == self.gpio.FALLING else None
+        route.callback = callback
+        route.bounce_ns = bouncetime*1_000_000 if bouncetime else 0
+        route.last_ns = None
+        route.active = True
+
+    def mask(self, pin):
+        '''ignore pin's edges until it is routed again'''
+        route = self.routes.get(pin)
+        if route is not None:
+            route.active = False
+            route.generation += 1
+
+    def edge_ns(self, pin):
+        '''CLOCK time of the edge last delivered on pin, None if there hasn't been one'''
+        route = self.routes.get(pin)
+        return route.edge_ns if route is not None else None
+
+    def release(self, pin):
+        '''really stop detection on pin, eg before handing it to something else'''
+        with self._lock:
+            if self.routes.pop(pin, None) is not None:
+                self.gpio.remove_event_detect(pin)
+
+    def release_all(self):
+        for pin in list(self.routes):
+            self.release(pin)
+
+    def _on_edge(self, channel):
+        route = self.routes.get(channel)
+        if route is None or not route.active:
+            self.stats['masked'] += 1
+            return
+        generation, callback = route.generation, route.callback
+        if route.level is not None and self.gpio.input(channel) != route.level:
+            self.stats['wrong_direction'] += 1
+            return
+        now = CLOCK.now_ns()
+        edge_ns = self._edge_time(channel) if self._edge_time is not None else None
+        if edge_ns is None:
+            edge_ns = now
+        if route.last_ns is not None and edge_ns - route.last_ns < route.bounce_ns:
+            self.stats['bounced'] += 1
+            return
+        if route.generation != generation or not route.active:
+            #rerouted or masked while we were checking
+            self.stats['masked'] += 1
+            return
+        route.last_ns = edge_ns
+        route.edge_ns = edge_ns
+        self.stats['dispatched'] += 1
+        callback(channel)
+        route.callback_histogram.add((CLOCK.now_ns() - now)/1e9)
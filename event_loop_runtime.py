@@ -0,0 +1,194 @@
+'''optional asyncio runtime for the box state machines.
+
+the threaded combos hold a pool worker for every reward period and entry wait. here those are timers on one
+event loop running in a background thread, so dozens of boxes cost one mostly-idle thread. LEDs flash from the
+shared LED scheduler in either runtime.
+GPIO callbacks hop onto the loop with loop_it (the event loop version of thread_it).'''
+import asyncio
+import threading
+import time
+import functools
+from functools import partial
+from components import Two_Beambreak_LED_Button_Combo, Four_Beambreak_LED_Button_Combo
+from session_clock import CLOCK
+
+
+class Runtime_Handle:
+    '''cancellable from any thread. a cancelled timer still wakes the loop once, but does nothing'''
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Event_Loop_Runtime:
+    def __init__(self, name = 'event_loop_runtime'):
+        ''''''
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target = self._run, daemon = True, name = name)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def in_loop(self):
+        return threading.get_ident() == self.thread.ident
+
+    def call_soon(self, func, *args):
+        '''run func(*args) on the loop as soon as possible. safe to call from GPIO callback threads'''
+        if self.in_loop():
+            self.loop.call_soon(func, *args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def call_later(self, delay, func, *args):
+        '''run func(*args) on the loop after delay seconds. returns a handle with cancel()'''
+        handle = Runtime_Handle()
+        def fire():
+            if not handle.cancelled:
+                func(*args)
+        self.call_soon(self.loop.call_later, delay, fire)
+        return handle
+
+    def run_coroutine(self, coro):
+        '''schedule a coroutine on the loop. returns a concurrent.futures.Future'''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def bridge(self, func):
+        '''wrap func so calling it (e.g. from a GPIO callback) runs it on the loop instead'''
+        def bridged(*args, **kwargs):
+            self.call_soon(partial(func, *args, **kwargs))
+        bridged.__name__ = getattr(func, '__name__', getattr(getattr(func, 'func', None), '__name__', 'bridged'))
+        return bridged
+
+    def shut_down(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+_default_runtime = None
+_default_runtime_lock = threading.Lock()
+
+def get_runtime():
+    '''the runtime shared by every box that was not handed its own'''
+    global _default_runtime
+    with _default_runtime_lock:
+        if _default_runtime is None:
+            _default_runtime = Event_Loop_Runtime()
+        return _default_runtime
+
+
+def loop_it(func):
+    '''event loop version of thread_it: pass the method to the box's runtime loop instead of a pool worker'''
+    @functools.wraps(func)
+    def pass_to_loop(self, *args, **kwargs):
+        self.runtime.call_soon(partial(func, self, *args, **kwargs))
+    return pass_to_loop
+
+
+class Event_Loop_Combo_Mixin:
+    '''replaces the thread-holding states of the beambreak combos with loop timers.
+    mix in ahead of a combo class, see Async_Two_Beambreak_LED_Button_Combo'''
+
+    def __init__(self, *args, runtime = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.runtime = runtime if runtime else get_runtime()
+        if not hasattr(self, 'all_breaks'):
+            self.all_breaks = [self.beambreak_1, self.beambreak_2]
+        self.reward_timer = None
+        self.waiting_to_enter = False
+
+    def stop_flashing(self):
+        handle = getattr(self.LED, 'flash_handle', None)
+        if handle is not None:
+            handle.cancel()
+
+    def cancel_reward_timer(self):
+        if self.reward_timer is not None:
+            self.reward_timer.cancel()
+            self.reward_timer = None
+
+    @loop_it
+    def entry_state(self, reward_time = 45):
+        ''''''
+        if not self.waiting_to_enter:
+            print('entry state')
+        if any(b.is_blocked() for b in self.all_breaks):
+            if not self.waiting_to_enter:
+                print(f'blocked beams: {[b.pin for b in self.all_breaks if b.is_blocked()]}')
+                print('waiting for beambreaks to be unblocked')
+            self.waiting_to_enter = True
+            self.runtime.call_later(0.5, self.entry_state, reward_time)
+            return
+        self.waiting_to_enter = False
+        self.state = 'entry'
+        self.reward_time = reward_time
+        self.LED.set_on()
+        self.latency_from_ns = CLOCK.now_ns()
+        self.button.set_callback(self.begin)
+
+    @loop_it
+    def begin(self, channel = None):
+        super().begin(channel)
+
+    @loop_it
+    def ready_state(self, channel = None):
+        self.cancel_reward_timer()
+        super().ready_state(channel)
+
+    @loop_it
+    def reward_cancel_state(self, beam_ID, notes):
+        self.cancel_reward_timer()
+        self.beambreak_1.clear_callback()
+        self.beambreak_2.clear_callback()
+        print('reward canceled state')
+        self.state = 'reward_canceled'
+        t_ns = self.edge_time(self.button)
+        self.timestamp_writer.write_timestamp((self.ID, beam_ID, self.elapsed(t_ns), 'reward_canceled', '', self.latency(t_ns), notes), state_change = True, edge_ns = t_ns)
+        self.button.clear_callback()
+        self.ready_state()
+
+    @loop_it
+    def beam_broken_state(self, beam_ID, notes = None):
+        self.stop_flashing()
+        self.LED.set_on()
+        self.beambreak_1.clear_callback()
+        self.beambreak_2.clear_callback()
+        self.button.clear_callback()
+
+        self.traversal_counts[beam_ID] += 1
+        print(f'\n\ntraversal_count +=1 for {beam_ID}\n{self.ID} {1} {self.notes_1}: {self.traversal_counts[1]} | {self.ID} {2} {self.notes_2}: {self.traversal_counts[2]}\n\n')
+        t_ns = self.edge_time(self.traversal_beams[beam_ID])
+        self.timestamp_writer.write_timestamp((self.ID, beam_ID, self.elapsed(t_ns), f'{beam_ID} traversal',self.traversal_counts[beam_ID], self.latency(t_ns), notes), state_change = True, edge_ns = t_ns)
+        self.button.set_callback(func=partial(self.reward_cancel_state, beam_ID, notes))
+        self.state = 'reward'
+        self.latency_from_ns = t_ns
+        self.cancel_reward_timer()
+        #the reward period runs from the beam break itself
+        end_ns = t_ns + int(self.reward_time*1e9)
+        self.reward_timer = self.runtime.call_later(max(0, (end_ns - CLOCK.now_ns())/1e9), self.reward_period_over, beam_ID, notes, end_ns)
+
+    def reward_period_over(self, beam_ID, notes, end_ns):
+        '''runs on the loop when the reward timer fires'''
+        self.reward_timer = None
+        if self.state != 'reward':
+            return
+        print(f'{self.ID} reward period over')
+        #top-of-wall beams stop recording until the box is reset
+        for beam in self.all_breaks[2:]:
+            beam.clear_callback()
+        self.LED.flash(frequency = 0.5, interrupt_func = self.LED.interrupt_LED)
+        self.button.clear_callback()
+        self.button.set_callback(self.ready_state)
+        self.timestamp_writer.write_timestamp((self.ID, beam_ID, self.elapsed(end_ns), 'reward_period_end','', '', notes), state_change = True, edge_ns = end_ns)
+        self.latency_from_ns = end_ns
+
+
+class Async_Two_Beambreak_LED_Button_Combo(Event_Loop_Combo_Mixin, Two_Beambreak_LED_Button_Combo):
+    '''Two_Beambreak_LED_Button_Combo running on an Event_Loop_Runtime'''
+
+
+class Async_Four_Beambreak_LED_Button_Combo(Event_Loop_Combo_Mixin, Four_Beambreak_LED_Button_Combo):
+    '''Four_Beambreak_LED_Button_Combo running on an Event_Loop_Runtime'''
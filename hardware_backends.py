@@ -0,0 +1,150 @@
+'''pluggable hardware backends, opened the first time something uses them rather than at import.
+
+gpio backends:
+    rpi        RPi.GPIO in BCM mode
+    simulated  Fake_handlers.Simulated_GPIO, no hardware needed
+    recorder   wraps another gpio backend (wrap = 'auto') and keeps every call made to it in .calls
+    sampled    pin_sampler.Sampled_GPIO over another gpio backend (wrap = 'auto'), other options (rate...) go to Sampled_GPIO
+    auto       rpi when RPi.GPIO imports, otherwise simulated (the default)
+
+servo backends are rpi (adafruit ServoKit), simulated (Fake_ServoKit) and auto.
+
+choose with the BEAMBREAK_BACKEND environment variable (BEAMBREAK_SERVO_BACKEND overrides it for the HAT),
+or in code with GPIO.use('sampled', rate = 1000) before anything touches a pin.
+'''
+import os
+import threading
+from session_clock import CLOCK
+
+BACKEND_ENV = 'BEAMBREAK_BACKEND'
+SERVO_BACKEND_ENV = 'BEAMBREAK_SERVO_BACKEND'
+
+GPIO_BACKENDS = {}
+SERVO_BACKENDS = {}
+
+def register_gpio_backend(name, factory):
+    '''factory(**options) returns an object that behaves like the RPi.GPIO module'''
+    GPIO_BACKENDS[name] = factory
+
+def register_servo_backend(name, factory):
+    '''factory(**options) returns an object that behaves like adafruit_servokit.ServoKit'''
+    SERVO_BACKENDS[name] = factory
+
+
+class Recording_GPIO:
+    '''passes everything through to gpio and keeps (CLOCK ns, function name, args, kwargs) for every call'''
+    def __init__(self, gpio):
+        self._gpio = gpio
+        self.calls = []
+
+    def __getattr__(self, name):
+        attr = getattr(self._gpio, name)
+        if not callable(attr):
+            return attr
+        def recorded(*args, **kwargs):
+            self.calls.append((CLOCK.now_ns(), name, args, kwargs))
+            return attr(*args, **kwargs)
+        return recorded
+
+
+def rpi_gpio():
+    import RPi.GPIO as GPIO
+    GPIO.setmode(GPIO.BCM)
+    return GPIO
+
+def simulated_gpio():
+    from Fake_handlers import Simulated_GPIO
+    gpio = Simulated_GPIO()
+    gpio.setmode(gpio.BCM)
+    return gpio
+
+def auto_gpio():
+    try:
+        return rpi_gpio()
+    except (ImportError, RuntimeError):
+        print('RPi.GPIO not found --> using simulated GPIO')
+        return simulated_gpio()
+
+def recorder_gpio(wrap = 'auto', **options):
+    return Recording_GPIO(GPIO_BACKENDS[wrap](**options))
+
+def sampled_gpio(wrap = 'auto', **options):
+    from pin_sampler import Sampled_GPIO
+    return Sampled_GPIO(GPIO_BACKENDS[wrap](), **options)
+
+def rpi_servokit(channels = 16):
+    from adafruit_servokit import ServoKit
+    return ServoKit(channels = channels)
+
+def simulated_servokit(channels = 16):
+    from Fake_handlers import Fake_ServoKit
+    return Fake_ServoKit(channels = channels)
+
+def auto_servokit(channels = 16):
+    try:
+        return rpi_servokit(channels)
+    except Exception as e:
+        print(e)
+        print('servokit not found --> using fake servokit')
+        return simulated_servokit(channels)
+
+register_gpio_backend('rpi', rpi_gpio)
+register_gpio_backend('simulated', simulated_gpio)
+register_gpio_backend('auto', auto_gpio)
+register_gpio_backend('recorder', recorder_gpio)
+register_gpio_backend('sampled', sampled_gpio)
+register_servo_backend('rpi', rpi_servokit)
+register_servo_backend('simulated', simulated_servokit)
+register_servo_backend('auto', auto_servokit)
+
+
+class Lazy_Backend:
+    '''stands in for the GPIO module or the ServoKit. the backend is built the first time any attribute is used,
+    so importing components never touches hardware'''
+
+    def __init__(self, kind, backends, env_vars, default = 'auto'):
+        self._kind = kind
+        self._backends = backends
+        self._env_vars = env_vars
+        self._default = default
+        self._name = None
+        self._options = {}
+        self._target = None
+        self._lock = threading.Lock()
+
+    def use(self, name, **options):
+        '''choose the backend. only allowed before first use'''
+        if self._target is not None:
+            raise Exception(f'{self._kind} backend is already open as {self._name}, choose one before anything uses it')
+        if name not in self._backends:
+            raise Exception(f'unknown {self._kind} backend {name}, expected one of {sorted(self._backends)}')
+        self._name, self._options = name, options
+
+    def backend_name(self):
+        if self._name is not None:
+            return self._name
+        for env_var in self._env_vars:
+            if os.environ.get(env_var):
+                return os.environ[env_var]
+        return self._default
+
+    def is_open(self):
+        return self._target is not None
+
+    def open(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    name = self.backend_name()
+                    #gpio-only backends (recorder, sampled) leave the servo side on auto
+                    factory = self._backends.get(name, self._backends[self._default])
+                    self._name = name
+                    self._target = factory(**self._options)
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self.open(), name)
+
+
+GPIO = Lazy_Backend('gpio', GPIO_BACKENDS, [BACKEND_ENV])
+SERVO_KIT = Lazy_Backend('servo', SERVO_BACKENDS, [SERVO_BACKEND_ENV, BACKEND_ENV])
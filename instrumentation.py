@@ -0,0 +1,246 @@
+'''hot path timings of a live session, as histograms per stage, box and pin.
+
+    beambreak_confirm_seconds          edge -> the Confirmation_Engine's decision, per pin and outcome (confirmed,
+                                       sampled: passed on the failure sampling, failed)
+    beambreak_edge_callback_seconds    how long each edge holds the GPIO callback thread in Edge_Dispatcher, per pin
+    beambreak_executor_queue_depth     thread_it lane queue depth at every submit, per lane (one lane per box)
+    beambreak_executor_wait_seconds    queued -> started on a lane
+    beambreak_executor_run_seconds     started -> finished on a lane
+    beambreak_writer_backlog           lines waiting for the Timestamp_Writer_Thread each time it wakes
+    beambreak_writer_flush_seconds     each flush (and fsync) of a file
+    beambreak_transition_seconds       edge -> the state change's line being written, per box and event
+
+each observation is a bisect and a few additions on a fixed bucket array, cheap enough for every edge. software:
+metrics: false turns recording off. METRICS.exposition() is the prometheus text format, with a few gauges and
+counters read when it is made (queued lines, edge dispatcher counts). Metrics_Exporter rewrites it to a stats file
+every interval seconds (the node_exporter textfile format, so a scrape of the file works too) and can serve it
+on a localhost port and/or a unix socket:
+
+    curl localhost:9109/metrics
+    curl --unix-socket /tmp/beambreak_metrics.sock localhost/metrics
+'''
+import http.server
+import math
+import os
+import socketserver
+import threading
+from running_stats import Bucket_Histogram
+from timer_scheduler import Timer_Scheduler
+
+#seconds, 10 us to 50 s in 1-2-5 steps
+SECONDS_BOUNDS = tuple(float(f'{m}e{e}') for e in range(-5, 2) for m in (1, 2, 5))
+DEPTH_BOUNDS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+HELP = {'beambreak_confirm_seconds':'edge to the confirmation decision',
+        'beambreak_edge_callback_seconds':'time an edge holds the gpio callback thread',
+        'beambreak_executor_queue_depth':'thread_it lane queue depth at submit',
+        'beambreak_executor_wait_seconds':'thread_it work queued to started',
+        'beambreak_executor_run_seconds':'thread_it work started to finished',
+        'beambreak_executor_queued':'thread_it work queued now',
+        'beambreak_writer_backlog':'lines waiting when the timestamp writer wakes',
+        'beambreak_writer_flush_seconds':'timestamp writer flush (and fsync) of one file',
+        'beambreak_writer_queued':'lines waiting for the timestamp writer now',
+        'beambreak_transition_seconds':'edge to the state change being written',
+        'beambreak_edges_total':'edges through the edge dispatcher by what happened to them',
+        'beambreak_ring_depth':'records waiting in a worker ring'}
+
+
+class Null_Histogram:
+    '''what METRICS hands out while recording is off'''
+    def add(self, value):
+        pass
+
+NULL_HISTOGRAM = Null_Histogram()
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def label_string(labels):
+    return ','.join(f'{name}="{escape(value)}"' for name, value in labels)
+
+
+class Metrics_Registry:
+    '''histograms by name and labels, made on first use. hot paths keep the histogram they are given rather than
+    looking it up per event where they can'''
+
+    def __init__(self):
+        self.enabled = True
+        self.pin_boxes = {}
+        self.histograms = {}
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, bounds = SECONDS_BOUNDS, **labels):
+        if not self.enabled:
+            return NULL_HISTOGRAM
+        key = tuple(labels.items())
+        series = self.histograms.get(name)
+        histogram = series.get(key) if series is not None else None
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, {}).setdefault(key, Bucket_Histogram(bounds))
+        return histogram
+
+    def pin_histogram(self, name, pin, **labels):
+        '''histogram labelled with pin and the box it is wired to (see map_pins)'''
+        return self.histogram(name, box = self.pin_boxes.get(pin, ''), pin = pin, **labels)
+
+    def map_pins(self, hardware):
+        '''pin -> box from the hardware section. led entries are HAT channels, not pins'''
+        for box_ID, parts in hardware.items():
+            for name, value in parts.items():
+                pin = value.get('pin') if isinstance(value, dict) else value
+                if 'led' not in name and isinstance(pin, int):
+                    self.pin_boxes[pin] = box_ID
+
+    def add_gauge(self, name, func, **labels):
+        '''func() is read every time the metrics are exposed. the same name and labels replace the old one'''
+        self._add_sample(name, 'gauge', func, labels)
+
+    def add_counter(self, name, func, **labels):
+        self._add_sample(name, 'counter', func, labels)
+
+    def _add_sample(self, name, kind, func, labels):
+        with self._lock:
+            self.samples.setdefault(name, (kind, {}))[1][tuple(labels.items())] = func
+
+    def exposition(self):
+        '''every metric in the prometheus text format'''
+        lines = []
+        for name, series in sorted(list(self.histograms.items())):
+            lines += [f'# HELP {name} {HELP.get(name, name)}', f'# TYPE {name} histogram']
+            for key, histogram in list(series.items()):
+                labels = label_string(key)
+                prefix = labels + ',' if labels else ''
+                cumulative = 0
+                for bound, count in zip(histogram.bounds + (math.inf,), list(histogram.counts)):
+                    cumulative += count
+                    lines += [f'{name}_bucket{{{prefix}le="{"+Inf" if bound == math.inf else repr(bound)}"}} {cumulative}']
+                lines += [f'{name}_sum{{{labels}}} {histogram.sum!r}', f'{name}_count{{{labels}}} {cumulative}']
+        for name, (kind, series) in sorted(list(self.samples.items())):
+            lines += [f'# HELP {name} {HELP.get(name, name)}', f'# TYPE {name} {kind}']
+            for key, func in list(series.items()):
+                try:
+                    value = func()
+                except Exception:
+                    continue
+                lines += [f'{name}{{{label_string(key)}}} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        '''one line per histogram, all its series together, and the series with the worst p99'''
+        lines = [f"{'metric':<34}{'count':>9}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}  worst p99"]
+        for name, series in sorted(list(self.histograms.items())):
+            series = [(key, histogram) for key, histogram in list(series.items()) if histogram.count]
+            if not series:
+                continue
+            total = Bucket_Histogram(series[0][1].bounds)
+            for _, histogram in series:
+                total.merge(histogram)
+            key, worst = max(series, key = lambda item: item[1].percentile(99))
+            scale, unit = (1e3, ' ms') if name.endswith('_seconds') else (1, '')
+            values = ''.join(f'{total.percentile(q)*scale:>10.2f}' for q in (50, 90, 99)) + f'{total.max*scale:>10.2f}'
+            lines += [f'{name[len("beambreak_"):] + unit:<34}{total.count:>9}{values}  {label_string(key)} '
+                      f'{worst.percentile(99)*scale:.2f}']
+        return '\n'.join(lines)
+
+    def clear(self):
+        with self._lock:
+            self.histograms = {}
+            self.samples = {}
+
+
+class Metrics_Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        #unix socket clients have no address
+        return 'local'
+
+    def log_message(self, *args):
+        pass
+
+
+class Unix_Metrics_Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+class Metrics_Exporter:
+    '''writes registry.exposition() to fpath every interval seconds (atomically, like the summary csv) and serves it
+    on host:port and/or socket_path while started'''
+
+    def __init__(self, registry, fpath = None, interval = 10, port = None, host = '127.0.0.1', socket_path = None,
+                 scheduler = None):
+        self.registry = registry
+        self.fpath = fpath
+        self.interval = interval
+        self.port = port
+        self.host = host
+        self.socket_path = socket_path
+        self.owns_scheduler = scheduler is None
+        self.scheduler = scheduler if scheduler else Timer_Scheduler('metrics_exporter')
+        self.servers = []
+        self.writes = 0
+        self.stopped = False
+
+    def start(self):
+        if self.port is not None:
+            self._serve(http.server.ThreadingHTTPServer((self.host, self.port), Metrics_Handler))
+            print(f'metrics on http://{self.host}:{self.servers[-1].server_address[1]}/metrics')
+        if self.socket_path is not None:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self._serve(Unix_Metrics_Server(self.socket_path, Metrics_Handler))
+            print(f'metrics on unix socket {self.socket_path}')
+        if self.fpath is not None:
+            self.write()
+            self.scheduler.call_later(self.interval, self._tick)
+
+    def _serve(self, server):
+        server.registry = self.registry
+        threading.Thread(target = server.serve_forever, daemon = True, name = 'metrics_server').start()
+        self.servers += [server]
+
+    def write(self):
+        tmp = self.fpath + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.registry.exposition())
+        os.replace(tmp, self.fpath)
+        self.writes += 1
+
+    def _tick(self):
+        if self.stopped:
+            return
+        self.write()
+        self.scheduler.call_later(self.interval, self._tick)
+
+    def stop(self):
+        '''a last write of the stats file, then stop serving'''
+        self.stopped = True
+        if self.fpath is not None:
+            self.write()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        if self.owns_scheduler:
+            self.scheduler.shut_down()
+
+
+METRICS = Metrics_Registry()
@@ -0,0 +1,169 @@
+'''one scheduler for every LED on the PCA9685 HAT.
+
+LEDs only say what duty cycle they want. once per tick the scheduler works out every flash pattern, drops
+channels whose duty cycle hasn't changed, and writes the rest in one I2C transaction per run of consecutive
+channels (the PCA9685 auto-increments through the LEDn_ON/OFF registers). ticks sit on a fixed grid, so
+toggles that land in the same tick share a write, and ticks with nothing to toggle are skipped apart from
+checking each flash's interrupt_func every poll_interval. an idle scheduler doesn't tick.
+'''
+import math
+import threading
+import traceback
+from timer_scheduler import Timer_Scheduler
+
+LED0_ON_L = 0x06
+MODE1 = 0x00
+AUTO_INCREMENT = 0x20
+
+
+def pca9685_registers(duty_cycle):
+    '''the LEDn_ON_L, ON_H, OFF_L, OFF_H bytes adafruit_pca9685 writes for a 16 bit duty_cycle'''
+    if duty_cycle >= 0xFFFF:
+        on, off = 0x1000, 0
+    elif duty_cycle < 0x0010:
+        on, off = 0, 0x1000
+    else:
+        on, off = 0, duty_cycle >> 4
+    return [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+
+
+class Flash_Handle:
+    def __init__(self, scheduler, channel):
+        self.scheduler = scheduler
+        self.channel = channel
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        self.scheduler.stop_flash(self.channel, self)
+
+
+class LED_Scheduler:
+    '''owns every channel of pca. set() and flash() can be called from any thread; writes happen on the next tick'''
+
+    def __init__(self, pca, tick = 0.02, poll_interval = 0.1, scheduler = None):
+        self.pca = pca
+        self.tick = tick
+        self.poll_interval = poll_interval
+        self.scheduler = scheduler if scheduler else Timer_Scheduler('led_scheduler')
+        self.epoch = self.scheduler.clock()
+        self.desired = [0]*len(pca.channels)
+        self.written = [None]*len(pca.channels)
+        self.flashes = {}
+        self.ticking = False
+        self.next_tick = None
+        self.stats = {'ticks':0, 'transactions':0, 'channel_writes':0, 'unchanged':0}
+        self._lock = threading.Lock()
+        self._auto_increment_checked = False
+
+    def set(self, channel, duty_cycle):
+        with self._lock:
+            self.desired[channel] = duty_cycle
+            if duty_cycle == self.written[channel]:
+                self.stats['unchanged'] += 1
+                return
+            self._wake()
+
+    def flash(self, channel, frequency, interrupt_func, duty_cycle = 0xFFFF, on_done = None):
+        '''on for 1/2, off for 1/2 of frequency seconds until interrupt_func returns True, then on_done().
+        a new flash on a channel replaces the one already running there'''
+        handle = Flash_Handle(self, channel)
+        with self._lock:
+            start = self.scheduler.clock()
+            self.flashes[channel] = (handle, start, frequency/2, duty_cycle, interrupt_func, on_done)
+            self._wake()
+        return handle
+
+    def stop_flash(self, channel, handle = None):
+        with self._lock:
+            entry = self.flashes.get(channel)
+            if entry is not None and (handle is None or entry[0] is handle):
+                del self.flashes[channel]
+
+    def _wake(self):
+        if not self.ticking:
+            self.ticking = True
+            self.next_tick = self.scheduler.clock()
+            self.scheduler.call_at(self.next_tick, self._tick)
+
+    def _on_grid(self, t):
+        '''first tick at or after t'''
+        return self.epoch + math.ceil((t - self.epoch)/self.tick)*self.tick
+
+    def _tick(self):
+        finished = []
+        with self._lock:
+            now = self.scheduler.clock()
+            next_change = now + self.poll_interval
+            for channel, (handle, start, half, duty_cycle, interrupt_func, on_done) in list(self.flashes.items()):
+                try:
+                    interrupted = interrupt_func()
+                except Exception:
+                    traceback.print_exc()
+                    interrupted = True
+                if interrupted:
+                    del self.flashes[channel]
+                    self.desired[channel] = 0
+                    finished += [on_done]
+                else:
+                    phase = int((now - start)/half)
+                    self.desired[channel] = duty_cycle if phase % 2 == 0 else 0
+                    next_change = min(next_change, start + (phase + 1)*half)
+            changed = [channel for channel, duty_cycle in enumerate(self.desired) if duty_cycle != self.written[channel]]
+            for channel in changed:
+                self.written[channel] = self.desired[channel]
+            values = [self.desired[channel] for channel in changed]
+            self.stats['ticks'] += 1
+            if self.flashes:
+                #absolute grid times so the flash phase doesn't drift with however long the writes took
+                self.next_tick = max(self._on_grid(next_change), self._on_grid(now + self.tick/2))
+                self.scheduler.call_at(self.next_tick, self._tick)
+            else:
+                self.ticking = False
+        if changed:
+            self._write(changed, values)
+        for on_done in finished:
+            if on_done is not None:
+                on_done()
+
+    def _write(self, channels, values):
+        #split into runs of consecutive channels, one transaction each
+        runs = []
+        for channel, value in zip(channels, values):
+            if runs and runs[-1][0] + len(runs[-1][1]) == channel:
+                runs[-1][1].append(value)
+            else:
+                runs.append((channel, [value]))
+        for first, run_values in runs:
+            self.write_run(first, run_values)
+        self.stats['transactions'] += len(runs)
+        self.stats['channel_writes'] += len(channels)
+
+    def write_run(self, first, values):
+        i2c_device = getattr(self.pca, 'i2c_device', None)
+        if i2c_device is None:
+            #not an adafruit_pca9685 we can talk to directly, fall back to a write per channel
+            for channel, value in enumerate(values, first):
+                self.pca.channels[channel].duty_cycle = value
+            return
+        if not self._auto_increment_checked:
+            mode1 = self.pca.mode1_reg
+            if not mode1 & AUTO_INCREMENT:
+                self.pca.mode1_reg = mode1 | AUTO_INCREMENT
+            self._auto_increment_checked = True
+        data = [LED0_ON_L + 4*first]
+        for value in values:
+            data += pca9685_registers(value)
+        with i2c_device as i2c:
+            i2c.write(bytes(data))
+
+    def shut_down(self):
+        '''everything off, written straight away'''
+        with self._lock:
+            self.flashes.clear()
+            self.desired = [0]*len(self.desired)
+            changed = [channel for channel, value in enumerate(self.written) if value != 0]
+            for channel in changed:
+                self.written[channel] = 0
+        if changed:
+            self._write(changed, [0]*len(changed))
@@ -0,0 +1,203 @@
+'''the session summary csv, kept up to date while the session runs.
+
+Live_Summary listens to every box's TimestampManager (see TimestampManager.add_listener) and folds each line into
+running aggregates as it is written: per box and traversal side the traversal count, latency mean and
+percentiles, rewards completed and canceled, and per top beam the breaks and time broken. each event is a few
+dict lookups and additions, nothing is kept per event.
+
+every interval seconds, if anything changed, the summary is written to a temp file and moved over the old one,
+so the file on disk is always a whole summary and a crashed session still leaves one behind. status is
+'running' until the final write at the end of the session, then 'done'.
+
+the first columns are the old end-of-run summary's (box, animal, IR_k_traversals, IR_k_notes, novel_ID).
+'''
+import csv
+import os
+import threading
+from running_stats import Running_Stats, Log_Histogram
+from timer_scheduler import Timer_Scheduler
+
+PERCENTILES = (50, 90)
+
+
+class Side_Aggregate:
+    def __init__(self, notes = ''):
+        self.notes = notes
+        self.traversals = 0
+        self.latency = Running_Stats()
+        self.latency_histogram = Log_Histogram()
+        self.rewards_completed = 0
+        self.rewards_canceled = 0
+        self.cancel_latency = Running_Stats()
+
+
+class Top_Aggregate:
+    def __init__(self):
+        self.breaks = 0
+        self.time_broken = 0.0
+        self.duration = Running_Stats()
+
+
+class Box_Aggregate:
+    def __init__(self):
+        self.sides = {}
+        self.tops = {}
+        self.resets = 0
+        self.events = 0
+        self.elapsed_time = 0.0
+
+    def side(self, k, notes = ''):
+        side = self.sides.get(k)
+        if side is None:
+            side = self.sides[k] = Side_Aggregate(notes)
+        elif notes and not side.notes:
+            side.notes = notes
+        return side
+
+    def add(self, beam, elapsed_time, event, latency, notes):
+        self.events += 1
+        self.elapsed_time = max(self.elapsed_time, elapsed_time)
+        if event.endswith(' traversal'):
+            side = self.side(int(beam), notes)
+            side.traversals += 1
+            if latency is not None:
+                side.latency.add(latency)
+                side.latency_histogram.add(latency)
+        elif event == 'reward_period_end':
+            self.side(int(beam), notes).rewards_completed += 1
+        elif event == 'reward_canceled':
+            side = self.side(int(beam), notes)
+            side.rewards_canceled += 1
+            if latency is not None:
+                side.cancel_latency.add(latency)
+        elif event == 'beam_break_duration':
+            top = self.tops.get(str(beam))
+            if top is None:
+                top = self.tops[str(beam)] = Top_Aggregate()
+            top.breaks += 1
+            if latency is not None:
+                top.time_broken += latency
+                top.duration.add(latency)
+        elif event == 'reset':
+            self.resets += 1
+
+
+def number(value):
+    return '' if value is None else round(value, 6)
+
+
+class Live_Summary:
+
+    def __init__(self, config_dict, fpath, interval = 5, n_beams = 2, scheduler = None):
+        self.config_dict = config_dict
+        self.fpath = fpath
+        self.interval = interval
+        self.n_beams = n_beams
+        self.boxes = {box_ID:Box_Aggregate() for box_ID in config_dict['hardware']}
+        self.owns_scheduler = scheduler is None
+        self.scheduler = scheduler if scheduler else Timer_Scheduler('live_summary')
+        self.status = 'running'
+        self.dirty = True
+        self.writes = 0
+        self.stopped = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def attach(self, manager):
+        manager.add_listener(self.record)
+        return manager
+
+    def record(self, line, edge_ns = None, dispatch_delay_ns = None):
+        ID, beam, elapsed_time, event, count, latency, notes = line
+        with self._lock:
+            box = self.boxes.get(ID)
+            if box is None:
+                box = self.boxes[ID] = Box_Aggregate()
+            box.add(beam, float(elapsed_time), event, None if latency in ('', None) else float(latency), notes)
+            self.dirty = True
+
+    def add_boxes(self, boxes):
+        '''sides and notes from the boxes themselves (their ir_pair's traversal_counts and notes_k), so sides without
+        a traversal still get their columns'''
+        with self._lock:
+            for box in boxes:
+                aggregate = self.boxes.setdefault(box.name, Box_Aggregate())
+                for k in box.ir_pair.traversal_counts:
+                    aggregate.side(k, getattr(box.ir_pair, f'notes_{k}', '') or '')
+            self.dirty = True
+
+    def rows(self):
+        with self._lock:
+            n_beams = max([self.n_beams] + [k for box in self.boxes.values() for k in box.sides])
+            n_tops = max([0] + [len(box.tops) for box in self.boxes.values()])
+            header = ['box', 'animal']
+            for k in range(1, n_beams + 1):
+                header += [f'IR_{k}_traversals', f'IR_{k}_notes']
+            header += ['novel_ID', 'status', 'session_s', 'events', 'resets']
+            for k in range(1, n_beams + 1):
+                header += [f'IR_{k}_latency_mean', f'IR_{k}_latency_std'] + [f'IR_{k}_latency_p{q}' for q in PERCENTILES]
+                header += [f'IR_{k}_rewards_completed', f'IR_{k}_rewards_canceled', f'IR_{k}_cancel_rate',
+                           f'IR_{k}_cancel_latency_mean']
+            for t in range(1, n_tops + 1):
+                header += [f'top_{t}', f'top_{t}_breaks', f'top_{t}_time_broken', f'top_{t}_duration_mean',
+                           f'top_{t}_duration_max']
+            rows = [header]
+            for box_ID, box in self.boxes.items():
+                animals = self.config_dict['animals'].get(box_ID, {})
+                sides = [box.sides.get(k) for k in range(1, n_beams + 1)]
+                row = [box_ID, animals.get('focal', '')]
+                for side in sides:
+                    row += [side.traversals, side.notes] if side else ['', '']
+                row += [animals.get('novel', ''), self.status, number(box.elapsed_time), box.events, box.resets]
+                for side in sides:
+                    if side is None:
+                        row += ['']*(6 + len(PERCENTILES))
+                        continue
+                    latency = side.latency
+                    row += [number(latency.mean if latency.count else None), number(latency.std() if latency.count else None)]
+                    row += [number(side.latency_histogram.percentile(q)) for q in PERCENTILES]
+                    row += [side.rewards_completed, side.rewards_canceled,
+                            number(side.rewards_canceled/side.traversals if side.traversals else None),
+                            number(side.cancel_latency.mean if side.cancel_latency.count else None)]
+                tops = list(box.tops.items())
+                for t in range(n_tops):
+                    if t >= len(tops):
+                        row += ['']*5
+                        continue
+                    name, top = tops[t]
+                    row += [name, top.breaks, number(top.time_broken), number(top.duration.mean if top.duration.count else None),
+                            number(top.duration.max if top.duration.count else None)]
+                rows += [row]
+            self.dirty = False
+        return rows
+
+    def write(self):
+        '''replace the summary file with the current aggregates, atomically'''
+        with self._write_lock:
+            rows = self.rows()
+            tmp = self.fpath + '.tmp'
+            with open(tmp, 'w', newline = '') as f:
+                csv.writer(f).writerows(rows)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.fpath)
+            self.writes += 1
+
+    def start(self):
+        self.write()
+        self.scheduler.call_later(self.interval, self._tick)
+
+    def _tick(self):
+        if self.stopped:
+            return
+        if self.dirty:
+            self.write()
+        self.scheduler.call_later(self.interval, self._tick)
+
+    def stop(self, status = 'done'):
+        '''the final write'''
+        self.stopped = True
+        self.status = status
+        self.write()
+        if self.owns_scheduler:
+            self.scheduler.shut_down()
@@ -0,0 +1,150 @@
+'''live pin status for the set up scripts.
+
+Pin_State_Snapshot reads every pin from one thread at a fixed rate (or straight from a Pin_Sampler when the GPIO
+is sampled) and keeps per pin level, edge counts, edge rate and the time of the last change.
+Pin_Dashboard draws the table once and then only rewrites the cells whose text changed, so the terminal never
+clears or flickers and the cost stays the same however many boxes are wired up.
+'''
+import collections
+import sys
+import threading
+import time
+from timer_scheduler import Deadline_Sampler
+from session_clock import CLOCK
+
+
+class Pin_State:
+    def __init__(self, level):
+        self.level = level
+        self.edges = 0
+        self.last_change_ns = None
+        self.recent = collections.deque()
+
+
+class Pin_State_Snapshot:
+    '''shared, read-only view of pin levels for anything that wants to display them. rate is edges per second over
+    the last rate_window seconds'''
+
+    def __init__(self, gpio, pins, poll_rate = 100, rate_window = 10):
+        self.gpio = gpio
+        self.pins = list(dict.fromkeys(pins))
+        self.rate_window_ns = int(rate_window*1e9)
+        self._lock = threading.Lock()
+        self.states = {pin:Pin_State(level) for pin, level in self._read().items()}
+        self.sampler = Deadline_Sampler(1/poll_rate)
+        self._thread = None
+
+    def _read(self):
+        sampler = getattr(self.gpio, 'sampler', None)
+        if sampler is not None and sampler._thread is not None:
+            latest = sampler.latest()
+            return {pin:latest[pin] if pin in latest else self.gpio.input(pin) for pin in self.pins}
+        return {pin:self.gpio.input(pin) for pin in self.pins}
+
+    def poll(self):
+        now = CLOCK.now_ns()
+        levels = self._read()
+        with self._lock:
+            for pin, level in levels.items():
+                state = self.states[pin]
+                if level != state.level:
+                    state.level = level
+                    state.edges += 1
+                    state.last_change_ns = now
+                    state.recent.append(now)
+                while state.recent and now - state.recent[0] > self.rate_window_ns:
+                    state.recent.popleft()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target = self.sampler.run, args = (self.poll,), daemon = True, name = 'pin_state_snapshot')
+            self._thread.start()
+
+    def stop(self):
+        self.sampler.stop()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def read(self):
+        '''{pin: (level, edges, edges per second, seconds since the last change or None)}'''
+        now = CLOCK.now_ns()
+        with self._lock:
+            return {pin:(s.level, s.edges, len(s.recent)*1e9/self.rate_window_ns,
+                         None if s.last_change_ns is None else (now - s.last_change_ns)/1e9)
+                    for pin, s in self.states.items()}
+
+
+class Pin_Dashboard:
+    '''one row per beam. rows is a list of (box, beam, pin, blocked_value)'''
+    columns = [('box', 10), ('beam', 6), ('pin', 5), ('state', 9), ('edges', 8), ('rate/s', 8), ('since', 9)]
+
+    def __init__(self, snapshot, rows, refresh = 0.2, out = sys.stdout):
+        self.snapshot = snapshot
+        self.rows = rows
+        self.refresh = refresh
+        self.out = out
+        self.cells = {}
+        self.running = False
+        self.offsets = []
+        x = 1
+        for _, width in self.columns:
+            self.offsets += [x]
+            x += width + 1
+
+    def cell_text(self, row, column, reading):
+        box, beam, pin, blocked_value = row
+        level, edges, rate, since = reading
+        return [str(box), str(beam), str(pin), 'BLOCKED' if level == blocked_value else 'clear', str(edges),
+                f'{rate:.2f}', '-' if since is None else (f'{since:.1f}s' if since < 60 else f'{int(since)}s')][column]
+
+    def draw_frame(self):
+        header = ''.join(name.ljust(width + 1) for name, width in self.columns)
+        self.out.write('\033[2J\033[H\033[?25l' + header + '\n' + '-'*len(header))
+        self.cells = {}
+
+    def frame(self):
+        '''escape codes that bring the screen up to date, rewriting only cells whose text changed'''
+        readings = self.snapshot.read()
+        updates = []
+        for r, row in enumerate(self.rows):
+            reading = readings[row[2]]
+            for c, (_, width) in enumerate(self.columns):
+                text = self.cell_text(row, c, reading)[:width].ljust(width)
+                if self.cells.get((r, c)) != text:
+                    self.cells[(r, c)] = text
+                    updates += [f'\033[{r + 3};{self.offsets[c]}H{text}']
+        if updates:
+            updates += [f'\033[{len(self.rows) + 3};1H']
+        return ''.join(updates)
+
+    def run(self, duration = None):
+        '''redraws until stopped, interrupted or duration seconds have passed'''
+        self.running = True
+        self.snapshot.start()
+        self.draw_frame()
+        end = None if duration is None else time.perf_counter() + duration
+        try:
+            while self.running and (end is None or time.perf_counter() < end):
+                update = self.frame()
+                if update:
+                    self.out.write(update)
+                    self.out.flush()
+                time.sleep(self.refresh)
+        finally:
+            self.out.write(f'\033[{len(self.rows) + 3};1H\033[?25h\n')
+            self.out.flush()
+            self.snapshot.stop()
+
+    def stop(self):
+        self.running = False
+
+
+def beam_rows(boxes, beam_names):
+    '''dashboard rows for boxes built by the set up scripts, eg beam_rows(boxes, ['beambreak_1', 'beambreak_2'])'''
+    rows = []
+    for box in boxes:
+        for beam_name in beam_names:
+            beam = getattr(box.ir_pair, beam_name)
+            rows += [(box.name, beam_name.replace('beambreak_', 'ir_'), beam.pin, beam.blocked_value)]
+    return rows
@@ -0,0 +1,227 @@
+'''optional acquisition mode: one thread samples every pin at a fixed rate instead of each component registering
+its own edge interrupt.
+
+levels go into a preallocated (time x pin) numpy ring, and edges are found by diffing each new block of samples
+in one vectorized step. subscribers get (pin, level, t_ns) for the edges they asked for, from a single dispatch
+thread so slow callbacks never push the sampler off its deadlines. cpu cost is rate x pins and doesn't grow with
+how many edges or callbacks there are.
+
+Sampled_GPIO wraps a GPIO module so the existing components work unchanged on top of a sampler. it's the
+'sampled' hardware backend:
+
+    from components import GPIO
+    GPIO.use('sampled', rate = 1000)
+
+edges reach callbacks at most about dispatch_interval after they're sampled, and are only as precise as 1/rate.
+during a callback, edge_time_ns(pin) is the time of the sample that found the edge (the Edge_Dispatcher uses it).
+'''
+import queue
+import threading
+import traceback
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from timer_scheduler import Deadline_Sampler
+from session_clock import CLOCK
+
+RISING = 1
+FALLING = -1
+BOTH = 0
+
+
+class Pin_Sampler:
+    '''reads all pins every 1/rate seconds. read_bank, if given, returns the 32 bit level word for gpios 0-31 in one
+    call (pigpio's pi.read_bank_1) and is used instead of a gpio.input per pin'''
+
+    def __init__(self, gpio = None, pins = (), rate = 1000, history = 2.0, dispatch_interval = 0.005, read_bank = None):
+        if np is None:
+            raise Exception('Pin_Sampler needs numpy')
+        self.gpio = gpio
+        self.rate = rate
+        self.read_bank = read_bank
+        self.history = max(int(rate*history), 2)
+        self.dispatch_every = max(int(rate*dispatch_interval), 1)
+        self.pins = []
+        self.subscribers = {}
+        self.levels = np.zeros((self.history, 0), dtype = np.uint8)
+        self.times = np.zeros(self.history, dtype = np.int64)
+        self.count = 0
+        self.dispatched = 0
+        self.edges_found = 0
+        self._lock = threading.Lock()
+        self._edges = queue.SimpleQueue()
+        self.sampler = Deadline_Sampler(1/rate, spin_window = 0)
+        self._thread = None
+        self._dispatch_thread = None
+        for pin in pins:
+            self.add_pin(pin)
+
+    def add_pin(self, pin):
+        '''pins can be added while running; the ring is rebuilt and history for the new pin starts now'''
+        with self._lock:
+            if pin in self.pins:
+                return
+            self.pins.append(pin)
+            self._shifts = np.array(self.pins, dtype = np.uint32)
+            self.levels = np.concatenate([self.levels, np.zeros((self.history, 1), dtype = np.uint8)], axis = 1)
+            #fill the new column with the pin's current level so its first diff isn't a false edge
+            self.levels[:, -1] = self._read_row()[-1]
+
+    def subscribe(self, pin, callback, edge = BOTH):
+        '''callback(pin, level, t_ns) for every edge of the given direction on pin'''
+        self.add_pin(pin)
+        self.subscribers.setdefault(pin, []).append((edge, callback))
+
+    def unsubscribe(self, pin, callback = None):
+        if callback is None:
+            self.subscribers.pop(pin, None)
+        else:
+            self.subscribers[pin] = [entry for entry in self.subscribers.get(pin, []) if entry[1] != callback]
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target = self.sampler.run, args = (self._sample,), daemon = True, name = 'pin_sampler')
+        self._dispatch_thread = threading.Thread(target = self._dispatch, daemon = True, name = 'pin_sampler_dispatch')
+        self._dispatch_thread.start()
+        self._thread.start()
+
+    def stop(self):
+        self.sampler.stop()
+        if self._thread is not None:
+            self._thread.join()
+            self._edges.put(None)
+            self._dispatch_thread.join()
+        self._thread = None
+
+    def level(self, pin):
+        '''most recent sampled level of pin'''
+        with self._lock:
+            return int(self.levels[(self.count - 1) % self.history, self.pins.index(pin)])
+
+    def latest(self):
+        '''{pin: level} for every sampled pin, from one sample'''
+        with self._lock:
+            row = self.levels[(self.count - 1) % self.history]
+            return dict(zip(self.pins, row.tolist()))
+
+    def window(self, seconds = None):
+        '''copies of (times, levels) for the last seconds of samples, oldest first'''
+        with self._lock:
+            n = min(self.count, self.history if seconds is None else int(seconds*self.rate))
+            index = np.arange(self.count - n, self.count) % self.history
+            return self.times[index], self.levels[index], list(self.pins)
+
+    def _read_row(self):
+        if self.read_bank is not None:
+            return (np.uint32(self.read_bank()) >> self._shifts) & 1
+        return [self.gpio.input(pin) for pin in self.pins]
+
+    def _sample(self):
+        with self._lock:
+            i = self.count % self.history
+            self.levels[i] = self._read_row()
+            self.times[i] = CLOCK.now_ns()
+            self.count += 1
+            if self.count - self.dispatched >= self.dispatch_every:
+                self._find_edges()
+
+    def _find_edges(self):
+        #diff the new block against the last sample already checked, all pins at once
+        start = max(self.dispatched - 1, 0, self.count - self.history)
+        index = np.arange(start, self.count) % self.history
+        block = self.levels[index].astype(np.int8)
+        rows, cols = np.nonzero(np.diff(block, axis = 0))
+        self.dispatched = self.count
+        if len(rows):
+            self.edges_found += len(rows)
+            times = self.times[index[rows + 1]]
+            levels = block[rows + 1, cols]
+            self._edges.put((times.tolist(), [self.pins[c] for c in cols.tolist()], levels.tolist()))
+
+    def _dispatch(self):
+        while True:
+            batch = self._edges.get()
+            if batch is None:
+                return
+            for t_ns, pin, level in zip(*batch):
+                direction = RISING if level else FALLING
+                for edge, callback in self.subscribers.get(pin, ()):
+                    if edge == BOTH or edge == direction:
+                        try:
+                            callback(pin, level, t_ns)
+                        except Exception:
+                            traceback.print_exc()
+
+    def stats(self):
+        s = self.sampler.stats()
+        s.update({'pins':len(self.pins), 'rate':self.rate, 'edges':self.edges_found})
+        return s
+
+
+class Sampled_GPIO:
+    '''stands in for a GPIO module: setup/output/cleanup go to the wrapped module, while edge detection and input()
+    on sampled pins come from a Pin_Sampler. bouncetime is applied in software from the sample timestamps'''
+
+    def __init__(self, gpio, rate = 1000, use_pigpio = True, **sampler_kwargs):
+        self._gpio = gpio
+        read_bank = None
+        if use_pigpio:
+            try:
+                import pigpio
+                pi = pigpio.pi()
+                if pi.connected:
+                    read_bank = pi.read_bank_1
+            except ImportError:
+                pass
+        self.sampler = Pin_Sampler(gpio, rate = rate, read_bank = read_bank, **sampler_kwargs)
+        self._callbacks = {}
+        self._detected = {}
+        self._edge_ns = {}
+
+    def __getattr__(self, name):
+        return getattr(self._gpio, name)
+
+    def input(self, pin):
+        if self.sampler._thread is not None and pin in self.sampler.pins:
+            return self.sampler.level(pin)
+        return self._gpio.input(pin)
+
+    def add_event_detect(self, pin, edge, callback = None, bouncetime = None):
+        if pin in self._callbacks:
+            raise RuntimeError('Conflicting edge detection already enabled for this GPIO channel')
+        direction = {self._gpio.RISING:RISING, self._gpio.FALLING:FALLING}.get(edge, BOTH)
+        self._callbacks[pin] = [callback] if callback else []
+        bounce_ns = bouncetime*1e6 if bouncetime else 0
+        last_ns = [None]
+        def on_edge(pin, level, t_ns):
+            if last_ns[0] is not None and t_ns - last_ns[0] < bounce_ns:
+                return
+            last_ns[0] = t_ns
+            self._detected[pin] = True
+            #callbacks that timestamp the edge ask for the sample's time (edge_time_ns), not when they got it
+            self._edge_ns[pin] = t_ns
+            for func in self._callbacks.get(pin, ()):
+                func(pin)
+        self.sampler.subscribe(pin, on_edge, direction)
+        self.sampler.start()
+
+    def add_event_callback(self, pin, callback):
+        self._callbacks[pin].append(callback)
+
+    def edge_time_ns(self, pin):
+        '''CLOCK time of the sample that found the edge being delivered on pin'''
+        return self._edge_ns.get(pin)
+
+    def remove_event_detect(self, pin):
+        self._callbacks.pop(pin, None)
+        self.sampler.unsubscribe(pin)
+
+    def event_detected(self, pin):
+        return self._detected.pop(pin, False)
+
+    def cleanup(self, *args):
+        self.sampler.stop()
+        self._callbacks.clear()
+        self._gpio.cleanup(*args)
@@ -1,6 +1,14 @@
-from components import thread_it, thread_executor
 import os
 import queue
+import threading
+import time
+import atexit
+import weakref
+import traceback
+import csv
+from binary_event_log import Binary_Event_Encoder, CLOCK_COLUMNS
+from session_clock import CLOCK
+from instrumentation import METRICS, DEPTH_BOUNDS
 
 def default_generate_output_fname(vole, date, vole_2 = None, title = ''):
         
@@ -14,44 +22,275 @@ def default_generate_output_fname(vole, date, vole_2 = None, title = ''):
         return fname
         
         
+class Flush_Policy:
+    def __init__(self, every_n = 50, every_ms = 250, on_state_change = True, fsync = False):
+        '''when the writer pushes buffered lines out to the file: after every_n lines, every_ms after the oldest
+        unflushed line, or straight away for lines marked as a state change. fsync also asks the OS to commit
+        flushed data to the SD card, which is slow but survives a power cut'''
+        self.every_n = every_n
+        self.every_ms = every_ms
+        self.on_state_change = on_state_change
+        self.fsync = fsync
+
+
+class Timestamp_Writer_Thread:
+    '''one long-lived thread that keeps the files of one or more TimestampManagers open, drains their
+    lines in batches and flushes on a Flush_Policy. one writer can be shared across all boxes'''
+
+    live_writers = weakref.WeakSet()
+    _close = object()
+    _stop = object()
+
+    def __init__(self, flush_policy = None, name = 'timestamp_writer', max_batch = 256):
+        self.flush_policy = flush_policy if flush_policy else Flush_Policy()
+        self.name = name
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.files = {}
+        self.thread = None
+        self._lock = threading.Lock()
+        self.backlog_histogram = METRICS.histogram('beambreak_writer_backlog', DEPTH_BOUNDS, writer = name)
+        self.flush_histogram = METRICS.histogram('beambreak_writer_flush_seconds', writer = name)
+        Timestamp_Writer_Thread.live_writers.add(self)
+
+    def submit(self, fp, data, state_change = False):
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target = self._run, daemon = True, name = self.name)
+                self.thread.start()
+            self.queue.put((fp, data, state_change))
+
+    def close_file(self, fp):
+        '''flush and close one file. blocks until every line submitted for it before this call is on disk'''
+        with self._lock:
+            if self.thread is None:
+                return
+            done = threading.Event()
+            self.queue.put((fp, self._close, done))
+        done.wait()
+
+    def shut_down(self):
+        '''write out everything that has been submitted, close all files and join the thread'''
+        with self._lock:
+            thread = self.thread
+            if thread is None:
+                return
+            self.queue.put((None, self._stop, None))
+        thread.join()
+
+    def backlog(self):
+        return self.queue.qsize()
+
+    def _open(self, fp, data):
+        entry = self.files.get(fp)
+        if entry is None:
+            entry = {'file':open(fp, 'ab' if isinstance(data, bytes) else 'a'), 'unflushed':0, 'oldest':None, 'flush_now':False}
+            self.files[fp] = entry
+        return entry
+
+    def _flush(self, entry):
+        start_ns = time.perf_counter_ns()
+        entry['file'].flush()
+        if self.flush_policy.fsync:
+            os.fsync(entry['file'].fileno())
+        self.flush_histogram.add((time.perf_counter_ns() - start_ns)/1e9)
+        entry['unflushed'] = 0
+        entry['oldest'] = None
+        entry['flush_now'] = False
+
+    def _close_entry(self, fp):
+        entry = self.files.pop(fp, None)
+        if entry is not None:
+            self._flush(entry)
+            entry['file'].close()
+
+    def _next_timeout(self):
+        if self.flush_policy.every_ms is None:
+            return None
+        oldest = [e['oldest'] for e in self.files.values() if e['oldest'] is not None]
+        if not oldest:
+            return None
+        return max(0, min(oldest) + self.flush_policy.every_ms/1000 - time.monotonic())
+
+    def _run(self):
+        policy = self.flush_policy
+        running = True
+        while True:
+            if running:
+                try:
+                    batch = [self.queue.get(timeout = self._next_timeout())]
+                    self.backlog_histogram.add(1 + self.queue.qsize())
+                except queue.Empty:
+                    batch = []
+            else:
+                #stopping: write whatever is left, and only exit once nothing can sneak in behind us
+                with self._lock:
+                    if self.queue.empty():
+                        for fp in list(self.files):
+                            self._close_entry(fp)
+                        self.thread = None
+                        return
+                batch = []
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for fp, data, extra in batch:
+                try:
+                    if data is self._stop:
+                        running = False
+                    elif data is self._close:
+                        self._close_entry(fp)
+                        extra.set()
+                    else:
+                        entry = self._open(fp, data)
+                        entry['file'].write(data)
+                        entry['unflushed'] += 1
+                        if entry['oldest'] is None:
+                            entry['oldest'] = time.monotonic()
+                        if extra and policy.on_state_change:
+                            entry['flush_now'] = True
+                except Exception:
+                    traceback.print_exc()
+
+            now = time.monotonic()
+            for entry in self.files.values():
+                if not entry['unflushed']:
+                    continue
+                if (entry['flush_now']
+                        or (policy.every_n and entry['unflushed'] >= policy.every_n)
+                        or (policy.every_ms is not None and now - entry['oldest'] >= policy.every_ms/1000)):
+                    self._flush(entry)
+
+class Buffered_Row_Writer:
+    '''csv writer that keeps its file open and holds rows in memory, writing them out together every
+    flush_rows rows or flush_interval seconds, whichever comes first. call close() when done
+    (also done at exit) so nothing is left in the buffer'''
+
+    live_writers = weakref.WeakSet()
+
+    def __init__(self, filepath, flush_interval = 5, flush_rows = 100, fsync = False):
+        self.filepath = filepath
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.fsync = fsync
+        self.file = open(filepath, 'a', newline = '', buffering = 1<<16)
+        self.writer = csv.writer(self.file)
+        self.rows = []
+        self.last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        Buffered_Row_Writer.live_writers.add(self)
+
+    def writerow(self, row):
+        with self._lock:
+            self.rows.append(row)
+            if len(self.rows) >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self.file.closed:
+            return
+        if self.rows:
+            self.writer.writerows(self.rows)
+            self.rows = []
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self.file.closed:
+                return
+            self._flush()
+            self.file.close()
+
+@atexit.register
+def _shut_down_live_writers():
+    '''writer threads are daemons, so get their buffered lines on disk before the interpreter goes away'''
+    for writer in list(Timestamp_Writer_Thread.live_writers):
+        writer.shut_down()
+    for writer in list(Buffered_Row_Writer.live_writers):
+        writer.close()
+
+
 class TimestampManager:
-    def __init__(self, path, fname, delimeter = ','):
-        ''''''
+    def __init__(self, path, fname, delimeter = ',', writer = None, flush_policy = None, log_format = 'csv', record_clocks = True,
+                 append = False):
+        '''pass a shared Timestamp_Writer_Thread as writer to have one thread write every box's file.
+        otherwise this manager gets its own writer, using flush_policy.
+        log_format = 'binary' writes fixed-width records instead of csv text, see binary_event_log.
+        record_clocks adds the edge's monotonic ns, its wall time and the dispatch delay (edge -> write_timestamp) to each line.
+        append carries on an existing file (a resumed session) instead of creating it'''
         print('making a timestamp writer')
         self.delimter = delimeter
         #list of values in header
 
         self.fp = os.path.join(path, fname)
-        self.queue = queue.Queue()
-        self.writing = False
+        self.log_format = log_format
+        self.record_clocks = record_clocks
+        self.append = append
+        self.encoder = None
+        self.owns_writer = writer is None
+        self.writer = Timestamp_Writer_Thread(flush_policy = flush_policy) if writer is None else writer
+        self.queue = self.writer.queue
+        self.listeners = []
         
     
     def create_file(self, header):
+        if self.record_clocks:
+            header = list(header) + CLOCK_COLUMNS
+        resuming = self.append and os.path.exists(self.fp)
+        if self.log_format == 'binary':
+            self.encoder = Binary_Event_Encoder(self.fp, header, clock = CLOCK)
+            if resuming:
+                self.encoder.table.load()
+                return
+            with open(self.fp, 'xb') as f:
+                f.write(self.encoder.file_header())
+            self.encoder.table.save()
+            return
+        if resuming:
+            return
         with open(self.fp, 'x') as f:
             header_string =  self.delimter.join(str(bit) for bit in header)
             f.write(header_string+'\n')            
     
+    def add_listener(self, listener):
+        '''listener(line, edge_ns, dispatch_delay_ns) is called with every line as it is written, on the writing thread.
+        keep it O(1)'''
+        self.listeners.append(listener)
+
     def shut_down(self):
-        if not self.queue.empty():
-            self._write_timestamp()
-            self.queue.join()
+        '''blocks until every line written so far is in the file'''
+        if self.owns_writer:
+            self.writer.shut_down()
+        else:
+            self.writer.close_file(self.fp)
             
-    def write_timestamp(self, line):
+    def write_timestamp(self, line, state_change = False, edge_ns = None):
+        '''edge_ns is the CLOCK time the event really happened (usually its GPIO edge). defaults to now'''
+        now = CLOCK.now_ns()
+        if edge_ns is None:
+            edge_ns = now
+        self.write_record(line, edge_ns, max(0, now - edge_ns), state_change)
+
+    def write_record(self, line, edge_ns, dispatch_delay_ns, state_change = False):
+        '''write_timestamp with the clocks already taken, eg by another process (see box_sharding)'''
+        for listener in self.listeners:
+            listener(line, edge_ns, dispatch_delay_ns)
+        if state_change:
+            METRICS.histogram('beambreak_transition_seconds', box = line[0], event = line[3]).add(dispatch_delay_ns/1e9)
+        if self.encoder is not None:
+            self.writer.submit(self.fp, self.encoder.encode(line, edge_ns, dispatch_delay_ns), state_change)
+            return
+        if self.record_clocks:
+            line = tuple(line) + (edge_ns, CLOCK.to_wall(edge_ns), dispatch_delay_ns/1e6)
         line_string =  self.delimter.join(str(bit) for bit in line)+'\n'
-        self.queue.put(line_string)
-        if not self.writing:
-            self._write_timestamp()
-            
-        
-    @thread_it 
-    def _write_timestamp(self):
-        self.writing = True
-        with open(self.fp, 'a') as f:
-            while not self.queue.empty():
-                f.write(self.queue.get())
-        self.writing = False
-                
-    
-        
-    
-    
\ No newline at end of file
+        self.writer.submit(self.fp, line_string, state_change)
@@ -0,0 +1,116 @@
+'''constant memory summary statistics and percentiles for values that arrive one at a time.'''
+import bisect
+import math
+
+
+class Running_Stats:
+    '''count, mean, standard deviation (welford), min and max without keeping the values'''
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta/self.count
+        self._m2 += delta*(value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def std(self):
+        return math.sqrt(self._m2/(self.count - 1)) if self.count > 1 else 0.0
+
+    def summary(self):
+        if not self.count:
+            return {'count':0, 'mean':None, 'std':None, 'min':None, 'max':None}
+        return {'count':self.count, 'mean':self.mean, 'std':self.std(), 'min':self.min, 'max':self.max}
+
+
+class Log_Histogram:
+    '''streaming percentiles: counts in log spaced buckets, so add() is O(1) and memory is fixed. a percentile is
+    the geometric middle of its bucket, within about 115/buckets_per_decade % of the true value (6 % by default).
+    values below low (zero included) share the first bucket, values above high the last'''
+
+    def __init__(self, low = 1e-4, high = 1e4, buckets_per_decade = 20):
+        self.low = low
+        self.scale = buckets_per_decade/math.log(10)
+        self.n_buckets = int(math.ceil(math.log(high/low)*self.scale)) + 2
+        self.counts = [0]*self.n_buckets
+        self.count = 0
+
+    def bucket(self, value):
+        if value < self.low:
+            return 0
+        return min(self.n_buckets - 1, 1 + int(math.log(value/self.low)*self.scale))
+
+    def add(self, value):
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+
+    def value_at(self, bucket):
+        if bucket == 0:
+            return self.low
+        return self.low*math.exp((bucket - 0.5)/self.scale)
+
+    def percentile(self, q):
+        '''q in 0-100. None before anything is added'''
+        if not self.count:
+            return None
+        rank = q/100*(self.count - 1)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen > rank:
+                return self.value_at(bucket)
+        return self.value_at(self.n_buckets - 1)
+
+    def percentiles(self, qs = (50, 90, 99)):
+        return {f'p{q}':self.percentile(q) for q in qs}
+
+
+class Bucket_Histogram:
+    '''counts against fixed upper bounds (a value lands in the first bucket whose bound it doesn't exceed, the
+    last bucket is everything above), the way a prometheus histogram keeps them. add() is a bisect and a few
+    additions. percentiles are interpolated inside their bucket'''
+
+    def __init__(self, bounds):
+        self.bounds = tuple(sorted(bounds))
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = -math.inf
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        '''fold in another histogram with the same bounds'''
+        for bucket, count in enumerate(other.counts):
+            self.counts[bucket] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        '''q in 0-100. None before anything is added'''
+        if not self.count:
+            return None
+        rank = q/100*self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[bucket - 1] if bucket else min(0, self.max)
+                upper = self.bounds[bucket] if bucket < len(self.bounds) else self.max
+                return min(self.max, lower + (upper - lower)*(rank - seen)/count)
+            seen += count
+        return self.max
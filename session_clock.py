@@ -0,0 +1,56 @@
+'''one monotonic, high resolution clock for the whole session, anchored once to wall time.
+
+event times are perf_counter nanoseconds taken in the GPIO callback, so they are not stretched by confirmation or
+thread hand-offs and an NTP step mid-session can't skew them. wall time is only derived from the anchor.
+
+use() swaps in another time source (anything with now_ns() and sleep(seconds)), which is how session_replay
+runs a recorded session on virtual time. continue_from() picks up an earlier run's timeline after a restart, see
+session_journal.'''
+import time
+
+
+class Session_Clock:
+    def __init__(self):
+        self.source = None
+        self.offset_ns = 0
+        self.anchor()
+
+    def use(self, source):
+        '''take time from source instead of the real clocks, and re-anchor. None goes back to real time'''
+        self.source = source
+        self.anchor()
+
+    def anchor(self):
+        '''pin monotonic time to wall time. call once at session start, before any events'''
+        self.offset_ns = 0
+        self.mono_anchor_ns = self.now_ns()
+        self.wall_anchor = time.time()
+
+    def continue_from(self, wall_anchor, mono_anchor_ns):
+        '''carry on an earlier session's timeline (its anchor), eg after a crash. perf_counter starts again on
+        reboot, so the gap is bridged through wall time and times stay comparable with the earlier run's'''
+        self.offset_ns = 0
+        self.offset_ns = mono_anchor_ns + int((time.time() - wall_anchor)*1e9) - self.now_ns()
+        self.mono_anchor_ns = mono_anchor_ns
+        self.wall_anchor = wall_anchor
+
+    def now_ns(self):
+        if self.source is not None:
+            return self.source.now_ns()
+        return time.perf_counter_ns() + self.offset_ns
+
+    def sleep(self, seconds):
+        '''time.sleep on the session's time'''
+        if self.source is not None:
+            self.source.sleep(seconds)
+        else:
+            time.sleep(seconds)
+
+    def to_wall(self, t_ns):
+        return self.wall_anchor + (t_ns - self.mono_anchor_ns)/1e9
+
+    def seconds_between(self, start_ns, end_ns):
+        return (end_ns - start_ns)/1e9
+
+
+CLOCK = Session_Clock()
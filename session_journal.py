@@ -0,0 +1,278 @@
+'''append-only journal of a session, for surviving a crash or a brown out.
+
+every line any box writes is also appended to the journal, along with a checkpoint of each box (state,
+traversal_counts, start_time, latency_from, elapsed) whenever its state changes and every checkpoint_interval
+seconds. the journal is json lines written by one thread with group commit: whatever has queued up is written
+and fsynced together, at most once per commit_interval, so fsync costs stay bounded however busy the session is
+and at most commit_interval of events is ever at risk. the per animal files are still written as before.
+
+after a crash, resume_session (session_orchestrator, or --resume on the run scripts) reads the journal back:
+    repair_logs appends any line the journal has that didn't reach a per animal file (csv or binary), after
+    cutting off a half written last line or record
+    the session clock carries on the old timeline (Session_Clock.continue_from), so edge_ns and wall_time stay
+    comparable, and the same files, summary and journal are appended to
+    each box that hadn't finished waits for its start press as usual, then carries on with its traversal counts
+    and elapsed time where they stopped (Session_Flags.resume). its total_time deadline is then only the time it
+    had left. time the session was down doesn't count. a box mid reward when it crashed starts again in ready
+'''
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+import yaml
+from binary_event_log import Binary_Event_Encoder, HEADER, RECORD
+from session_clock import CLOCK
+from timer_scheduler import Timer_Scheduler
+
+FINISHED_STATES = ('exit', 'done')
+
+
+class Session_Journal:
+    '''group commit journal writer. attach() each box's TimestampManager, watch() the boxes'''
+
+    _stop = object()
+
+    def __init__(self, fpath, commit_interval = 0.05, checkpoint_interval = 10, scheduler = None):
+        self.fpath = fpath
+        self.commit_interval = commit_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.file = open(fpath, 'a')
+        self.queue = queue.Queue()
+        self.files = 0
+        self.combos = []
+        self.records = 0
+        self.commits = 0
+        self.max_batch = 0
+        self.owns_scheduler = scheduler is None
+        self.scheduler = scheduler if scheduler else Timer_Scheduler('session_journal')
+        self.closed = False
+        self.thread = threading.Thread(target = self._run, daemon = True, name = 'session_journal')
+        self.thread.start()
+
+    def append(self, record):
+        self.queue.put(record)
+
+    def start(self, config_dict, date):
+        self.append({'kind':'session', 'date':date.isoformat(), 'config':yaml.safe_dump(config_dict),
+                     'wall_anchor':CLOCK.wall_anchor, 'mono_anchor_ns':CLOCK.mono_anchor_ns, 'wall_time':time.time()})
+
+    def resumed(self, run):
+        self.append({'kind':'resume', 'run':run, 'wall_time':time.time()})
+
+    def attach(self, manager, first_seq = 0):
+        '''journal every line written through manager. first_seq is how many lines its file already has'''
+        file_id = self.files
+        self.files += 1
+        self.append({'kind':'file', 'file':file_id, 'fp':manager.fp, 'format':manager.log_format,
+                     'record_clocks':manager.record_clocks, 'delimeter':manager.delimter})
+        seq = [first_seq]
+
+        def journal_line(line, edge_ns, dispatch_delay_ns):
+            self.queue.put({'kind':'event', 'file':file_id, 'seq':seq[0], 'line':list(line), 'edge_ns':edge_ns,
+                            'delay_ns':dispatch_delay_ns})
+            seq[0] += 1
+        manager.add_listener(journal_line)
+        return manager
+
+    def watch(self, combos):
+        '''checkpoint each combo on every state change, and all of them every checkpoint_interval'''
+        self.combos += list(combos)
+        for combo in combos:
+            combo.add_session_listener(self._changed)
+        self.scheduler.call_later(self.checkpoint_interval, self._periodic)
+
+    def _changed(self, combo, name, value):
+        self.checkpoint(combo)
+
+    def _periodic(self):
+        if self.closed:
+            return
+        for combo in self.combos:
+            self.checkpoint(combo)
+        self.scheduler.call_later(self.checkpoint_interval, self._periodic)
+
+    def checkpoint(self, combo):
+        started = combo.started
+        start_ns = combo.start_ns if started else None
+        latency_from_ns = getattr(combo, 'latency_from_ns', None)
+        self.append({'kind':'checkpoint', 'box':combo.ID, 'state':combo.state, 'started':started, 'exit':combo.exit,
+                     'traversal_counts':dict(combo.traversal_counts),
+                     'elapsed':(CLOCK.now_ns() - start_ns)/1e9 if started else combo.resume_offset_ns/1e9,
+                     'start_time':getattr(combo, 'start_time', None) if started else None,
+                     'latency_from':(latency_from_ns - start_ns)/1e9 if started and latency_from_ns is not None else None,
+                     'reward_time':getattr(combo, 'reward_time', None), 'wall_time':time.time()})
+
+    def close(self):
+        '''final checkpoints, then commit everything and close'''
+        if self.closed:
+            return
+        self.closed = True
+        for combo in self.combos:
+            self.checkpoint(combo)
+        self.append({'kind':'end', 'wall_time':time.time()})
+        self.queue.put(self._stop)
+        self.thread.join()
+        self.file.close()
+        if self.owns_scheduler:
+            self.scheduler.shut_down()
+
+    def report(self):
+        return (f'journal: {self.records} records in {self.commits} commits, largest commit {self.max_batch}, '
+                f'commit interval {self.commit_interval*1000:.0f} ms')
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is self._stop:
+                batch.pop()
+                stopping = True
+            committed = time.monotonic()
+            self.file.write(''.join(json.dumps(record) + '\n' for record in batch))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.records += len(batch)
+            self.commits += 1
+            self.max_batch = max(self.max_batch, len(batch))
+            #let the next group gather rather than fsyncing every record on its own
+            if not stopping:
+                time.sleep(max(0, committed + self.commit_interval - time.monotonic()))
+
+
+class Journal_State:
+    '''what a journal says about its session'''
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.config_dict = None
+        self.date = None
+        self.wall_anchor = None
+        self.mono_anchor_ns = None
+        self.runs = 0
+        self.ended = False
+        self.files = {}
+        self.checkpoints = {}
+        self.last_elapsed = {}
+        self.counts = {}
+        self.torn = 0
+
+    def elapsed(self, box_ID):
+        '''how far into its session the box got, from its last checkpoint or its last line, whichever is later'''
+        checkpoint = self.checkpoints.get(box_ID, {})
+        return max(checkpoint.get('elapsed') or 0, self.last_elapsed.get(box_ID, 0))
+
+    def traversal_counts(self, box_ID):
+        counts = {int(k):count for k, count in self.checkpoints.get(box_ID, {}).get('traversal_counts', {}).items()}
+        for k, count in self.counts.get(box_ID, {}).items():
+            counts[k] = max(counts.get(k, 0), count)
+        return counts
+
+    def finished(self, box_ID, total_time):
+        checkpoint = self.checkpoints.get(box_ID, {})
+        return checkpoint.get('exit') or checkpoint.get('state') in FINISHED_STATES or self.elapsed(box_ID) >= total_time
+
+
+def read_journal(fpath):
+    state = Journal_State(fpath)
+    file_ids = {}
+    with open(fpath) as f:
+        lines = f.readlines()
+    for i, text in enumerate(lines):
+        try:
+            record = json.loads(text)
+        except ValueError:
+            #a crash mid write only ever tears the last line
+            if i == len(lines) - 1:
+                state.torn += 1
+                continue
+            raise Exception(f'{fpath} line {i + 1} is not a journal record')
+        kind = record['kind']
+        if kind == 'event':
+            fp = file_ids[record['file']]
+            line = record['line']
+            state.files[fp]['events'][record['seq']] = (line, record['edge_ns'], record['delay_ns'])
+            box_ID = line[0]
+            state.last_elapsed[box_ID] = max(state.last_elapsed.get(box_ID, 0), float(line[2]))
+            if str(line[3]).endswith(' traversal') and line[4] != '':
+                counts = state.counts.setdefault(box_ID, {})
+                counts[int(line[1])] = max(counts.get(int(line[1]), 0), int(line[4]))
+        elif kind == 'checkpoint':
+            state.checkpoints[record['box']] = record
+        elif kind == 'file':
+            file_ids[record['file']] = record['fp']
+            state.files.setdefault(record['fp'], {'format':record['format'], 'record_clocks':record['record_clocks'],
+                                                  'delimeter':record['delimeter'], 'events':{}})
+        elif kind == 'session':
+            state.config_dict = yaml.safe_load(record['config'])
+            state.date = datetime.datetime.fromisoformat(record['date'])
+            state.wall_anchor = record['wall_anchor']
+            state.mono_anchor_ns = record['mono_anchor_ns']
+            state.runs = 1
+            file_ids = {}
+        elif kind == 'resume':
+            state.runs = record['run'] + 1
+            file_ids = {}
+            state.ended = False
+        elif kind == 'end':
+            state.ended = True
+    if state.config_dict is None:
+        raise Exception(f'{fpath} has no session record, is it a journal?')
+    return state
+
+def repair_logs(state):
+    '''append the lines each per animal file is missing from the journal. returns {fp: lines in the file now}'''
+    rows = {}
+    for fp, info in state.files.items():
+        if not os.path.exists(fp):
+            print(f'{fp} is in the journal but missing, not repairing it')
+            continue
+        if info['format'] == 'binary':
+            rows[fp] = repair_binary(fp, info['events'])
+        else:
+            rows[fp] = repair_csv(fp, info, state)
+    return rows
+
+def missing_events(events, present):
+    return [events[seq] for seq in sorted(events) if seq >= present]
+
+def repair_csv(fp, info, state):
+    with open(fp, 'rb+') as f:
+        data = f.read()
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data):
+            f.truncate(complete)
+    present = max(0, data[:complete].count(b'\n') - 1)
+    missing = missing_events(info['events'], present)
+    if missing:
+        delimeter = info['delimeter']
+        with open(fp, 'a') as f:
+            for line, edge_ns, delay_ns in missing:
+                if info['record_clocks']:
+                    #the same arithmetic as TimestampManager, so the strings match
+                    line = list(line) + [edge_ns, state.wall_anchor + (edge_ns - state.mono_anchor_ns)/1e9, delay_ns/1e6]
+                f.write(delimeter.join(str(bit) for bit in line) + '\n')
+        print(f'{fp}: restored {len(missing)} lines from the journal')
+    return present + len(missing)
+
+def repair_binary(fp, events):
+    size = os.path.getsize(fp)
+    present = max(0, (size - HEADER.size)//RECORD.size)
+    complete = HEADER.size + present*RECORD.size
+    if complete < size:
+        with open(fp, 'rb+') as f:
+            f.truncate(complete)
+    missing = missing_events(events, present)
+    if missing:
+        encoder = Binary_Event_Encoder(fp, clock = CLOCK)
+        encoder.table.load()
+        with open(fp, 'ab') as f:
+            for line, edge_ns, delay_ns in missing:
+                f.write(encoder.encode(line, edge_ns, delay_ns))
+        print(f'{fp}: restored {len(missing)} records from the journal')
+    return present + len(missing)
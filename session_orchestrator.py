@@ -0,0 +1,291 @@
+'''runs a session of boxes from start to summary without polling.
+
+each combo signals when it starts and exits (see components.Session_Flags). the orchestrator waits on those
+events and puts each box's total_time deadline on a timer as soon as it starts, timed from the button press
+that started it. at the deadline the box goes to its exit state, or as soon as it leaves reward if it was mid
+reward. the summary csv is kept current from the event stream as the session runs, see live_summary, and the hot
+path timings go to a stats file (and a metrics endpoint if configured), see instrumentation.
+
+both run scripts go through run_session:
+
+    run_session(config_dict, make_beambreak_pair)
+
+with software: processes: n above 1 the boxes are split across n worker processes instead, see box_sharding.
+'''
+import datetime
+import os
+import threading
+from functools import partial
+from timer_scheduler import Timer_Scheduler
+from session_clock import CLOCK
+
+#a box isn't sent to its exit state from these, it waits until it leaves them
+HOLD_STATES = ('reward', 'exit')
+
+
+class Session_Orchestrator:
+
+    def __init__(self, combos, total_time, scheduler = None, status_interval = 1.5, settle = 0.05):
+        self.combos = list(combos)
+        self.total_time = total_time
+        self.scheduler = scheduler if scheduler else Timer_Scheduler('session')
+        self.status_interval = status_interval
+        self.settle = settle
+        self.deadlines = {}
+        self.due = set()
+        self.exiting = set()
+        self.exit_lateness_ms = {}
+        self._lock = threading.Lock()
+        for combo in self.combos:
+            combo.add_session_listener(self._changed)
+            if combo.started:
+                self._schedule(combo)
+
+    def _changed(self, combo, name, value):
+        if name == 'started' and value:
+            self._schedule(combo)
+        elif name == 'state' and combo.ID in self.due:
+            #the combos set state part way through a transition and then arm callbacks, so give it settle seconds
+            #to finish or the exit state could be undone by the end of the transition
+            self.scheduler.call_later(self.settle, self._try_exit, combo)
+
+    def _schedule(self, combo):
+        with self._lock:
+            if combo.ID in self.deadlines:
+                return
+            deadline_ns = self.deadlines[combo.ID] = combo.start_ns + int(self.total_time*1e9)
+        #deadlines are on CLOCK, which a resumed session offsets from the scheduler's perf_counter, so go by the delay
+        self.scheduler.call_later(max(0, (deadline_ns - CLOCK.now_ns())/1e9), self._deadline, combo)
+
+    def _deadline(self, combo):
+        with self._lock:
+            self.due.add(combo.ID)
+        self._try_exit(combo)
+
+    def _try_exit(self, combo):
+        with self._lock:
+            if combo.ID in self.exiting or combo.exit or combo.state in HOLD_STATES:
+                return
+            self.exiting.add(combo.ID)
+        self.exit_lateness_ms[combo.ID] = (CLOCK.now_ns() - self.deadlines[combo.ID])/1e6
+        combo.exit_state()
+
+    def waiting(self, flag):
+        return [combo.ID for combo in self.combos if not getattr(combo, flag)]
+
+    def wait_for(self, flag, message):
+        '''block until flag is set on every combo, printing who is left every status_interval seconds'''
+        wait = {'started':'wait_started', 'exit':'wait_exit'}[flag]
+        for combo in self.combos:
+            while not getattr(combo, wait)(self.status_interval):
+                print(f'{message}: {self.waiting(flag)}')
+
+    def run(self):
+        self.wait_for('started', 'waiting to start')
+        print('done waiting to start')
+        self.wait_for('exit', 'waiting to exit')
+        lateness = ', '.join(f'{ID} {ms:.1f} ms' for ID, ms in self.exit_lateness_ms.items())
+        print(f'every box has exited. exit state after total_time: {lateness}')
+
+
+def configure_runtime(software):
+    '''the process wide settings from the software section. every process that runs boxes calls this'''
+    from components import GPIO, CONFIRMATION_ENGINE
+    from box_executor import EXECUTORS
+
+    #software: acquisition: {mode: sampled, rate: 1000} reads every pin from one sampling thread instead of an interrupt per pin
+    acquisition = software.get('acquisition', {})
+    if acquisition.get('mode') == 'sampled':
+        GPIO.use('sampled', rate = acquisition.get('rate', 1000))
+
+    #per box thread_it lanes, eg software: executor: {workers: 3, max_queue: 16, starvation_ms: 100}
+    EXECUTORS.configure(**software.get('executor', {}))
+
+    #per pin overrides of beam/button confirmation, eg software: confirmation: {17: {cycles_required: 3}}
+    for pin, settings in software.get('confirmation', {}).items():
+        CONFIRMATION_ENGINE.configure(pin, **settings)
+
+    #hot path histograms, see instrumentation. software: metrics: false stops recording them
+    from instrumentation import METRICS
+    METRICS.enabled = software.get('metrics', {}) is not False
+
+def save_config(config_dict, date):
+    '''save the config file, timestamped just in case'''
+    from recording_classes import default_generate_output_fname
+    import yaml
+    config_filename = default_generate_output_fname('config', date)
+    with open(os.path.join(config_dict['software']['save_path'], config_filename)+'.yaml', 'w') as outfile:
+        yaml.dump(config_dict, outfile)
+
+def compile_machine(software, spec = None):
+    '''software: engine: table runs the boxes from one compiled state machine (see state_machine) instead of the combo
+    classes. None otherwise'''
+    from state_machine import Compiled_State_Machine, DEFAULT_SPEC
+    if software.get('engine') != 'table':
+        return None
+    software.setdefault('state_machine', spec if spec else DEFAULT_SPEC)
+    return Compiled_State_Machine(software['state_machine'])
+
+def log_filename(config_dict, box_ID, date):
+    '''software: log_format: binary writes compact records (see binary_event_log) instead of csv text'''
+    from recording_classes import default_generate_output_fname
+    binary = config_dict['software'].get('log_format', 'csv') == 'binary'
+    return default_generate_output_fname(config_dict['animals'][box_ID]['focal'], date)+('.bbev' if binary else '.csv')
+
+def make_boxes(config_dict, box_IDs, make_box, machine, make_writer):
+    '''a Box with its ir_pair for each box_ID. make_writer(box_ID) gives the box's timestamp writer'''
+    from box import Box
+    from state_machine import build_box
+    boxes = []
+    for box_ID in box_IDs:
+        box = Box(box_ID)
+        writer = make_writer(box_ID)
+        if machine is not None:
+            box.add_component(build_box(config_dict, box_ID, writer, machine = machine), 'ir_pair')
+        else:
+            box.add_component(make_box(config_dict, box_ID, writer), 'ir_pair')
+        boxes += [box]
+    return boxes
+
+def start_live_summary(config_dict, date):
+    '''the summary csv, rewritten every software: summary_interval seconds (default 5) while the session runs.
+    attach each box's TimestampManager to it'''
+    from recording_classes import default_generate_output_fname
+    from live_summary import Live_Summary
+    software = config_dict['software']
+    fpath = os.path.join(software['save_path'], default_generate_output_fname('summary', date) + '.csv')
+    summary = Live_Summary(config_dict, fpath, interval = software.get('summary_interval', 5))
+    summary.start()
+    return summary
+
+def start_metrics(config_dict, date, writer = None, name = 'metrics', serve = True):
+    '''the hot path histograms (see instrumentation) written to <name>_<date>.prom every
+    software: metrics: {stats_interval} seconds (default 10), and served on {port} and/or {socket} if given.
+    writer is the shared Timestamp_Writer_Thread, for its queued lines. None with software: metrics: false'''
+    from recording_classes import default_generate_output_fname
+    from instrumentation import METRICS, Metrics_Exporter
+    from components import EDGE_DISPATCHER
+    software = config_dict['software']
+    settings = software.get('metrics', {})
+    if settings is False:
+        return None
+    settings = settings if isinstance(settings, dict) else {}
+    METRICS.map_pins(config_dict['hardware'])
+    if writer is not None:
+        METRICS.add_gauge('beambreak_writer_queued', writer.backlog, writer = writer.name)
+    for result in EDGE_DISPATCHER.stats:
+        METRICS.add_counter('beambreak_edges_total', partial(EDGE_DISPATCHER.stats.get, result), result = result)
+    exporter = Metrics_Exporter(METRICS, os.path.join(software['save_path'], default_generate_output_fname(name, date) + '.prom'),
+                                interval = settings.get('stats_interval', 10),
+                                port = settings.get('port') if serve else None, host = settings.get('host', '127.0.0.1'),
+                                socket_path = settings.get('socket') if serve else None)
+    exporter.start()
+    return exporter
+
+def journal_path(config_dict, date):
+    from recording_classes import default_generate_output_fname
+    return os.path.join(config_dict['software']['save_path'], default_generate_output_fname('journal', date) + '.jsonl')
+
+def start_journal(config_dict, date, resume = None):
+    '''the crash journal (see session_journal), on unless software: journal: false. tune with
+    software: journal: {commit_interval, checkpoint_interval}'''
+    from session_journal import Session_Journal
+    settings = config_dict['software'].get('journal', {})
+    if settings is False:
+        return None
+    journal = Session_Journal(resume.fpath if resume else journal_path(config_dict, date),
+                              **(settings if isinstance(settings, dict) else {}))
+    if resume:
+        journal.resumed(resume.runs)
+    else:
+        journal.start(config_dict, date)
+    return journal
+
+def run_session(config_dict, make_box, spec = None, resume = None):
+    '''everything after loading the yaml: set up, build a box per hardware entry with make_box(config_dict, box_ID,
+    timestamp_writer) (or the table engine, see state_machine), run until every box exits, then finish the summary.
+    spec is the state machine used for software: engine: table when the yaml doesn't declare one.
+    resume is a Journal_State to carry on from, see resume_session'''
+    software = config_dict['software']
+    if software.get('processes', 1) > 1:
+        if resume:
+            raise Exception('resuming runs every box in one process, set software: processes: 1')
+        from box_sharding import run_sharded_session
+        return run_sharded_session(config_dict, make_box, spec)
+
+    from components import GPIO
+    from box_executor import EXECUTORS
+    from instrumentation import METRICS
+    from recording_classes import TimestampManager, Timestamp_Writer_Thread, Flush_Policy
+    configure_runtime(software)
+    if resume:
+        date = resume.date
+    else:
+        date = datetime.datetime.now()
+        save_config(config_dict, date)
+
+    #one writer thread keeps every box's file open. tune with software: flush_policy: {every_n, every_ms, on_state_change, fsync}
+    shared_writer = Timestamp_Writer_Thread(flush_policy = Flush_Policy(**software.get('flush_policy', {})))
+    metrics = start_metrics(config_dict, date, shared_writer)
+
+    #event times are monotonic from here on, pinned to wall time once (or carrying on the interrupted run's times)
+    box_IDs = list(config_dict['hardware'].keys())
+    rows = {}
+    if resume:
+        from session_journal import repair_logs
+        CLOCK.continue_from(resume.wall_anchor, resume.mono_anchor_ns)
+        rows = repair_logs(resume)
+        for box_ID in [box_ID for box_ID in box_IDs if resume.finished(box_ID, software['total_time'])]:
+            print(f'{box_ID} had already finished, not resuming it')
+            box_IDs.remove(box_ID)
+    else:
+        CLOCK.anchor()
+
+    machine = compile_machine(software, spec)
+    log_format = software.get('log_format', 'csv')
+    session_summary = start_live_summary(config_dict, date)
+    journal = start_journal(config_dict, date, resume)
+    if resume:
+        for info in resume.files.values():
+            for seq in sorted(info['events']):
+                session_summary.record(*info['events'][seq])
+
+    def make_writer(box_ID):
+        manager = TimestampManager(software['save_path'], log_filename(config_dict, box_ID, date), writer = shared_writer,
+                                   log_format = log_format, append = resume is not None)
+        if journal:
+            journal.attach(manager, first_seq = rows.get(manager.fp, 0))
+        return session_summary.attach(manager)
+    boxes = make_boxes(config_dict, box_IDs, make_box, machine, make_writer)
+    session_summary.add_boxes(boxes)
+    if resume:
+        for box in boxes:
+            box.ir_pair.resume(resume.elapsed(box.name), resume.traversal_counts(box.name))
+            print(f'{box.name} resuming {resume.elapsed(box.name):.1f} s in, {software["total_time"] - resume.elapsed(box.name):.1f} s left, '
+                  f'traversal counts {box.ir_pair.traversal_counts}')
+    if journal:
+        journal.watch([box.ir_pair for box in boxes])
+
+    orchestrator = Session_Orchestrator([box.ir_pair for box in boxes], software['total_time'])
+    for box in boxes:
+        box.ir_pair.entry_state(reward_time = software['reward_period'])
+    orchestrator.run()
+
+    GPIO.cleanup()
+    shared_writer.shut_down()
+    print(EXECUTORS.report())
+    if metrics:
+        metrics.stop()
+        print(METRICS.report())
+    if journal:
+        journal.close()
+        print(journal.report())
+    session_summary.stop()
+    return boxes
+
+def resume_session(journal_fpath, make_box, spec = None):
+    '''carry on a crashed session from its journal, with the config it was started with'''
+    from session_journal import read_journal
+    resume = read_journal(journal_fpath)
+    print(f'resuming the session of {resume.date} from {journal_fpath} ({resume.runs} earlier runs)')
+    return run_session(resume.config_dict, make_box, spec, resume = resume)
@@ -0,0 +1,456 @@
+'''replays recorded sessions through the current combos, on virtual time.
+
+a session's timestamp csvs (ID, beam, elapsed_time, event, count, latency, notes, from TimestampManager) are
+turned back into the inputs that made them: the start press, each traversal's beam break, reward cancel and reset
+presses, and the top beams' breaks. those are played as edges on the simulated GPIO into freshly built boxes,
+and what the boxes log is compared with the recording, row by row.
+
+nothing sleeps for real. the session clock, the confirmation engine, the LED scheduler, the total_time deadlines
+and the combos' own waits all run on a Virtual_Clock, and the replay only moves it forward once every edge
+callback and executor lane has finished or is waiting on virtual time. an hour of behavior replays in seconds,
+and the replayed times are exact, so any difference from the recording is a change in behavior, not jitter.
+
+    python session_replay.py results/Kelly/a1_*.csv results/Kelly/a2_*.csv --reward_time 30 --total_time 900
+    python session_replay.py session.csv --engine table --out replayed/
+
+replay needs the simulated GPIO and the threaded runtime (the asyncio runtime keeps real time).
+'''
+import argparse
+import csv
+import difflib
+import heapq
+import itertools
+import math
+import os
+import statistics
+import threading
+import time
+from timer_scheduler import Timer_Handle
+from session_clock import CLOCK
+
+PIN_BLOCK = 8
+BUTTON_HOLD = 0.1
+BEAM_HOLD = 0.1
+GRACE = 5.0
+
+
+class Replay_Stalled(Exception):
+    pass
+
+
+class Virtual_Clock:
+    '''time that only moves when advance_to is called. sleep() blocks until it has moved far enough'''
+
+    def __init__(self, start_ns = None):
+        self.t_ns = time.perf_counter_ns() if start_ns is None else start_ns
+        self.sleeping = 0
+        self.driver = None
+        self._wakes = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def now_ns(self):
+        return self.t_ns
+
+    def sleep(self, seconds):
+        if threading.current_thread() is self.driver:
+            raise Exception('replay timers must not sleep, nothing would move the clock on')
+        with self._condition:
+            entry = [self.t_ns + int(seconds*1e9), next(self._counter), False]
+            heapq.heappush(self._wakes, entry)
+            self.sleeping += 1
+            while not entry[2]:
+                self._condition.wait()
+
+    def next_wake_ns(self):
+        with self._condition:
+            return self._wakes[0][0] if self._wakes else None
+
+    def advance_to(self, t_ns):
+        '''sleepers that are due count as awake from here, before their threads actually resume'''
+        with self._condition:
+            self.t_ns = max(self.t_ns, t_ns)
+            woke = False
+            while self._wakes and self._wakes[0][0] <= self.t_ns:
+                entry = heapq.heappop(self._wakes)
+                entry[2] = True
+                self.sleeping -= 1
+                woke = True
+            if woke:
+                self._condition.notify_all()
+
+
+class Virtual_Scheduler:
+    '''Timer_Scheduler's interface on a Virtual_Clock. nothing runs on its own, the replay calls run_due'''
+
+    def __init__(self, clock):
+        self.virtual_clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def clock(self):
+        return self.virtual_clock.t_ns/1e9
+
+    def call_at(self, deadline, func, *args):
+        handle = Timer_Handle(deadline)
+        with self._lock:
+            heapq.heappush(self._heap, (round(deadline*1e9), next(self._counter), handle, func, args))
+        return handle
+
+    def call_later(self, delay, func, *args):
+        return self.call_at(self.clock() + delay, func, *args)
+
+    def call_soon(self, func, *args):
+        return self.call_at(self.clock(), func, *args)
+
+    def pending(self):
+        with self._lock:
+            return sum(not entry[2].cancelled for entry in self._heap)
+
+    def next_deadline_ns(self):
+        with self._lock:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def run_due(self, t_ns):
+        '''run every timer due by t_ns, including ones they set for no later than t_ns'''
+        ran = 0
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > t_ns:
+                    return ran
+                _, _, handle, func, args = heapq.heappop(self._heap)
+            if not handle.cancelled:
+                func(*args)
+                ran += 1
+
+    def shut_down(self):
+        pass
+
+
+class Recorded_Row:
+    def __init__(self, row):
+        self.ID = row['ID']
+        self.beam = row['beam']
+        self.elapsed_time = float(row['elapsed_time'])
+        self.event = row['event']
+        self.count = row['count']
+        self.latency = float(row['latency']) if row['latency'] not in ('', None) else None
+        self.notes = row['notes']
+
+    def key(self):
+        return (self.event, self.beam, self.count, self.notes)
+
+
+class Capture_Writer:
+    '''timestamp writer that keeps the replayed rows, and optionally also writes them like the live session'''
+    def __init__(self, manager = None):
+        self.rows = []
+        self.manager = manager
+
+    def create_file(self, header):
+        if self.manager is not None:
+            self.manager.create_file(header)
+
+    def write_timestamp(self, line, state_change = False, edge_ns = None):
+        ID, beam, elapsed_time, event, count, latency, notes = line
+        self.rows.append(Recorded_Row({'ID':str(ID), 'beam':str(beam), 'elapsed_time':elapsed_time, 'event':str(event),
+                                       'count':str(count), 'latency':latency, 'notes':str(notes)}))
+        if self.manager is not None:
+            self.manager.write_timestamp(line, state_change = state_change, edge_ns = edge_ns)
+
+    def shut_down(self):
+        if self.manager is not None:
+            self.manager.shut_down()
+
+
+def read_session(path):
+    '''rows of a recorded timestamp csv, or a binary event log (.bbev)'''
+    if path.endswith('.bbev'):
+        from binary_event_log import Binary_Event_Log
+        log = Binary_Event_Log(path)
+        return [Recorded_Row(dict(zip(log.header, row))) for row in log.csv_rows()]
+    with open(path) as f:
+        return [Recorded_Row(row) for row in csv.DictReader(f)]
+
+def top_beam_names(rows):
+    names = []
+    for row in rows:
+        if row.event.startswith('beam_break') and row.beam not in names:
+            names += [row.beam]
+    return names
+
+def traversal_notes(rows):
+    notes = {}
+    for row in rows:
+        if row.event.endswith(' traversal'):
+            notes.setdefault(int(row.beam), row.notes)
+    return notes
+
+def infer_reward_time(rows):
+    '''median gap from a traversal to its reward_period_end'''
+    gaps = []
+    last_traversal = None
+    for row in rows:
+        if row.event.endswith(' traversal'):
+            last_traversal = row.elapsed_time
+        elif row.event == 'reward_period_end' and last_traversal is not None:
+            gaps += [row.elapsed_time - last_traversal]
+            last_traversal = None
+    return round(statistics.median(gaps), 3) if gaps else None
+
+def behavior_timeline(rows, top_names, button_hold = BUTTON_HOLD, beam_hold = BEAM_HOLD):
+    '''the inputs behind a recording, as (seconds after entry_state, input, level). inputs are 'button', the
+    traversal beam numbers and the top beam names. times are from the start press, which happened the first reset's
+    latency after entry'''
+    start = rows[0].latency if rows and rows[0].event == 'reset' and rows[0].latency is not None else 1.0
+    edges = [(start, 'button', 0), (start + button_hold, 'button', 1)]
+    previous = None
+    for row in rows[1:] if rows and rows[0].event == 'reset' else rows:
+        t = start + row.elapsed_time
+        if row.event == 'reward_canceled' or (row.event == 'reset' and not (previous is not None
+                and previous.event == 'reward_canceled' and previous.elapsed_time == row.elapsed_time)):
+            edges += [(t, 'button', 0), (t + button_hold, 'button', 1)]
+        elif row.event.endswith(' traversal'):
+            edges += [(t, int(row.beam), 0), (t + beam_hold, int(row.beam), 1)]
+        elif row.event == 'beam_break_initiation':
+            edges += [(t, row.beam, 0)]
+        elif row.event == 'beam_break_duration':
+            edges += [(t, row.beam, 1)]
+        previous = row
+    return sorted(edges, key = lambda edge: edge[0])
+
+
+class Replay_Box:
+    '''one recorded box: its rows, the box rebuilt to replay them and where its inputs are wired'''
+    def __init__(self, ID, rows, index):
+        self.ID = ID
+        self.rows = rows
+        base = 100 + index*PIN_BLOCK
+        self.top_names = top_beam_names(rows)
+        self.pins = {'button':base + 4}
+        self.pins.update({k:base + k - 1 for k in (1, 2)})
+        self.pins.update({name:base + 2 + i for i, name in enumerate(self.top_names)})
+        self.led = index % 16
+        self.combo = None
+        self.writer = None
+
+
+class Session_Replay:
+
+    def __init__(self, paths, reward_time = None, total_time = None, engine = 'combo', out_dir = None,
+                 button_hold = BUTTON_HOLD, beam_hold = BEAM_HOLD, settle_timeout = 10):
+        self.paths = paths
+        by_box = {}
+        for path in paths:
+            for row in read_session(path):
+                by_box.setdefault(row.ID, []).append(row)
+        self.boxes = [Replay_Box(ID, rows, i) for i, (ID, rows) in enumerate(by_box.items())]
+        inferred = [infer_reward_time(box.rows) for box in self.boxes]
+        self.reward_time = reward_time if reward_time is not None else next((r for r in inferred if r is not None), 30)
+        self.total_time = total_time
+        self.engine = engine
+        self.out_dir = out_dir
+        self.button_hold = button_hold
+        self.beam_hold = beam_hold
+        self.settle_timeout = settle_timeout
+        self.steps = 0
+        self.virtual_s = 0
+        self.real_s = 0
+
+    def install(self):
+        '''point the session clock and every timer at virtual time'''
+        import components
+        import state_machine
+        from led_scheduler import LED_Scheduler
+        from box_executor import EXECUTORS
+        GPIO = components.GPIO
+        if not GPIO.is_open():
+            GPIO.use('simulated')
+            components.SERVO_KIT.use('simulated')
+        if not hasattr(GPIO, 'idle'):
+            raise Exception(f'replay needs the simulated GPIO backend, but {GPIO.backend_name()} is open')
+        self.gpio = GPIO
+        self.clock = Virtual_Clock()
+        self.clock.driver = threading.current_thread()
+        self.scheduler = Virtual_Scheduler(self.clock)
+        self.saved = (components.CONFIRMATION_ENGINE.scheduler, components._led_scheduler, state_machine.TIMER_SCHEDULER)
+        CLOCK.use(self.clock)
+        components.CONFIRMATION_ENGINE.scheduler = self.scheduler
+        components._led_scheduler = LED_Scheduler(components.SERVO_KIT._pca, scheduler = self.scheduler)
+        state_machine.TIMER_SCHEDULER = self.scheduler
+        self.lanes = EXECUTORS
+        #work left behind by an earlier replay never finishes, so only count what is new
+        self.baseline = self.outstanding()
+
+    def uninstall(self):
+        import components
+        import state_machine
+        components.CONFIRMATION_ENGINE.scheduler, components._led_scheduler, state_machine.TIMER_SCHEDULER = self.saved
+        CLOCK.use(None)
+
+    def outstanding(self):
+        return sum(lane.submitted - lane.completed for lane in list(self.lanes.lanes.values()))
+
+    def quiescent(self):
+        return self.gpio.idle() and self.outstanding() - self.baseline == self.clock.sleeping
+
+    def settle(self):
+        end = time.perf_counter() + self.settle_timeout
+        while not self.quiescent():
+            if time.perf_counter() > end:
+                raise Replay_Stalled(f'replay stalled at virtual {self.clock.t_ns/1e9:.3f} s: gpio idle {self.gpio.idle()}, '
+                                     f'{self.outstanding() - self.baseline} lane tasks running, {self.clock.sleeping} asleep')
+            time.sleep(0.00005)
+
+    def build(self, box):
+        from components import Two_Beambreak_LED_Button_Combo, Four_Beambreak_LED_Button_Combo, IR_beambreak, Button, LED
+        from recording_classes import TimestampManager
+        manager = None
+        if self.out_dir is not None:
+            os.makedirs(self.out_dir, exist_ok = True)
+            manager = TimestampManager(self.out_dir, f'replay_{box.ID}.csv')
+        box.writer = Capture_Writer(manager)
+        notes = traversal_notes(box.rows)
+        beams = [IR_beambreak(box.pins[k]) for k in (1, 2)]
+        tops = [IR_beambreak(box.pins[name], timestamp_writer = box.writer, notes = name) for name in box.top_names]
+        led, button = LED(box.led), Button(box.pins['button'])
+        if self.engine == 'table':
+            from state_machine import State_Machine_Box, Compiled_State_Machine, DEFAULT_SPEC, FOUR_BEAM_SPEC
+            machine = Compiled_State_Machine(FOUR_BEAM_SPEC if tops else DEFAULT_SPEC)
+            return State_Machine_Box(machine, beams, led, button, box.ID, top_beams = tops,
+                                     notes = [notes.get(1), notes.get(2)], timestamp_writer = box.writer)
+        if len(tops) == 2:
+            return Four_Beambreak_LED_Button_Combo(beams[0], beams[1], tops[0], tops[1], led, button, box.ID,
+                                                   notes_1 = notes.get(1), notes_2 = notes.get(2),
+                                                   notes_3 = box.top_names[0], notes_4 = box.top_names[1],
+                                                   timestamp_writer = box.writer)
+        if tops:
+            raise Exception(f'{box.ID} has {len(tops)} top beams ({box.top_names}), the combos have 0 or 2')
+        return Two_Beambreak_LED_Button_Combo(beams[0], beams[1], led, button, box.ID, notes_1 = notes.get(1),
+                                              notes_2 = notes.get(2), timestamp_writer = box.writer)
+
+    def run(self):
+        from session_orchestrator import Session_Orchestrator
+        self.install()
+        real_start = time.perf_counter()
+        try:
+            for box in self.boxes:
+                for pin in box.pins.values():
+                    self.gpio.set_level(pin, 1)
+                box.combo = self.build(box)
+            entry_ns = self.clock.t_ns
+            timeline = []
+            last_ns = entry_ns
+            for box in self.boxes:
+                for t, name, level in behavior_timeline(box.rows, box.top_names, self.button_hold, self.beam_hold):
+                    t_ns = entry_ns + round(t*1e9)
+                    timeline += [(t_ns, box.pins[name], level)]
+                    last_ns = max(last_ns, t_ns)
+            heapq.heapify(timeline)
+            end_ns = last_ns + round((self.reward_time + GRACE)*1e9)
+            total_time = self.total_time if self.total_time is not None else math.inf
+            if total_time != math.inf:
+                Session_Orchestrator([box.combo for box in self.boxes], total_time, scheduler = self.scheduler)
+            for box in self.boxes:
+                box.combo.entry_state(reward_time = self.reward_time)
+
+            while True:
+                self.settle()
+                candidates = [t for t in (timeline[0][0] if timeline else None, self.scheduler.next_deadline_ns(),
+                                          self.clock.next_wake_ns()) if t is not None]
+                if not candidates or min(candidates) > end_ns:
+                    break
+                t_ns = min(candidates)
+                self.clock.advance_to(t_ns)
+                while timeline and timeline[0][0] <= t_ns:
+                    _, pin, level = heapq.heappop(timeline)
+                    self.gpio.set_level(pin, level)
+                    #edges at the same instant are still handled one at a time, like the kernel would
+                    self.settle()
+                self.scheduler.run_due(t_ns)
+                self.steps += 1
+            self.virtual_s = (self.clock.t_ns - entry_ns)/1e9
+        finally:
+            self.real_s = time.perf_counter() - real_start
+            for box in self.boxes:
+                if box.writer is not None and box.writer.manager is not None:
+                    box.writer.manager.shut_down()
+            self.uninstall()
+        return self.compare()
+
+    def compare(self, tolerance = 0.001):
+        return [Box_Comparison(box.ID, box.rows, box.writer.rows, tolerance) for box in self.boxes]
+
+    def speedup(self):
+        return self.virtual_s/self.real_s if self.real_s else math.inf
+
+
+class Box_Comparison:
+    '''recorded vs replayed rows of one box, matched on (event, beam, count, notes) in order'''
+
+    def __init__(self, ID, recorded, replayed, tolerance = 0.001):
+        self.ID = ID
+        self.recorded = recorded
+        self.replayed = replayed
+        self.tolerance = tolerance
+        matcher = difflib.SequenceMatcher(None, [row.key() for row in recorded], [row.key() for row in replayed], autojunk = False)
+        self.matched = []
+        self.missing = []
+        self.extra = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                self.matched += list(zip(recorded[i1:i2], replayed[j1:j2]))
+            else:
+                self.missing += recorded[i1:i2]
+                self.extra += replayed[j1:j2]
+        self.time_errors = [abs(a.elapsed_time - b.elapsed_time) for a, b in self.matched]
+        self.late = [(a, b) for a, b in self.matched if abs(a.elapsed_time - b.elapsed_time) > tolerance]
+
+    @property
+    def ok(self):
+        return not self.missing and not self.extra and not self.late
+
+    def first_difference(self):
+        for row in self.missing[:1]:
+            return f'missing {row.event} beam {row.beam} at {row.elapsed_time:.3f} s'
+        for row in self.extra[:1]:
+            return f'extra {row.event} beam {row.beam} at {row.elapsed_time:.3f} s'
+        for a, b in self.late[:1]:
+            return f'{a.event} beam {a.beam} at {b.elapsed_time:.3f} s instead of {a.elapsed_time:.3f} s'
+        return ''
+
+    def summary(self):
+        worst = max(self.time_errors) if self.time_errors else 0
+        return (f"{self.ID:<12}{'ok' if self.ok else 'DIFFERS':>8}{len(self.recorded):>9}{len(self.replayed):>9}"
+                f"{len(self.matched):>8}{len(self.missing):>8}{len(self.extra):>7}{worst*1000:>11.3f}  {self.first_difference()}")
+
+
+def print_report(replay, comparisons):
+    print(f"{'box':<12}{'result':>8}{'recorded':>9}{'replayed':>9}{'matched':>8}{'missing':>8}{'extra':>7}{'worst ms':>11}")
+    for comparison in comparisons:
+        print(comparison.summary())
+    print(f'{replay.virtual_s:.1f} s of session in {replay.real_s:.2f} s ({replay.speedup():.0f}x), {replay.steps} steps. '
+          f'reward_time {replay.reward_time}, total_time {replay.total_time}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'replay recorded sessions through the current combos and compare')
+    parser.add_argument('sessions', type = str, nargs = '+', help = 'timestamp csvs (or .bbev logs), one per box')
+    parser.add_argument('--reward_time', type = float, default = None, help = 'defaults to what the recording shows')
+    parser.add_argument('--total_time', type = float, default = None, help = 'send boxes to exit after this long, like the live run')
+    parser.add_argument('--engine', type = str, default = 'combo', choices = ['combo', 'table'])
+    parser.add_argument('--out', type = str, default = None, help = 'also write the replayed csvs here')
+    parser.add_argument('--tolerance_ms', type = float, default = 1)
+    parser.add_argument('--verbose', action = 'store_true', help = "keep the combos' prints")
+    args = parser.parse_args()
+    import contextlib
+    replay = Session_Replay(args.sessions, reward_time = args.reward_time, total_time = args.total_time,
+                            engine = args.engine, out_dir = args.out)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(None if args.verbose else devnull):
+        replay.run()
+    comparisons = replay.compare(args.tolerance_ms/1000)
+    print_report(replay, comparisons)
+    os._exit(0 if all(comparison.ok for comparison in comparisons) else 1)
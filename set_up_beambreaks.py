@@ -5,6 +5,8 @@ parser = argparse.ArgumentParser(description='input io info')
 parser.add_argument('--yaml_in', '-i',type = str, 
                     help = 'where is the csv experiments file?',
                     action = 'store')
+parser.add_argument('--table', action = 'store_true',
+                    help = 'redraw the whole tabulate table every 50 ms instead of the live dashboard')
 from recording_classes import TimestampManager, default_generate_output_fname
 from components import Two_Beambreak_LED_Button_Combo, IR_beambreak, Button, LED
 import yaml
@@ -12,7 +14,7 @@ import datetime
 import pdb
 import time
 from components import GPIO
-from tabulate import tabulate
+from pin_dashboard import Pin_State_Snapshot, Pin_Dashboard, beam_rows
 args = parser.parse_args()
 
 def make_beambreak_pair(yaml_file, box_id, timestamp_writer):
@@ -74,6 +76,7 @@ time.sleep(1)
 def print_pin_status(box_list):
     num_IRs = len(box_list)*2
 
+    from tabulate import tabulate
     print("\033c", end="")
     
     status = []
@@ -89,9 +92,15 @@ def print_pin_status(box_list):
     time.sleep(0.05)
 
 try:
-    while True:
-        print_pin_status(boxes)
-        time.sleep(0.05) 
+    if args.table:
+        while True:
+            print_pin_status(boxes)
+            time.sleep(0.05) 
+    else:
+        #one thread reads every pin at a fixed rate, the screen only rewrites cells that changed
+        rows = beam_rows(boxes, ['beambreak_1', 'beambreak_2'])
+        snapshot = Pin_State_Snapshot(GPIO, [row[2] for row in rows])
+        Pin_Dashboard(snapshot, rows).run()
 
 except KeyboardInterrupt:
     print('\n\ncleaning up')
\ No newline at end of file
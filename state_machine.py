@@ -0,0 +1,310 @@
+'''table driven box state machine, declared in the yaml instead of written out per combo class.
+
+    software:
+      engine: table
+      state_machine:          #optional, DEFAULT_SPEC below is the two/four beam barrier task
+        traversal_beams: [ir_1, ir_2]
+        top_beams: [ir_3, ir_4]
+        initial: entry
+        states:
+          ready:
+            led: off
+            log: {event: reset, beam: false}
+            record_top: true
+            on:
+              traversal: {to: reward, log: '{beam} traversal', count: true}
+          ...
+
+a hardware box can list its own traversal_beams / top_beams, so boxes can have any number of either.
+traversal beam k (from 1) is logged as beam k, like beambreak_k on the combos.
+
+states:
+    led          on, off, or {flash: period in seconds}
+    log          event written when the state is entered
+    record_top   top beams record break durations while true
+    wait_clear   wait for every beam to be unblocked before entering (checked every 0.5 s)
+    timer        {after: seconds or a box attribute such as reward_time, to: state, log: event}, timed from the
+                 edge that entered the state
+    finish       the box is done: LED off, exit set
+    on           {button: transition, traversal: transition}. edges with no transition in a state are masked
+
+transitions are {to: state, log: event, count: true/false, start: true/false}. start begins the session clock at
+that edge. log is an event name ('{beam}' becomes the beam number) or {event, beam, latency, mark}, where beam and
+latency false leave those columns blank and mark false keeps timing latency from the previous marked event.
+
+everything is compiled once: each state is a row of (button, traversal, timer) transitions, event names are
+formatted for every beam up front and every edge handler is bound when the box is built, so an edge is a table
+lookup and never allocates handlers.
+'''
+import copy
+import threading
+from functools import partial
+from timer_scheduler import Timer_Scheduler
+from session_clock import CLOCK
+from components import Session_Flags
+
+BUTTON = 0
+TRAVERSAL = 1
+TIMER = 2
+TRIGGERS = {'button':BUTTON, 'traversal':TRAVERSAL, 'timer':TIMER}
+
+DEFAULT_SPEC = {
+    'traversal_beams':['ir_1', 'ir_2'],
+    'top_beams':[],
+    'initial':'entry',
+    'states':{
+        'entry':{'led':'on', 'wait_clear':True,
+                 'on':{'button':{'to':'ready', 'start':True}}},
+        'ready':{'led':'off', 'log':{'event':'reset', 'beam':False}, 'record_top':True,
+                 'on':{'traversal':{'to':'reward', 'log':'{beam} traversal', 'count':True}}},
+        'reward':{'led':'on', 'record_top':True,
+                  'timer':{'after':'reward_time', 'to':'reward_over', 'log':{'event':'reward_period_end', 'latency':False}},
+                  'on':{'button':{'to':'ready', 'log':{'event':'reward_canceled', 'mark':False}}}},
+        'reward_over':{'led':{'flash':0.5},
+                       'on':{'button':{'to':'ready'}}},
+        'exit':{'led':{'flash':0.2},
+                'on':{'button':{'to':'done'}}},
+        'done':{'led':'off', 'finish':True}}}
+
+#the four beam task, as IR_beambreak_barrier_run_top_IRs runs it
+FOUR_BEAM_SPEC = copy.deepcopy(DEFAULT_SPEC)
+FOUR_BEAM_SPEC['top_beams'] = ['ir_3', 'ir_4']
+
+#timers for every table driven box (reward periods, waiting for beams to clear)
+TIMER_SCHEDULER = Timer_Scheduler('state_machine')
+
+
+class Event_Def:
+    def __init__(self, spec, n_beams):
+        if isinstance(spec, str):
+            spec = {'event':spec}
+        self.with_beam = spec.get('beam', True)
+        self.with_latency = spec.get('latency', True)
+        self.mark = spec.get('mark', True)
+        #formatted once per beam, index 0 is for events without a beam
+        self.names = [spec['event'].replace('{beam}', str(beam)) for beam in range(n_beams + 1)]
+
+
+class Transition:
+    def __init__(self, spec, state_index, n_beams, source):
+        if spec['to'] not in state_index:
+            raise Exception(f'state machine: {source} goes to unknown state {spec["to"]}')
+        self.to = state_index[spec['to']]
+        self.event = Event_Def(spec['log'], n_beams) if spec.get('log') else None
+        self.count = spec.get('count', False)
+        self.start = spec.get('start', False)
+
+
+class State_Def:
+    def __init__(self, index, name, spec, state_index, n_beams):
+        self.index = index
+        self.name = name
+        led = spec.get('led')
+        self.led_on = led == 'on'
+        self.led_off = led == 'off'
+        self.flash = led.get('flash') if isinstance(led, dict) else None
+        self.record_top = spec.get('record_top', False)
+        self.wait_clear = spec.get('wait_clear', False)
+        self.finish = spec.get('finish', False)
+        self.event = Event_Def(spec['log'], n_beams) if spec.get('log') else None
+        self.row = [None, None, None]
+        for trigger, transition in spec.get('on', {}).items():
+            if trigger not in ('button', 'traversal'):
+                raise Exception(f'state machine: state {name} has an unknown trigger {trigger}')
+            self.row[TRIGGERS[trigger]] = Transition(transition, state_index, n_beams, f'{name} on {trigger}')
+        self.timer_after = None
+        if spec.get('timer'):
+            self.row[TIMER] = Transition(spec['timer'], state_index, n_beams, f'{name} timer')
+            self.timer_after = spec['timer']['after']
+        self.listens_button = self.row[BUTTON] is not None
+        self.listens_traversal = self.row[TRAVERSAL] is not None
+
+
+class Compiled_State_Machine:
+    '''a spec checked and turned into the transition table, shared by every box that runs it'''
+    def __init__(self, spec = None, n_beams = None):
+        self.spec = spec if spec else DEFAULT_SPEC
+        n_beams = n_beams if n_beams else max(len(self.spec.get('traversal_beams', [])), 1)
+        self.n_beams = n_beams
+        names = list(self.spec['states'])
+        state_index = {name:i for i, name in enumerate(names)}
+        self.states = [State_Def(i, name, self.spec['states'][name], state_index, n_beams) for i, name in enumerate(names)]
+        self.index = state_index
+        self.initial = state_index[self.spec.get('initial', names[0])]
+        if 'exit' not in state_index:
+            raise Exception('state machine: needs an exit state')
+        self.exit = state_index['exit']
+
+
+class State_Machine_Box(Session_Flags):
+    '''runs a Compiled_State_Machine for one box. keeps the combos' interface (entry_state, exit_state, started,
+    start_time, exit, state, traversal_counts, notes_k) so the run scripts can use either.
+    transitions never block, so they run on whichever thread delivered the edge or timer, one at a time per box'''
+
+    def __init__(self, machine, traversal_beams, led, button, box_ID, top_beams = (), notes = None,
+                 timestamp_writer = None, scheduler = None):
+        from components import FakeTimestampManager
+        self.machine = machine
+        self.table = [state.row for state in machine.states]
+        self.ID = box_ID
+        self.beams = list(traversal_beams)
+        self.traversal_beams = {k + 1:beam for k, beam in enumerate(self.beams)}
+        self.top_beams = list(top_beams)
+        for beam in self.top_beams:
+            beam.ID = self.ID
+        self.all_breaks = self.beams + self.top_beams
+        #same names as the combos, beambreak_1.. for traversal beams then the top beams
+        for k, beam in enumerate(self.all_breaks):
+            setattr(self, f'beambreak_{k + 1}', beam)
+        self.LED = led
+        self.button = button
+        self.notes = [''] + [note if note else '' for note in (notes if notes else [''] * len(self.beams))]
+        for k in self.traversal_beams:
+            setattr(self, f'notes_{k}', self.notes[k])
+        self.timestamp_writer = timestamp_writer if timestamp_writer else FakeTimestampManager()
+        self.scheduler = scheduler if scheduler else TIMER_SCHEDULER
+        self.traversal_counts = {k:0 for k in self.traversal_beams}
+        self.exit = False
+        self.started = False
+        self.start_ns = 0
+        self.start_time = None
+        self.latency_from_ns = CLOCK.now_ns()
+        self.reward_time = None
+        self.state = None
+        self.current = None
+        self.beam = 0
+        self.epoch = 0
+        self.recording_top = False
+        self._lock = threading.RLock()
+
+        #every handler is bound once here
+        self._button_handler = partial(self.trigger, BUTTON, 0)
+        self._beam_handlers = [partial(self.trigger, TRAVERSAL, k) for k in self.traversal_beams]
+        self.header_list = ['ID', 'beam', 'elapsed_time', 'event', 'count', 'latency', 'notes']
+        self.timestamp_writer.create_file(self.header_list)
+
+    def edge_time(self, component):
+        return component.last_edge_ns if component.last_edge_ns is not None else CLOCK.now_ns()
+
+    def entry_state(self, reward_time = 45):
+        self.reward_time = reward_time
+        self.latency_from_ns = CLOCK.now_ns()
+        self.enter(self.machine.initial, self.latency_from_ns)
+
+    def exit_state(self):
+        with self._lock:
+            self.enter(self.machine.exit, CLOCK.now_ns())
+
+    def check_state(self, state_query):
+        return self.state == state_query
+
+    def exit_func(self):
+        return self.exit
+
+    def trigger(self, kind, beam, channel = None):
+        '''edge (or timer) of the given kind. beam is the traversal beam number, 0 for the button'''
+        with self._lock:
+            transition = self.table[self.current][kind]
+            if transition is None:
+                return
+            t_ns = self.edge_time(self.traversal_beams[beam] if beam else self.button)
+            self.take(transition, beam, t_ns)
+
+    def timer_fired(self, epoch, t_ns):
+        with self._lock:
+            #only if nothing else moved the box on since the timer was set
+            if epoch == self.epoch:
+                self.take(self.table[self.current][TIMER], self.beam, t_ns)
+
+    def take(self, transition, beam, t_ns):
+        if beam:
+            self.beam = beam
+        if transition.start:
+            self.start_ns = t_ns - self.resume_offset_ns
+            self.start_time = CLOCK.to_wall(self.start_ns)
+            self.started = True
+            for top_beam in self.top_beams:
+                top_beam.begin(self.start_ns)
+        if transition.count:
+            self.traversal_counts[self.beam] += 1
+            print(f'{self.ID} traversal_count +=1 for {self.beam}: {self.traversal_counts}')
+        if transition.event is not None:
+            self.log(transition.event, t_ns, self.traversal_counts[self.beam] if transition.count else '')
+        self.enter(transition.to, t_ns)
+
+    def log(self, event, t_ns, count = ''):
+        beam = self.beam if event.with_beam else 0
+        self.timestamp_writer.write_timestamp((self.ID, beam if beam else '', (t_ns - self.start_ns)/1e9, event.names[beam], count,
+                                               (t_ns - self.latency_from_ns)/1e9 if event.with_latency else '',
+                                               self.notes[beam]), state_change = True, edge_ns = t_ns)
+        if event.mark:
+            self.latency_from_ns = t_ns
+
+    def enter(self, index, t_ns):
+        state = self.machine.states[index]
+        if state.wait_clear and any(beam.is_blocked() for beam in self.all_breaks):
+            print(f'{self.ID} waiting for beambreaks to be unblocked')
+            self.scheduler.call_later(0.5, self.enter, index, t_ns)
+            return
+        self.epoch += 1
+        self.current = index
+        self.state = state.name
+        print(f'{self.ID} {state.name} state')
+
+        if state.listens_button:
+            self.button.set_callback(self._button_handler)
+        else:
+            self.button.clear_callback()
+        for beam, handler in zip(self.beams, self._beam_handlers):
+            if state.listens_traversal:
+                beam.set_callback(handler)
+            else:
+                beam.clear_callback()
+        if state.record_top and not self.recording_top:
+            for top_beam in self.top_beams:
+                top_beam.record_durations()
+        elif not state.record_top and self.recording_top:
+            for top_beam in self.top_beams:
+                top_beam.clear_callback()
+        self.recording_top = state.record_top
+
+        if state.led_on:
+            self.LED.set_on()
+        elif state.led_off:
+            self.LED.set_off()
+        elif state.flash:
+            self.LED.flash(frequency = state.flash, interrupt_func = self.LED.interrupt_LED)
+
+        if state.event is not None:
+            self.log(state.event, t_ns)
+        if state.timer_after is not None:
+            after = state.timer_after if isinstance(state.timer_after, (int, float)) else getattr(self, state.timer_after)
+            end_ns = t_ns + int(after*1e9)
+            #by delay, as CLOCK can be offset from the scheduler's clock (a resumed session)
+            self.scheduler.call_later(max(0, (end_ns - CLOCK.now_ns())/1e9), self.timer_fired, self.epoch, end_ns)
+        if state.finish:
+            print(f'{self.ID} shut down')
+            self.exit = True
+            self.timestamp_writer.shut_down()
+
+
+def pin_of(value):
+    '''hardware entries are either a pin number or {pin: n, ...}'''
+    return value['pin'] if isinstance(value, dict) else value
+
+def build_box(config_dict, box_ID, timestamp_writer, machine = None):
+    '''State_Machine_Box for a box in the run config, with its beams, LED and button made from the hardware section'''
+    from components import IR_beambreak, Button, LED
+    hardware = config_dict['hardware'][box_ID]
+    spec = config_dict['software'].get('state_machine', DEFAULT_SPEC)
+    traversal_names = hardware.get('traversal_beams', spec.get('traversal_beams', DEFAULT_SPEC['traversal_beams']))
+    top_names = hardware.get('top_beams', spec.get('top_beams', []))
+    if machine is None or machine.n_beams < len(traversal_names):
+        machine = Compiled_State_Machine(spec, n_beams = len(traversal_names))
+    side_notes = config_dict['animals'][box_ID].get('side_notes', {})
+    traversal_beams = [IR_beambreak(pin_of(hardware[name])) for name in traversal_names]
+    top_beams = [IR_beambreak(pin_of(hardware[name]), timestamp_writer = timestamp_writer,
+                              notes = side_notes.get(name, f'pin {pin_of(hardware[name])}')) for name in top_names]
+    return State_Machine_Box(machine, traversal_beams, LED(hardware['led']), Button(hardware['button']), box_ID,
+                             top_beams = top_beams, notes = [side_notes.get(name) for name in traversal_names],
+                             timestamp_writer = timestamp_writer)
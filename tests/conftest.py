@@ -0,0 +1,20 @@
+import os
+import sys
+import pytest
+
+#everything runs against Fake_handlers.Simulated_GPIO and the fake servokit
+os.environ.setdefault('BEAMBREAK_BACKEND', 'simulated')
+os.environ.setdefault('BEAMBREAK_SERVO_BACKEND', 'simulated')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def session():
+    '''a clean clock and edge dispatcher for a test that runs sessions, put back afterwards'''
+    from session_clock import CLOCK
+    from components import EDGE_DISPATCHER
+    CLOCK.anchor()
+    yield
+    #GPIO.cleanup at the end of a session drops detection, so the dispatcher has to register the pins again
+    EDGE_DISPATCHER.release_all()
+    CLOCK.anchor()
@@ -0,0 +1,62 @@
+'''configs, journals and scripted boxes for the tests that run whole sessions on the simulated GPIO'''
+import datetime
+import json
+import threading
+import time
+import yaml
+from components import GPIO, Two_Beambreak_LED_Button_Combo, IR_beambreak, Button, LED
+
+
+def make_config(save_path, n_boxes = 1, total_time = 2, reward_period = 0.2, first_pin = 200, **software):
+    hardware = {f'box_{b}':{'ir_1':first_pin + 8*b, 'ir_2':first_pin + 8*b + 1, 'button':first_pin + 8*b + 4, 'led':b}
+                for b in range(n_boxes)}
+    software = dict({'reward_period':reward_period, 'total_time':total_time, 'save_path':str(save_path),
+                     'summary_interval':1, 'metrics':False}, **software)
+    return {'hardware':hardware, 'animals':{box_ID:{'focal':f'a{box_ID}', 'novel':'n'} for box_ID in hardware},
+            'software':software}
+
+def make_box(config_dict, box_ID, timestamp_writer):
+    hardware = config_dict['hardware'][box_ID]
+    return Two_Beambreak_LED_Button_Combo(IR_beambreak(hardware['ir_1']), IR_beambreak(hardware['ir_2']),
+                                          LED(hardware['led']), Button(hardware['button']), box_ID, notes_1 = 'novel',
+                                          notes_2 = 'partner', timestamp_writer = timestamp_writer)
+
+def press(pin, t, start):
+    GPIO.script_edges(pin, [(t, 0), (t + 0.05, 1)], start = start)
+
+def script_session(config_dict, traversals = (), presses = (0.3,), exit_presses = 20, exit_from = 0.5, delay = 0.3):
+    '''scripted edges for every box: presses (s after now + delay), beam breaks at (t, k), then a press every
+    0.25 s from exit_from on so each box gets shut down whenever it reaches its exit state'''
+    start = time.perf_counter() + delay
+    for hardware in config_dict['hardware'].values():
+        GPIO.setup(hardware['button'], GPIO.IN, pull_up_down = GPIO.PUD_UP)
+        for t in presses:
+            press(hardware['button'], t, start)
+        for t, k in traversals:
+            GPIO.setup(hardware[f'ir_{k}'], GPIO.IN, pull_up_down = GPIO.PUD_UP)
+            press(hardware[f'ir_{k}'], t, start)
+        for n in range(exit_presses):
+            press(hardware['button'], exit_from + 0.25*n, start)
+
+def run_in_thread(func, *args, timeout = 20, **kwargs):
+    '''func's return value, or None if it hadn't returned after timeout seconds'''
+    result = []
+    thread = threading.Thread(target = lambda: result.append(func(*args, **kwargs)), daemon = True)
+    thread.start()
+    thread.join(timeout)
+    return result[0] if result else None
+
+def write_journal(fpath, config_dict, wall_anchor, mono_anchor_ns, records = ()):
+    with open(fpath, 'w') as f:
+        for record in [{'kind':'session', 'date':datetime.datetime.now().isoformat(), 'config':yaml.safe_dump(config_dict),
+                        'wall_anchor':wall_anchor, 'mono_anchor_ns':mono_anchor_ns, 'wall_time':time.time()}] + list(records):
+            f.write(json.dumps(record) + '\n')
+
+def checkpoint(box_ID, elapsed, traversal_counts, state = 'ready'):
+    return {'kind':'checkpoint', 'box':box_ID, 'state':state, 'started':True, 'exit':False,
+            'traversal_counts':traversal_counts, 'elapsed':elapsed, 'start_time':None, 'latency_from':None,
+            'reward_time':None, 'wall_time':time.time()}
+
+def read_rows(fpath):
+    with open(fpath) as f:
+        return [line.rstrip('\n').split(',') for line in f][1:]
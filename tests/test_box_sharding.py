@@ -0,0 +1,119 @@
+import csv
+import multiprocessing
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+import pytest
+from box_sharding import Shared_Event_Ring, Ring_Publisher, Ring_TimestampManager, Event_Aggregator
+from recording_classes import TimestampManager, Timestamp_Writer_Thread
+from session_helpers import make_config, run_in_thread
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEADER = ['ID', 'beam', 'elapsed_time', 'event', 'count', 'latency', 'notes']
+LINES = [(('box_0', '', 0.0, 'reset', '', 1.25, ''), False),
+         (('box_0', 1, 0.1 + 0.2, '1 traversal', 1, 0.30000000000000004, 'novel'), True),
+         (('box_0', 1, 12.345678901, 'reward_period_end', '', '', 'novel'), True),
+         (('box_0', 'pin 19', 13.0, 'beam_break_duration', '', 0.5, 'novel_top'), False)]
+
+
+@pytest.fixture
+def ring():
+    context = multiprocessing.get_context('fork')
+    ring = Shared_Event_Ring(context, context.Event(), slots = 8)
+    yield ring
+    ring.close(unlink = True)
+
+def test_ring_keeps_order_across_wraps(ring):
+    for n in range(20):
+        ring.publish(bytes([n])*4)
+        if n % 3 == 2:
+            assert [record[0] for record in ring.drain()] == [n - 2, n - 1, n]
+    assert [record[0] for record in ring.drain()] == [18, 19]
+    assert ring.depth() == 0 and ring.drain() == []
+
+def test_ring_drain_is_bounded(ring):
+    for n in range(6):
+        ring.publish(bytes([n]))
+    assert len(ring.drain(max_records = 4)) == 4
+    assert ring.depth() == 2
+
+@pytest.mark.parametrize('log_format', ['csv', 'binary'])
+def test_lines_through_the_ring_are_byte_identical(tmp_path, ring, log_format):
+    '''the aggregator rebuilds each line and writes it the way the worker's TimestampManager would have'''
+    direct_writer = Timestamp_Writer_Thread()
+    direct = TimestampManager(str(tmp_path), 'direct', writer = direct_writer, log_format = log_format)
+    direct.create_file(HEADER)
+    shared_writer = Timestamp_Writer_Thread()
+    aggregator = Event_Aggregator([ring], ring.doorbell, shared_writer, poll_interval = 0.01)
+    publisher = Ring_Publisher(ring)
+    sharded = Ring_TimestampManager(publisher, str(tmp_path), 'sharded', log_format = log_format)
+    sharded.create_file(HEADER)
+    aggregator.start()
+    for n, (line, state_change) in enumerate(LINES):
+        edge_ns, delay_ns = 10**12 + n*10**9, 1000 + n
+        direct.write_record(line, edge_ns, delay_ns, state_change)
+        publisher.event(sharded.file_id, line, edge_ns, delay_ns, state_change)
+    sharded.shut_down()
+    publisher.done()
+    assert aggregator.wait(5)
+    direct.shut_down()
+    shared_writer.shut_down()
+    with open(tmp_path / 'direct', 'rb') as a, open(tmp_path / 'sharded', 'rb') as b:
+        assert a.read() == b.read()
+
+
+def run_scripted(out_dir, processes, duration = 3):
+    '''benchmark_sharding's scripted session in a fresh interpreter, as the benchmark runs it. csv rows by focal animal'''
+    os.makedirs(out_dir)
+    script = os.path.join(REPO, 'benchmark_sharding.py')
+    command = [sys.executable, script, '--single', '--boxes', '2', '--processes', str(processes), '--duration',
+               str(duration), '--out_dir', out_dir, '--seed', '0', '--result_file', os.path.join(out_dir, 'result.json')]
+    #its own process group, so a session that hangs goes with its workers
+    process = subprocess.Popen(command, cwd = REPO, start_new_session = True)
+    try:
+        assert process.wait(timeout = 60) == 0
+    finally:
+        if process.poll() is None:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+    files = {}
+    for fname in sorted(os.listdir(out_dir)):
+        #<focal>_<month>_<day>_<year>___<time>_.csv
+        match = re.match(r'(.+?)_\d+_\d+_\d+___.*\.csv$', fname)
+        if match and fname.startswith('animal_'):
+            with open(os.path.join(out_dir, fname)) as f:
+                files[match.group(1)] = list(csv.reader(f))
+    return files
+
+def test_sharded_session_writes_the_same_rows(tmp_path):
+    single = run_scripted(str(tmp_path / 'single'), 1)
+    sharded = run_scripted(str(tmp_path / 'sharded'), 2)
+    assert sorted(single) == sorted(sharded) == ['animal_0', 'animal_1']
+    for animal, rows in single.items():
+        other = sharded[animal]
+        assert rows[0] == other[0]
+        assert len(rows) == len(other) > 5
+        for a, b in zip(rows[1:], other[1:]):
+            #ID, beam, event, count and notes match exactly. the times are two real runs of the same script
+            assert [a[i] for i in (0, 1, 3, 4, 6)] == [b[i] for i in (0, 1, 3, 4, 6)]
+            assert abs(float(a[2]) - float(b[2])) < 0.05
+            assert (a[5] == '') == (b[5] == '')
+
+
+def die_in_worker(config_dict, box_ID, timestamp_writer):
+    from session_helpers import make_box
+    if box_ID == 'box_1':
+        os._exit(3)
+    return make_box(config_dict, box_ID, timestamp_writer)
+
+def test_a_dead_worker_stops_the_others(tmp_path, session):
+    from session_orchestrator import run_session
+    config_dict = make_config(tmp_path, n_boxes = 2, total_time = 60, processes = 2, first_pin = 400)
+    started = time.perf_counter()
+    #box_0 never gets its start press, so its worker only stops if it is stopped
+    assert run_in_thread(run_session, config_dict, die_in_worker, timeout = 30) is not None
+    assert time.perf_counter() - started < 15
@@ -0,0 +1,41 @@
+import time
+import numpy as np
+from components import IR_beambreak
+from edge_dispatcher import Edge_Dispatcher
+from Fake_handlers import Simulated_GPIO
+from pin_sampler import Sampled_GPIO
+
+PIN = 500
+
+
+class Recording_Confirmation:
+    '''takes the place of the Confirmation_Engine, keeping what the beam had stamped when the edge was handed over'''
+    def __init__(self, beam):
+        self.beam = beam
+        self.edges = []
+
+    def confirm(self, pin, callback_func, state_func, failure_func = None):
+        self.edges.append(self.beam.last_edge_ns)
+
+
+def test_beam_edge_time_is_the_sample_time(session):
+    simulated = Simulated_GPIO()
+    simulated.setup(PIN, simulated.IN, pull_up_down = simulated.PUD_UP)
+    #a long dispatch interval, so the callback runs well after the sample that found the edge
+    gpio = Sampled_GPIO(simulated, rate = 1000, use_pigpio = False, dispatch_interval = 0.05)
+    dispatcher = Edge_Dispatcher(gpio)
+    beam = IR_beambreak(PIN, edge_dispatcher = dispatcher)
+    beam.confirmation_engine = Recording_Confirmation(beam)
+    beam.set_callback(lambda *args: None)
+    try:
+        time.sleep(0.1)
+        simulated.set_level(PIN, 0)
+        end = time.perf_counter() + 2
+        while not beam.confirmation_engine.edges and time.perf_counter() < end:
+            time.sleep(0.005)
+    finally:
+        gpio.sampler.stop()
+    times, levels, pins = gpio.sampler.window()
+    blocked = np.nonzero(levels[:, pins.index(PIN)] == 0)[0]
+    assert beam.confirmation_engine.edges == [int(times[blocked[0]])]
+    assert dispatcher.edge_ns(PIN) == int(times[blocked[0]])
@@ -0,0 +1,34 @@
+import glob
+import time
+from session_orchestrator import resume_session
+from session_helpers import make_config, make_box, script_session, run_in_thread, write_journal, checkpoint, read_rows
+
+
+def resume_after_reboot(tmp_path, **software):
+    '''resume a journal whose clock anchor is far from this boot's perf_counter, as after a power cut'''
+    config_dict = make_config(tmp_path, total_time = 1.5, **software)
+    journal = tmp_path / 'journal.jsonl'
+    write_journal(journal, config_dict, wall_anchor = time.time() - 5, mono_anchor_ns = 10**15,
+                  records = [checkpoint('box_0', 1.0, {'1':1, '2':0})])
+    return config_dict, str(journal)
+
+def test_resumed_box_exits_at_its_deadline(tmp_path, session):
+    config_dict, journal = resume_after_reboot(tmp_path)
+    script_session(config_dict, exit_from = 0.4)
+    started = time.perf_counter()
+    boxes = run_in_thread(resume_session, journal, make_box)
+    assert boxes is not None, 'the resumed box was never sent to its exit state'
+    assert boxes[0].ir_pair.exit
+    #0.5 s were left of the 1.5 s session
+    assert time.perf_counter() - started < 5
+    rows = read_rows(glob.glob(str(tmp_path / 'abox_0*.csv'))[0])
+    assert rows[0][3] == 'reset' and float(rows[0][2]) >= 1.0
+
+def test_resumed_table_box_ends_its_reward_period(tmp_path, session):
+    config_dict, journal = resume_after_reboot(tmp_path, engine = 'table')
+    config_dict['software']['total_time'] = 2.0
+    script_session(config_dict, traversals = [(0.5, 1)], exit_from = 0.9)
+    boxes = run_in_thread(resume_session, journal, make_box)
+    assert boxes is not None and boxes[0].ir_pair.exit
+    events = [row[3] for row in read_rows(glob.glob(str(tmp_path / 'abox_0*.csv'))[0])]
+    assert events[:3] == ['reset', '1 traversal', 'reward_period_end']
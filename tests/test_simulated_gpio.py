@@ -0,0 +1,36 @@
+import multiprocessing
+import time
+from Fake_handlers import Simulated_GPIO
+
+
+def callback_in_child(gpio, queue):
+    '''what a box_sharding worker does: register a pin and script its edges after the fork'''
+    calls = []
+    gpio.setup(11, gpio.IN, pull_up_down = gpio.PUD_UP)
+    gpio.add_event_detect(11, gpio.FALLING, callback = calls.append)
+    gpio.script_edges(11, [(0.01, 0)])
+    gpio.wait_for_timeline(timeout = 2)
+    gpio.wait_for_callbacks(timeout = 2)
+    queue.put(calls)
+
+
+def test_scripted_edges_reach_callbacks_in_a_forked_child():
+    gpio = Simulated_GPIO()
+    #start the parent's dispatcher and player, which the child inherits as dead thread objects
+    gpio.setup(10, gpio.IN, pull_up_down = gpio.PUD_UP)
+    gpio.add_event_detect(10, gpio.FALLING, callback = lambda pin: None)
+    gpio.script_edges(10, [(0, 0)])
+    gpio.wait_for_timeline(timeout = 2)
+    gpio.wait_for_callbacks(timeout = 2)
+
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    child = context.Process(target = callback_in_child, args = (gpio, queue))
+    child.start()
+    try:
+        assert queue.get(timeout = 10) == [11]
+    finally:
+        child.join(timeout = 5)
+        if child.is_alive():
+            child.terminate()
+    gpio.cleanup()
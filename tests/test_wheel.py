@@ -0,0 +1,61 @@
+from array import array
+from wheel import Edge_Ring_Buffer, Wheel
+
+
+def filled(size, n):
+    ring = Edge_Ring_Buffer(size)
+    for t in range(n):
+        ring.append(t)
+    return ring
+
+def test_empty_buffer():
+    times, cursor = Edge_Ring_Buffer(8).snapshot()
+    assert list(times) == [] and cursor == 0
+
+def test_partial_buffer():
+    ring = filled(8, 3)
+    assert ring.snapshot() == (array('q', [0, 1, 2]), 3)
+    assert list(ring.snapshot(since = 1)[0]) == [1, 2]
+    assert list(ring.snapshot(since = 3)[0]) == []
+
+def test_negative_cursor_only_returns_real_edges():
+    ring = filled(8, 1)
+    assert list(ring.snapshot(since = ring.count - 3)[0]) == [0]
+
+def test_wrapped_buffer_keeps_the_newest():
+    ring = filled(8, 13)
+    times, cursor = ring.snapshot()
+    assert list(times) == list(range(5, 13)) and cursor == 13
+    #a cursor that fell behind skips what was overwritten
+    assert list(ring.snapshot(since = 2)[0]) == list(range(5, 13))
+    assert list(ring.snapshot(since = 10)[0]) == [10, 11, 12]
+
+def test_cursor_continues_across_snapshots():
+    ring = filled(8, 5)
+    _, cursor = ring.snapshot()
+    for t in range(5, 9):
+        ring.append(t)
+    assert ring.snapshot(since = cursor) == (array('q', [5, 6, 7, 8]), 9)
+
+def test_writer_lapping_the_reader_drops_overwritten_edges():
+    ring = filled(8, 8)
+
+    class Lapping(array):
+        '''the callback appends 3 edges while the reader is copying'''
+        def __getitem__(self, index):
+            if isinstance(index, slice) and ring.count == 8:
+                for t in range(8, 11):
+                    ring.append(t)
+            return super().__getitem__(index)
+
+    ring.times = Lapping('q', ring.times)
+    times, cursor = ring.snapshot()
+    assert list(times) == [3, 4, 5, 6, 7] and cursor == 8
+
+def test_wheel_speed_and_intervals_need_two_revolutions():
+    wheel = Wheel(300, 'w')
+    assert wheel.instantaneous_speed() == 0.0 and wheel.intervals(3) == []
+    wheel.iterate(300)
+    assert wheel.instantaneous_speed() == 0.0 and wheel.intervals(3) == []
+    wheel.iterate(300)
+    assert wheel.instantaneous_speed() > 0 and len(wheel.intervals(3)) == 1
@@ -0,0 +1,146 @@
+'''timing helpers: one thread that runs many short timers instead of a sleeping thread per timer, and a
+low-cpu fixed-rate sampler on absolute deadlines.'''
+import threading
+import heapq
+import time
+import itertools
+import traceback
+
+
+class Timer_Handle:
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Timer_Scheduler:
+    '''runs func(*args) at a deadline from a single daemon thread.
+    timers should be short and never block, or every other timer on the scheduler waits behind them.
+    Event_Loop_Runtime has the same call_later interface, so either can be handed to anything that takes a scheduler'''
+
+    def __init__(self, name = 'timer_scheduler', clock = time.perf_counter):
+        self.name = name
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = True
+
+    def call_later(self, delay, func, *args):
+        return self.call_at(self.clock() + delay, func, *args)
+
+    def call_at(self, deadline, func, *args):
+        handle = Timer_Handle(deadline)
+        with self._condition:
+            heapq.heappush(self._heap, (deadline, next(self._counter), handle, func, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run, daemon = True, name = self.name)
+                self._thread.start()
+            elif self._heap[0][2] is handle:
+                #new earliest deadline, wake the thread so it doesn't oversleep
+                self._condition.notify()
+        return handle
+
+    def call_soon(self, func, *args):
+        return self.call_at(self.clock(), func, *args)
+
+    def pending(self):
+        with self._condition:
+            return sum(not entry[2].cancelled for entry in self._heap)
+
+    def shut_down(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and (not self._heap or self._heap[0][0] > self.clock()):
+                    timeout = self._heap[0][0] - self.clock() if self._heap else None
+                    self._condition.wait(timeout)
+                if not self._running:
+                    return
+                _, _, handle, func, args = heapq.heappop(self._heap)
+            if handle.cancelled:
+                continue
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+
+
+class Deadline_Sampler:
+    '''calls func on absolute deadlines (start + n*interval), so the time func takes never accumulates as drift.
+    sleeps until spin_window before each deadline and only busy-waits for that last stretch, instead of a whole core.
+    keeps running jitter (lateness past each deadline) and missed-deadline counts'''
+
+    def __init__(self, interval, spin_window = 0.002, clock = time.perf_counter):
+        self.interval = interval
+        self.spin_window = spin_window
+        self.clock = clock
+        self.running = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.samples = 0
+        self.missed = 0
+        self.mean_lateness = 0.0
+        self._m2 = 0.0
+        self.max_lateness = 0.0
+
+    def wait_until(self, deadline):
+        remaining = deadline - self.clock()
+        if remaining > self.spin_window:
+            time.sleep(remaining - self.spin_window)
+        while self.clock() < deadline:
+            pass
+
+    def run(self, func, duration = None):
+        '''call func every interval until duration seconds have passed (forever if None) or stop() is called.
+        deadlines that have already passed when func returns are skipped and counted as missed rather than run late'''
+        self.running = True
+        start = self.clock()
+        n = 0
+        while self.running:
+            deadline = start + n*self.interval
+            if duration is not None and deadline - start >= duration:
+                break
+            self.wait_until(deadline)
+            self._record(self.clock() - deadline)
+            func()
+            n += 1
+            behind = int((self.clock() - start)/self.interval) + 1 - n
+            if behind > 0:
+                self.missed += behind
+                n += behind
+        self.running = False
+
+    def stop(self):
+        self.running = False
+
+    def _record(self, lateness):
+        self.samples += 1
+        delta = lateness - self.mean_lateness
+        self.mean_lateness += delta/self.samples
+        self._m2 += delta*(lateness - self.mean_lateness)
+        self.max_lateness = max(self.max_lateness, lateness)
+
+    def stats(self):
+        std = (self._m2/(self.samples - 1))**0.5 if self.samples > 1 else 0.0
+        return {'samples':self.samples,
+                'missed':self.missed,
+                'mean_jitter_ms':self.mean_lateness*1000,
+                'std_jitter_ms':std*1000,
+                'max_jitter_ms':self.max_lateness*1000}
+
+    def report(self):
+        s = self.stats()
+        return (f"{s['samples']} samples, {s['missed']} missed deadlines, jitter mean {s['mean_jitter_ms']:.3f} ms "
+                f"/ std {s['std_jitter_ms']:.3f} ms / max {s['max_jitter_ms']:.3f} ms")
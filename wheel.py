@@ -1,26 +1,96 @@
 import time as time
-import RPi.GPIO as GPIO
-GPIO.setmode(GPIO.BCM)
+from array import array
+from hardware_backends import GPIO
+from session_clock import CLOCK
+
+
+class Edge_Ring_Buffer:
+    '''fixed-size ring of int64 timestamps (CLOCK ns) backed by a preallocated array, so storing an edge
+    doesn't create or keep any python objects. count is the total number of edges ever appended and works
+    as a cursor: snapshot(since = cursor) returns only what arrived after it'''
+
+    def __init__(self, size = 4096):
+        self.size = size
+        self.times = array('q', bytes(8*size))
+        self.count = 0
+
+    def append(self, t_ns):
+        self.times[self.count % self.size] = t_ns
+        self.count += 1
+
+    def snapshot(self, since = 0):
+        '''returns (times, cursor): an array of the edges from since onwards, oldest first, and the cursor to pass
+        next time. edges already overwritten are skipped. safe to call while the GPIO callback keeps appending'''
+        end = self.count
+        #a cursor from count - n is negative while fewer than n edges have arrived
+        start = max(since, 0, end - self.size)
+        if start >= end:
+            return array('q'), end
+        first, last = start % self.size, end % self.size
+        if first < last:
+            times = self.times[first:last]
+        else:
+            times = self.times[first:] + self.times[:last]
+        #the writer may have lapped us while copying; drop anything it overwrote
+        overwritten = self.count - self.size - start
+        if overwritten > 0:
+            times = times[overwritten:]
+        return times, end
 
 
 class Wheel:
-    
-    def __init__(self, pin, id) -> None:
+
+    def __init__(self, pin, id, buffer_size = 4096) -> None:
         self.pin = pin
         GPIO.setup(self.pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
         self.ID = id
         self.reads = 0
-    
+        self.edges = Edge_Ring_Buffer(buffer_size)
+
     def setup_callback(self):
         GPIO.add_event_detect(self.pin, GPIO.FALLING, callback = self.iterate)
-    
+
     def iterate(self, pin):
         '''add event detect by defualt passes back the channel (pin) on which it was set up. '''
+        self.edges.append(CLOCK.now_ns())
         self.reads += 1
         if self.reads % 10 == 1:
             print(f'{self.ID}: {self.reads}')
-    
+
     def get_ID(self):
         return self.ID
-    
-    
\ No newline at end of file
+
+    def edge_times(self, since = 0):
+        '''(edge times in CLOCK ns, cursor) for every revolution since the cursor still in the buffer'''
+        return self.edges.snapshot(since)
+
+    def intervals(self, last_n = None):
+        '''seconds between consecutive revolutions, oldest first'''
+        times, _ = self.edges.snapshot(0 if last_n is None else self.edges.count - last_n - 1)
+        return [(b - a)/1e9 for a, b in zip(times, times[1:])]
+
+    def instantaneous_speed(self, circumference = None, stale_after = 2.0):
+        '''revolutions per second from the latest inter-revolution interval (distance per second if the wheel
+        circumference is given). 0 once the last revolution is more than stale_after seconds old'''
+        times, _ = self.edges.snapshot(self.edges.count - 2)
+        if len(times) < 2 or (CLOCK.now_ns() - times[-1])/1e9 > stale_after:
+            return 0.0
+        speed = 1e9/(times[-1] - times[-2])
+        return speed*circumference if circumference else speed
+
+    def bouts(self, max_gap = 2.0, min_revolutions = 3):
+        '''running bouts in the buffer: runs of revolutions no more than max_gap seconds apart.
+        returns a list of (start_ns, end_ns, revolutions)'''
+        times, _ = self.edges.snapshot(0)
+        bouts = []
+        if not times:
+            return bouts
+        max_gap_ns = max_gap*1e9
+        start = 0
+        for i in range(1, len(times) + 1):
+            if i == len(times) or times[i] - times[i-1] > max_gap_ns:
+                if i - start >= min_revolutions:
+                    bouts += [(times[start], times[i-1], i - start)]
+                start = i
+        return bouts
+
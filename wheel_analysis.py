@@ -0,0 +1,236 @@
+'''speed, distance and running bouts from wheel_recorder csvs, for many sessions at once.
+
+a wheel_recorder csv has a time column (s) and one cumulative reads column per animal, sampled every
+time_interval. for each animal:
+    speed       revolutions per second over a sliding window (distance per second with a circumference)
+    distance    cumulative revolutions (times the circumference if given)
+    bouts       runs of revolutions no more than max_gap seconds apart with at least min_revolutions, the same
+                rule as Wheel.bouts on the pi
+all of it is diff/threshold/cumsum on whole columns. decimate() keeps each bin's min and max so a downsampled
+plot still shows every peak.
+
+sessions run in a process pool, and each result is cached in cache_dir keyed by the file's path, size and mtime
+and the analysis settings, so re-running over a growing results directory only analyzes new or changed files.
+
+    python wheel_analysis.py /home/donaldsonlab/temp_wheel_data --circumference 0.5 --out wheel_summary.csv
+'''
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'wheel_analysis')
+CACHE_VERSION = 1
+
+
+class Wheel_Settings:
+    def __init__(self, circumference = None, speed_window = 1.0, max_gap = 2.0, min_revolutions = 3):
+        self.circumference = circumference
+        self.speed_window = speed_window
+        self.max_gap = max_gap
+        self.min_revolutions = min_revolutions
+
+    def key(self):
+        return json.dumps(vars(self), sort_keys = True)
+
+
+class Wheel_Session:
+    '''one analyzed csv. samples is long form (time, animal, reads, speed, distance), bouts one row per bout,
+    summary one row per animal'''
+    def __init__(self, path, samples, bouts, summary):
+        self.path = path
+        self.samples = samples
+        self.bouts = bouts
+        self.summary = summary
+
+    def animal(self, animal):
+        return self.samples[self.samples['animal'] == str(animal)]
+
+
+def is_wheel_file(path):
+    if not path.endswith('.csv') or path.endswith('_edges.csv'):
+        return False
+    with open(path) as f:
+        header = f.readline().strip().split(',')
+    return len(header) > 1 and header[0] == 'time'
+
+def load_session(path):
+    df = pd.read_csv(path, dtype = {'time':'float64'})
+    df.columns = [str(column) for column in df.columns]
+    return df
+
+def revolutions_per_sample(reads):
+    '''new revolutions at each sample. the counter only goes up, a drop would be a restart so counts as 0'''
+    return np.clip(np.diff(reads, prepend = reads[0] if len(reads) else 0), 0, None)
+
+def windowed_speed(time, reads, window):
+    '''revolutions per second over the last window seconds at every sample'''
+    if len(time) < 2:
+        return np.zeros(len(time))
+    step = np.median(np.diff(time))
+    lag = max(1, int(round(window/step))) if step > 0 else 1
+    lagged = np.concatenate([np.full(lag, 0), np.arange(len(time) - lag)])[:len(time)]
+    elapsed = time - time[lagged]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        speed = (reads - reads[lagged])/elapsed
+    return np.where(elapsed > 0, np.clip(speed, 0, None), 0.0)
+
+def detect_bouts(time, reads, max_gap = 2.0, min_revolutions = 3):
+    '''(start, end, revolutions) arrays. a bout starts at the sample before its first revolution and ends at the
+    sample of its last one'''
+    new = revolutions_per_sample(reads)
+    active = np.flatnonzero(new > 0)
+    if not len(active):
+        empty = np.zeros(0)
+        return empty, empty, np.zeros(0, dtype = np.int64)
+    breaks = np.diff(time[active]) > max_gap
+    first = np.concatenate([[True], breaks])
+    last = np.concatenate([breaks, [True]])
+    revolutions = np.add.reduceat(new[active], np.flatnonzero(first))
+    starts = time[np.maximum(active[first] - 1, 0)]
+    ends = time[active[last]]
+    keep = revolutions >= min_revolutions
+    return starts[keep], ends[keep], revolutions[keep].astype(np.int64)
+
+def decimate(x, y, n_bins = 2000):
+    '''at most 2*n_bins points of (x, y), keeping the min and max of each bin in their original order'''
+    x, y = np.asarray(x), np.asarray(y, dtype = float)
+    if len(y) <= 2*n_bins:
+        return x, y
+    size = int(np.ceil(len(y)/n_bins))
+    padded = np.full(size*int(np.ceil(len(y)/size)), np.nan)
+    padded[:len(y)] = y
+    bins = padded.reshape(-1, size)
+    offsets = np.arange(len(bins))*size
+    keep = np.unique(np.concatenate([offsets + np.nanargmin(bins, axis = 1), offsets + np.nanargmax(bins, axis = 1)]))
+    return x[keep], y[keep]
+
+def analyze_session(path, settings = None):
+    settings = settings if settings else Wheel_Settings()
+    df = load_session(path)
+    time = df['time'].to_numpy()
+    scale = settings.circumference if settings.circumference else 1.0
+    samples, bouts, summary = [], [], []
+    for animal in df.columns[1:]:
+        reads = df[animal].to_numpy(dtype = np.int64)
+        speed = windowed_speed(time, reads, settings.speed_window)
+        samples += [pd.DataFrame({'time':time, 'animal':animal, 'reads':reads, 'speed':speed*scale,
+                                  'distance':(reads - reads[0])*scale})]
+        starts, ends, revolutions = detect_bouts(time, reads, settings.max_gap, settings.min_revolutions)
+        durations = ends - starts
+        bouts += [pd.DataFrame({'animal':animal, 'start':starts, 'end':ends, 'duration':durations,
+                                'revolutions':revolutions, 'distance':revolutions*scale,
+                                'mean_speed':np.divide(revolutions*scale, durations, out = np.zeros(len(durations)),
+                                                       where = durations > 0)})]
+        running_s = durations.sum()
+        summary += [{'file':os.path.basename(path), 'animal':animal, 'session_s':time[-1] - time[0] if len(time) else 0,
+                     'revolutions':int(reads[-1] - reads[0]) if len(reads) else 0,
+                     'distance':(reads[-1] - reads[0])*scale if len(reads) else 0,
+                     'bouts':len(starts), 'running_s':running_s,
+                     'mean_bout_s':durations.mean() if len(durations) else np.nan,
+                     'running_speed':revolutions.sum()*scale/running_s if running_s else np.nan,
+                     'max_speed':speed.max()*scale if len(speed) else 0}]
+    samples = pd.concat(samples, ignore_index = True) if samples else pd.DataFrame()
+    if len(samples):
+        samples['animal'] = samples['animal'].astype('category')
+    return Wheel_Session(path, samples, pd.concat(bouts, ignore_index = True) if bouts else pd.DataFrame(),
+                         pd.DataFrame(summary))
+
+
+def cache_path(path, settings, cache_dir):
+    key = json.dumps([CACHE_VERSION, os.path.abspath(path), settings.key()])
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.pkl')
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def load_cached(path, settings, cache_dir):
+    '''the cached Wheel_Session for path, or None if there isn't one or the file changed since'''
+    cached = cache_path(path, settings, cache_dir)
+    if not os.path.exists(cached):
+        return None
+    stamp, result = pd.read_pickle(cached)
+    return result if stamp == file_stamp(path) else None
+
+def analyze_and_cache(path, settings, cache_dir):
+    '''runs in the pool workers. a changed file overwrites its old entry'''
+    stamp = file_stamp(path)
+    result = analyze_session(path, settings)
+    if cache_dir is not None:
+        cached = cache_path(path, settings, cache_dir)
+        os.makedirs(cache_dir, exist_ok = True)
+        tmp = f'{cached}.{os.getpid()}.tmp'
+        pd.to_pickle((stamp, result), tmp)
+        os.replace(tmp, cached)
+    return result
+
+def wheel_files(paths):
+    for root in paths:
+        if os.path.isfile(root):
+            yield root
+            continue
+        for directory, subdirectories, files in os.walk(root):
+            subdirectories.sort()
+            for fname in sorted(files):
+                if is_wheel_file(os.path.join(directory, fname)):
+                    yield os.path.join(directory, fname)
+
+def analyze_sessions(paths, settings = None, workers = None, cache_dir = CACHE_DIR):
+    '''Wheel_Sessions for every wheel csv in paths (files or directories), in order. workers defaults to one per
+    cpu, 1 runs everything in this process. cache_dir None turns the cache off'''
+    settings = settings if settings else Wheel_Settings()
+    files = list(wheel_files(paths))
+    results = [load_cached(path, settings, cache_dir) if cache_dir is not None else None for path in files]
+    missing = [path for path, result in zip(files, results) if result is None]
+    workers = min(workers if workers else os.cpu_count(), len(missing))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            fresh = list(pool.map(analyze_and_cache, missing, [settings]*len(missing), [cache_dir]*len(missing)))
+    else:
+        fresh = [analyze_and_cache(path, settings, cache_dir) for path in missing]
+    fresh = iter(fresh)
+    return [result if result is not None else next(fresh) for result in results]
+
+def summary_table(sessions):
+    return pd.concat([session.summary for session in sessions], ignore_index = True) if sessions else pd.DataFrame()
+
+def plot_session(session, axes = None, n_bins = 2000):
+    '''speed of every animal (decimated) with its bouts shaded. needs matplotlib'''
+    import matplotlib.pyplot as plt
+    animals = list(session.summary['animal'])
+    if axes is None:
+        _, axes = plt.subplots(len(animals), 1, sharex = True, squeeze = False, figsize = (12, 2.5*len(animals)))
+        axes = axes[:, 0]
+    for ax, animal in zip(axes, animals):
+        samples = session.animal(animal)
+        ax.plot(*decimate(samples['time'].to_numpy(), samples['speed'].to_numpy(), n_bins), lw = 0.7)
+        for bout in session.bouts[session.bouts['animal'] == animal].itertuples():
+            ax.axvspan(bout.start, bout.end, color = 'tab:orange', alpha = 0.2, lw = 0)
+        ax.set_ylabel(f'{animal} speed')
+    axes[-1].set_xlabel('time (s)')
+    return axes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'speed, distance and bouts for wheel_recorder csvs')
+    parser.add_argument('paths', type = str, nargs = '+', help = 'wheel csvs or directories of them')
+    parser.add_argument('--circumference', type = float, default = None, help = 'distance per revolution')
+    parser.add_argument('--speed_window', type = float, default = 1.0, help = 'seconds speed is averaged over')
+    parser.add_argument('--max_gap', type = float, default = 2.0, help = 'longest pause (s) inside a bout')
+    parser.add_argument('--min_revolutions', type = int, default = 3)
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--cache_dir', type = str, default = CACHE_DIR)
+    parser.add_argument('--no_cache', action = 'store_true')
+    parser.add_argument('--out', type = str, default = None, help = 'write the per animal summary here')
+    args = parser.parse_args()
+    settings = Wheel_Settings(args.circumference, args.speed_window, args.max_gap, args.min_revolutions)
+    sessions = analyze_sessions(args.paths, settings, args.workers, None if args.no_cache else args.cache_dir)
+    summary = summary_table(sessions)
+    print(summary.to_string(index = False) if len(summary) else 'no wheel csvs found')
+    if args.out and len(summary):
+        summary.to_csv(args.out, index = False)
+        print(f'wrote {args.out}')
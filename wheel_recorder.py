@@ -3,7 +3,10 @@ from datetime import datetime
 import os as os
 import time as time
 import csv
-import RPi.GPIO as GPIO
+from hardware_backends import GPIO
+from timer_scheduler import Deadline_Sampler
+from recording_classes import Buffered_Row_Writer
+from session_clock import CLOCK
 
 
 save_location = '/home/donaldsonlab/temp_wheel_data/'
@@ -14,12 +17,7 @@ animal_nums = ['6711']
 
 time_interval = 0.1 #50ms between recording. note that the wheel will still iterate
 duration = 45*60 #30 sec for testing
-
-def precise_sleeper(duration, get_now=time.perf_counter):
-    now = get_now()
-    end = now + duration
-    while now < end:
-        now = get_now()
+record_edges = True #also write every revolution's timestamp to <file>_edges.csv
 
 def make_filepath(save_location, animal_nums):
     date = datetime.now()
@@ -39,25 +37,58 @@ def make_row(start_time, wheel_dict):
     row = [wheel_dict[id].reads for id in wheel_ids]
     return [round(time.time() - start_time, 4) ] + row
 
-def write_row(filepath, row):
-     with open(filepath, 'a+') as f:
+def make_edges_filepath(filepath):
+    return filepath[:-len('.csv')] + '_edges.csv'
+
+def create_edges_csv(filepath):
+    with open(filepath, 'w+') as f:
         writer = csv.writer(f)
-        writer.writerow(row)
-        
+        writer.writerow(['animal', 'time', 'edge_ns'])
+
+def write_new_edges(edge_writer, start_ns, wheel_dict, cursors):
+    '''copies the revolutions each wheel's ring buffer picked up since the last sample. runs on the sampler
+    thread, so the GPIO callback only ever stores a timestamp'''
+    for id in sorted(wheel_dict.keys()):
+        times, cursors[id] = wheel_dict[id].edge_times(cursors[id])
+        for t_ns in times:
+            edge_writer.writerow([id, round((t_ns - start_ns)/1e9, 6), t_ns])
+
 
 wheels = {animal:Wheel(pin, animal) for pin, animal in zip(wheels_pins, animal_nums)}
 filepath = make_filepath(save_location, animal_nums)
 create_csv(filepath, animal_nums)
 
 
+CLOCK.anchor()
 start_time = time.time()
+start_ns = CLOCK.now_ns()
 [wheel.setup_callback() for _, wheel in wheels.items()]
 
-while time.time() - start_time < duration:
-    row = make_row(start_time, wheels)
-    write_row(filepath, row)
-    precise_sleeper(time_interval)
-    
-GPIO.cleanup()
+#rows are held in memory and written out every few seconds, not opened/closed 10 times a second
+row_writer = Buffered_Row_Writer(filepath, flush_interval = 5, flush_rows = 100)
+if record_edges:
+    edges_filepath = make_edges_filepath(filepath)
+    create_edges_csv(edges_filepath)
+    edge_writer = Buffered_Row_Writer(edges_filepath, flush_interval = 5, flush_rows = 500)
+    edge_cursors = {animal:0 for animal in wheels}
+
+def sample():
+    row_writer.writerow(make_row(start_time, wheels))
+    if record_edges:
+        write_new_edges(edge_writer, start_ns, wheels, edge_cursors)
+
+#samples on absolute deadlines, sleeping between them rather than spinning the whole interval
+sampler = Deadline_Sampler(time_interval)
+try:
+    sampler.run(sample, duration = duration)
+except KeyboardInterrupt:
+    print('\nstopping early')
+finally:
+    row_writer.close()
+    if record_edges:
+        write_new_edges(edge_writer, start_ns, wheels, edge_cursors)
+        edge_writer.close()
+    GPIO.cleanup()
+print(f'sampler: {sampler.report()}')
 print('done!')
     